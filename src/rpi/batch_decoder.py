@@ -0,0 +1,217 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# whether the batch decoder can be used at all
+HAVE_NUMPY = np is not None
+
+# the shortest message the UMAS header fields can be read from
+UMAS_MIN_MSG_SZ = 0x0E
+
+
+class FpgaBatchDecoder():
+
+    def __init__(self, processor):
+        """
+        Initialize a decoder that handles a whole batch of raw FPGA messages
+        with NumPy, returning the same UMAS transactions as decoding them one
+        at a time with `processor`
+
+        The batch is packed into a 2-D uint32 array padded to its longest
+        message, byte swapped in one go and searched for the XBUS signatures
+        with vectorized compares, and the UMAS length byte and module IDs
+        are read as columns. Only gathering the variable length payloads is
+        left per message. Messages the array cannot represent, with a
+        trailing partial word or too short to hold a header, and XBUS types
+        other than UMAS go through `processor._decodeFpgaMsg`
+
+        Keyword arguments:
+        processor -- the FpgaMsgProcessor whose offsets and signature table
+                     are used
+        """
+
+        if not HAVE_NUMPY:
+            raise RuntimeError('the batch decoder needs NumPy')
+
+        self.processor = processor
+        self.signatures = [(name, np.frombuffer(signature, dtype=np.uint8)) \
+            for name, signature in zip(processor.xbus_signatures.names, \
+                processor.xbus_signatures.signatures)]
+
+        # reusable buffer the batch is packed into, grown as needed
+        self.buf = bytearray(0x4000)
+
+    def _pack(self, raw_fpga_msgs, row_sz):
+        """
+        Return the batch as an array of big endian bytes with one row per
+        message, zero padded to `row_sz`
+
+        Keyword arguments:
+        raw_fpga_msgs -- the raw little endian FPGA messages
+        row_sz -- the padded size of each row, a multiple of 4
+        """
+
+        batch_sz = len(raw_fpga_msgs) * row_sz
+        if batch_sz > len(self.buf):
+            self.buf = bytearray(batch_sz)
+        buf = self.buf
+
+        offset = 0x00
+        for raw_fpga_msg in raw_fpga_msgs:
+            msg_len = len(raw_fpga_msg)
+            buf[offset:offset + msg_len] = raw_fpga_msg
+            if msg_len < row_sz:
+                buf[offset + msg_len:offset + row_sz] = bytes(row_sz - msg_len)
+            offset += row_sz
+
+        words = np.frombuffer(buf, dtype='<u4', count=batch_sz // 0x04)
+        return words.byteswap().view(np.uint8) \
+            .reshape(len(raw_fpga_msgs), row_sz)
+
+    def _matchSignature(self, be_msgs, msg_lens, signature):
+        """
+        Return a boolean array of the rows containing a signature within
+        their message length
+
+        Keyword arguments:
+        be_msgs -- the big endian rows
+        msg_lens -- an array of the message length of each row
+        signature -- the signature as a uint8 array
+        """
+
+        sig_len = len(signature)
+        starts = be_msgs.shape[0x01] - sig_len + 0x01
+        if starts <= 0x00:
+            return np.zeros(len(be_msgs), dtype=bool)
+
+        found = be_msgs[:, :starts] == signature[0]
+        for idx in range(0x01, sig_len):
+            found &= be_msgs[:, idx:idx + starts] == signature[idx]
+
+        # a match running into the padding does not count
+        found &= np.arange(starts) + sig_len <= msg_lens[:, None]
+        return found.any(axis=0x01)
+
+    def _gatherPayload(self, cur_fpga_msg, umas_msg_sz, payload_sz):
+        """
+        Return the UMAS payload of one big endian message, sliced exactly
+        like `_extractXbusTraffic` followed by `_extractUmasTraffic`
+
+        Keyword arguments:
+        cur_fpga_msg -- a memoryview of the big endian message
+        umas_msg_sz -- the UMAS length byte
+        payload_sz -- the UMAS payload size derived from it
+        """
+
+        proc = self.processor
+        msg_len = len(cur_fpga_msg)
+
+        # everything fits in a single XBUS message
+        if umas_msg_sz <= proc.xbus_max_pay_sz \
+          or msg_len <= proc.xbus_msg_max_sz:
+            offset = proc.xbus_pay_start_offset + proc.xbus_umas_hdr_sz
+            return bytes(cur_fpga_msg[offset:offset + payload_sz])
+
+        parts = []
+        parts_sz = 0x00
+        last_start = (msg_len - 0x01) // proc.xbus_msg_max_sz \
+            * proc.xbus_msg_max_sz
+        for start in range(0x00, msg_len, proc.xbus_msg_max_sz):
+            part = cur_fpga_msg[start:start + proc.xbus_msg_max_sz]
+            if start == 0x00:
+                part = part[proc.xbus_pay_start_offset \
+                    + proc.xbus_umas_hdr_sz:proc.xbus_pay_end_offset]
+            elif start == last_start:
+                part = part[proc.xbus_pay_start_offset \
+                    :proc.xbus_pay_start_offset + payload_sz - parts_sz]
+            else:
+                part = part[proc.xbus_pay_start_offset \
+                    :proc.xbus_pay_start_offset + proc.xbus_max_pay_sz]
+            parts.append(part)
+            parts_sz += len(part)
+        return b''.join(parts)
+
+    def decode(self, raw_fpga_msgs):
+        """
+        Return a list with the UMAS transaction found in each message of a
+        batch, or None for messages without one
+
+        Keyword arguments:
+        raw_fpga_msgs -- a list of (ingest_ts, raw FPGA message) tuples
+        """
+
+        proc = self.processor
+        umas_txns = [None] * len(raw_fpga_msgs)
+
+        # only whole words of a sane size fit the array
+        batch = []
+        for idx, (ingest_ts, raw_fpga_msg) in enumerate(raw_fpga_msgs):
+            msg_len = len(raw_fpga_msg)
+            if msg_len & 0x03 or msg_len < UMAS_MIN_MSG_SZ:
+                umas_txns[idx] = proc._decodeFpgaMsg(raw_fpga_msg, ingest_ts)
+            else:
+                batch.append(idx)
+        if not batch:
+            return umas_txns
+
+        msgs = [raw_fpga_msgs[idx][0x01] for idx in batch]
+        msg_lens = np.fromiter((len(msg) for msg in msgs), dtype=np.intp, \
+            count=len(msgs))
+        row_sz = int(msg_lens.max())
+        be_msgs = self._pack(msgs, row_sz)
+
+        # the first signature found in a message decides its XBUS type
+        types = np.full(len(msgs), -0x01, dtype=np.intp)
+        for type_idx, (name, signature) in enumerate(self.signatures):
+            found = self._matchSignature(be_msgs, msg_lens, signature) \
+                & (types < 0x00)
+            types[found] = type_idx
+
+        umas_type = next((type_idx for type_idx, (name, _) \
+            in enumerate(self.signatures) if name == 'umas'), None)
+
+        # the UMAS header fields of every message at once
+        umas_msg_szs = be_msgs[:, proc.xbus_umas_msg_sz_offset].tolist()
+        dst_ids = be_msgs[:, 0x0C].tolist()
+        src_ids = be_msgs[:, 0x0D].tolist()
+        payload_szs = (be_msgs[:, proc.xbus_umas_msg_sz_offset] \
+            .astype(np.intp) - proc.xbus_umas_hdr_sz \
+            + proc.xbus_umas_len_field_sz).tolist()
+
+        msg_lens = msg_lens.tolist()
+        be_view = memoryview(be_msgs.tobytes())
+        for row, type_idx in enumerate(types.tolist()):
+            if type_idx < 0x00:
+                continue
+            idx = batch[row]
+            if type_idx != umas_type:
+                umas_txns[idx] = proc._decodeFpgaMsg(raw_fpga_msgs[idx][0x01], \
+                    raw_fpga_msgs[idx][0x00])
+                continue
+
+            offset = row * row_sz
+            umas_txn = {}
+            umas_txn['src_id'] = src_ids[row]
+            umas_txn['dst_id'] = dst_ids[row]
+            umas_txn['payload'] = self._gatherPayload( \
+                be_view[offset:offset + msg_lens[row]], \
+                umas_msg_szs[row], payload_szs[row])
+            umas_txn['ingest_ts'] = raw_fpga_msgs[idx][0x00]
+            umas_txns[idx] = umas_txn
+
+        return umas_txns
@@ -0,0 +1,210 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from time import perf_counter
+import argparse
+import struct
+import sys
+
+from parse_xbus_from_fpga import FpgaMsgProcessor
+from batch_decoder import FpgaBatchDecoder, HAVE_NUMPY
+
+parser = argparse.ArgumentParser(description='Benchmark decoding of raw FPGA messages')
+parser.add_argument('--count', type=int, default=0x4E20, help='The number of messages to decode per run')
+parser.add_argument('--batch_sz', type=int, default=0x40, help='The number of messages per batch when benchmarking batch decoding')
+parser.add_argument('--runs', type=int, default=0x05, help='The number of runs to take the best result from')
+args = parser.parse_args()
+
+# the three part UMAS message from the `_extractUmasTraffic` docstring, as it
+# looks once the FPGA words have been swapped to big endian
+UMAS_SAMPLE = bytes.fromhex(
+    '04 05 00 27 04 26 05 ea 98 08 43 00 0c 0a 5c 06'
+    '1b 00 00 40 08 64 01 00 00 7f d9 d9 06 5a 00 fe'
+    '02 0d 00 00 a2 9b 02 00 00 02 70 a9 00 05 ef de'
+    '04 05 08 27 04 26 04 f8 94 08 0d 00 00 a2 9b 02'
+    '00 00 02 0e 00 0d 0a 03 e4 07 02 0e 08 0c 0a 03'
+    'e4 07 02 00 00 00 08 50 72 6f c8 a4 00 0b 9f bc'
+    '04 55 90 27 04 26 05 bc 86 08 6a 65 63 74 00 43')
+
+# the second part on its own carries no UMAS flag and gets discarded
+OTHER_SAMPLE = UMAS_SAMPLE[0x30:0x60]
+
+
+def to_fpga_words(msg):
+    """
+    Convert a big endian sample back into the little endian words the FPGA
+    sends
+
+    Keyword arguments:
+    msg -- the big endian message
+    """
+
+    return b''.join(struct.pack('<I', struct.unpack_from('>I', msg, idx)[0]) \
+        for idx in range(0x00, len(msg), 0x04))
+
+
+class NullQueue():
+
+    def __init__(self):
+        """
+        Stand-in for xbus_msg_q that only keeps the last transaction
+        """
+        self.last = None
+        self.count = 0x00
+
+    def put(self, umas_txn):
+        self.last = umas_txn
+        self.count += 0x01
+
+
+class LegacyFpgaMsgProcessor(FpgaMsgProcessor):
+    """
+    The decode path as it was before the bulk byteswap and the signature
+    table, kept as a baseline
+    """
+
+    def _matchXbusType(self, raw_fpga_msg):
+        cur_fpga_msg = self._swapFpgaMsg(raw_fpga_msg)
+        return self.xbus_signatures.match_swapped(cur_fpga_msg), cur_fpga_msg
+
+    def _swapFpgaMsg(self, raw_fpga_msg):
+        cur_fpga_msg = b''
+        for idx in range(0x00, len(raw_fpga_msg), self.uint32):
+            cur_fpga_msg += self._fix_endianess( \
+                raw_fpga_msg[idx:idx+self.uint32])
+        return cur_fpga_msg
+
+    def _extractXbusTraffic(self, cur_fpga_msg):
+        return [bytes(txn) for txn in super()._extractXbusTraffic( \
+            bytes(cur_fpga_msg))]
+
+    def _extractUmasTraffic(self, xbus_umas_data):
+        # reuse the current code for the header fields and the single part 
+        # case, only the multi part reassembly differs
+        umas_txn = super()._extractUmasTraffic(xbus_umas_data[:0x01])
+
+        payload_sz = xbus_umas_data[0][self.xbus_umas_msg_sz_offset] \
+            - self.xbus_umas_hdr_sz + self.xbus_umas_len_field_sz
+        if len(xbus_umas_data) == 0x01:
+            return umas_txn
+
+        last_idx = len(xbus_umas_data) - 0x01
+        umas_txn_data = b''
+        for idx, xbus_umas_msg_part in enumerate(xbus_umas_data):
+            if idx == 0x00:
+                umas_txn_data = xbus_umas_msg_part[self.xbus_pay_start_offset \
+                    + self.xbus_umas_hdr_sz:self.xbus_pay_end_offset]
+            elif idx == last_idx:
+                remaining_data_sz = payload_sz - len(umas_txn_data)
+                umas_txn_data += xbus_umas_msg_part[ \
+                    self.xbus_pay_start_offset:self.xbus_pay_start_offset \
+                    + remaining_data_sz]
+            else:
+                umas_txn_data += xbus_umas_msg_part[ \
+                    self.xbus_pay_start_offset:self.xbus_pay_start_offset \
+                    + self.xbus_max_pay_sz]
+
+        umas_txn['payload'] = umas_txn_data
+        return umas_txn
+
+
+def bench(processor, raw_fpga_msg):
+    """
+    Return the best messages/sec seen decoding the same message repeatedly
+
+    Keyword arguments:
+    processor -- the FpgaMsgProcessor to benchmark
+    raw_fpga_msg -- the raw little endian FPGA message to decode
+    """
+
+    xbus_msg_q = NullQueue()
+    best = 0.0
+    for _ in range(args.runs):
+        start = perf_counter()
+        for _ in range(args.count):
+            processor._processFpgaMsg(raw_fpga_msg, xbus_msg_q)
+        best = max(best, args.count / (perf_counter() - start))
+    return best, xbus_msg_q.last
+
+
+def bench_batch(processor, batch):
+    """
+    Return the best messages/sec seen decoding the same batch repeatedly,
+    the number of transactions queued per batch and the last of them
+
+    Keyword arguments:
+    processor -- the FpgaMsgProcessor to benchmark
+    batch -- a list of (ingest_ts, raw FPGA message) tuples
+    """
+
+    xbus_msg_q = NullQueue()
+    batch_count = max(args.count // len(batch), 0x01)
+    best = 0.0
+    for _ in range(args.runs):
+        start = perf_counter()
+        for _ in range(batch_count):
+            processor._processFpgaMsgs(batch, xbus_msg_q)
+        best = max(best, batch_count * len(batch) \
+            / (perf_counter() - start))
+    return best, xbus_msg_q.count // (args.runs * batch_count), \
+        xbus_msg_q.last
+
+
+def main():
+    """
+    Decode each sample with the legacy and current paths and print the
+    messages/sec of both
+    """
+
+    print('{:<8} {:>14} {:>14} {:>8}'.format('sample', 'before msg/s', \
+        'after msg/s', 'speedup'))
+
+    for name, sample in (('umas', UMAS_SAMPLE), ('other', OTHER_SAMPLE)):
+        raw_fpga_msg = to_fpga_words(sample)
+
+        before, before_txn = bench(LegacyFpgaMsgProcessor(), raw_fpga_msg)
+        after, after_txn = bench(FpgaMsgProcessor(), raw_fpga_msg)
+
+        # both paths have to agree before the numbers mean anything
+        if before_txn != after_txn:
+            print('[!] ERROR: decoded output differs for {}'.format(name))
+            sys.exit(0x01)
+
+        print('{:<8} {:>14.0f} {:>14.0f} {:>7.2f}x'.format(name, before, \
+            after, after / before))
+
+    if not HAVE_NUMPY:
+        print('[!] WARNING: NumPy is not installed, skipping batch decoding')
+        return
+
+    # a batch of alternating UMAS and other messages, as a batch recv 
+    # worker or shared memory ring would hand them over
+    batch = [(0.0, to_fpga_words(UMAS_SAMPLE if idx & 0x01 else \
+        OTHER_SAMPLE)) for idx in range(args.batch_sz)]
+
+    processor = FpgaMsgProcessor()
+    before, before_count, before_txn = bench_batch(processor, batch)
+    processor.batch_decoder = FpgaBatchDecoder(processor)
+    after, after_count, after_txn = bench_batch(processor, batch)
+
+    if before_count != after_count or before_txn != after_txn:
+        print('[!] ERROR: decoded output differs for the batch')
+        sys.exit(0x01)
+
+    print('{:<8} {:>14.0f} {:>14.0f} {:>7.2f}x'.format('batch', before, \
+        after, after / before))
+
+
+if __name__ == '__main__':
+    main()
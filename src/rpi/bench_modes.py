@@ -0,0 +1,170 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from time import perf_counter, sleep
+import subprocess
+import threading
+import resource
+import argparse
+import signal
+import socket
+import sys
+import os
+
+from gen_fpga_traffic import UMAS_SAMPLE, to_fpga_words
+
+parser = argparse.ArgumentParser(description='Compare the multiprocess and asyncio pipeline modes at different packet rates')
+parser.add_argument('--lport', type=int, default=0x343B, help='The UDP port the pipeline under test listens on')
+parser.add_argument('--sendinterface', type=str, default='lo', help='The interface the pipeline sends spoofed frames on and that gets sniffed')
+parser.add_argument('--rates', type=str, default='500,1000,2000,5000', help='Comma separated FPGA messages/sec to test')
+parser.add_argument('--duration', type=float, default=5.0, help='Seconds to send traffic for at each rate')
+parser.add_argument('--startup', type=float, default=3.0, help='Seconds to wait for the pipeline to start')
+parser.add_argument('--drain', type=float, default=2.0, help='Seconds to wait for the pipeline to catch up after sending')
+parser.add_argument('--modes', type=str, default='multiprocess,asyncio', help='Comma separated pipeline modes to test')
+parser.add_argument('pipeline_args', nargs=argparse.REMAINDER, help='Extra arguments passed through to parse_xbus_from_fpga.py')
+args = parser.parse_args()
+
+# the pipeline under test, found next to this script so the benchmark can be
+# started from any directory
+PIPELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+    'parse_xbus_from_fpga.py')
+
+# offset of the TCP flags byte in an untagged Ethernet/IPv4/TCP frame
+TCP_FLAGS_OFFSET = 0x2F
+TCP_PSH = 0x08
+
+
+class FrameCounter(threading.Thread):
+
+    def __init__(self, iface):
+        """
+        Count the spoofed Modbus/TCP data segments seen on an interface
+
+        Keyword arguments:
+        iface -- the interface to sniff
+        """
+
+        super().__init__(daemon=True)
+        self.count = 0x00
+        self.running = True
+
+        self.s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, \
+            socket.htons(0x0003))
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 0x2000000)
+        self.s.bind((iface, 0x00))
+        self.s.settimeout(0.2)
+
+    def run(self):
+        while self.running:
+            try:
+                frame, addr = self.s.recvfrom(0x800)
+            except socket.timeout:
+                continue
+
+            # loopback shows every frame twice, only count one copy
+            if addr[2] == socket.PACKET_OUTGOING:
+                continue
+            if len(frame) > TCP_FLAGS_OFFSET \
+              and frame[TCP_FLAGS_OFFSET] & TCP_PSH:
+                self.count += 0x01
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.s.close()
+
+
+def send_paced(rate, duration):
+    """
+    Send the sample FPGA message at a fixed rate and return the number sent
+    and the achieved rate
+
+    Keyword arguments:
+    rate -- FPGA messages/sec
+    duration -- seconds to send for
+    """
+
+    msg = to_fpga_words(UMAS_SAMPLE)
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.connect(('127.0.0.1', args.lport))
+
+    total = int(rate * duration)
+    interval = 1.0 / rate
+    start = perf_counter()
+    next_t = start
+    for _ in range(total):
+        s.send(msg)
+        next_t += interval
+        delay = next_t - perf_counter()
+        if delay > 0.0:
+            sleep(delay)
+
+    elapsed = perf_counter() - start
+    s.close()
+    return total, total / elapsed
+
+
+def run_once(mode, rate):
+    """
+    Run the pipeline in the given mode at one rate and return the results
+
+    Keyword arguments:
+    mode -- the --mode passed to the pipeline
+    rate -- FPGA messages/sec
+    """
+
+    counter = FrameCounter(args.sendinterface)
+    counter.start()
+
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    pipeline_p = subprocess.Popen([sys.executable, PIPELINE_PATH, \
+        '--mode', mode, '--lport', str(args.lport), '--sendinterface', \
+        args.sendinterface] + args.pipeline_args, start_new_session=True, \
+        stdout=subprocess.DEVNULL)
+
+    try:
+        sleep(args.startup)
+        sent, sent_rate = send_paced(rate, args.duration)
+        sleep(args.drain)
+    finally:
+        # CTRL+C the whole process group so every stage exits cleanly and is
+        # reaped, which is what makes its CPU time show up below
+        os.killpg(pipeline_p.pid, signal.SIGINT)
+        pipeline_p.wait()
+        counter.stop()
+
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (after.ru_utime - before.ru_utime) \
+        + (after.ru_stime - before.ru_stime)
+
+    return sent, sent_rate, counter.count, cpu
+
+
+def main():
+    """
+    Run every mode at every rate and print a table of the results
+    """
+
+    print('{:<13} {:>8} {:>9} {:>9} {:>9} {:>9}'.format('mode', 'rate', \
+        'sent/s', 'emitted', 'delivered', 'cpu sec'))
+
+    for rate in [int(rate) for rate in args.rates.split(',')]:
+        for mode in args.modes.split(','):
+            sent, sent_rate, emitted, cpu = run_once(mode, rate)
+            print('{:<13} {:>8} {:>9.0f} {:>9} {:>8.1f}% {:>9.2f}'.format( \
+                mode, rate, sent_rate, emitted, 100.0 * emitted / sent, cpu))
+
+
+if __name__ == '__main__':
+    main()
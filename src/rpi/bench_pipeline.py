@@ -0,0 +1,350 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from multiprocessing import Process, Queue, Event
+from time import monotonic, sleep, time
+from datetime import datetime, timezone
+from array import array
+import subprocess
+import threading
+import tempfile
+import argparse
+import signal
+import socket
+import struct
+import json
+import sys
+import os
+
+from gen_fpga_traffic import FpgaTrafficGenerator, send_paced, DEFAULT_MIX
+from gen_fpga_traffic import UMAS_SEQ_OFFSET
+
+parser = argparse.ArgumentParser(description='Benchmark the whole pipeline with synthetic FPGA traffic written to a local capture sink')
+parser.add_argument('--lport', type=int, default=0x343C, help='The UDP port the pipeline under test listens on')
+parser.add_argument('--rates', type=str, default='1000,2000,5000,10000', help='Comma separated FPGA messages/sec to step through')
+parser.add_argument('--duration', type=float, default=5.0, help='Seconds to send traffic for at each rate')
+parser.add_argument('--startup', type=float, default=3.0, help='Seconds to wait for the pipeline to start')
+parser.add_argument('--drain', type=float, default=2.0, help='Seconds to wait for the pipeline to catch up after sending')
+parser.add_argument('--mix', type=str, default=DEFAULT_MIX, help='Comma separated kind=weight pairs of generated messages')
+parser.add_argument('--seed', type=int, default=0x01, help='The random seed for the generated traffic')
+parser.add_argument('--stats_interval', type=float, default=0.25, help='Seconds between the pipeline stats snapshots used for per-stage rates')
+parser.add_argument('--output', type=str, default='bench_results.json', help='The JSON file the results are written to')
+parser.add_argument('pipeline_args', nargs=argparse.REMAINDER, help='Extra arguments passed through to parse_xbus_from_fpga.py')
+args = parser.parse_args()
+
+# allow `-- --transport shm ...` so pipeline options are not taken as ours
+if args.pipeline_args[:0x01] == ['--']:
+    args.pipeline_args = args.pipeline_args[0x01:]
+
+# the pipeline under test, found next to this script so the benchmark can be
+# started from any directory
+PIPELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+    'parse_xbus_from_fpga.py')
+
+# offsets into an untagged Ethernet/IPv4/TCP frame carrying an MBAP header
+TCP_FLAGS_OFFSET = 0x2F
+TCP_PSH = 0x08
+UMAS_PAY_OFFSET = 0x0E + 0x14 + 0x14 + 0x07
+
+# pipeline stages and the stats counter each one is measured by
+STAGES = (('UdpServer', 'recv', 'datagrams'), \
+    ('FpgaMsgProcessor', 'decode', 'fpga_msgs'), \
+    ('UmasMsgSpoofer', 'emit', 'umas_txns'))
+
+
+def run_sink(path, ready, stop, result_q):
+    """
+    Collect the spoofed frames written by the capture emitter and return the
+    sequence number and arrival time of every UMAS message through result_q
+
+    Keyword arguments:
+    path -- the Unix datagram socket to bind
+    ready -- an Event set once the socket is bound
+    stop -- an Event that ends the capture
+    result_q -- a Queue the (seqs, arrival times, frame count) go to
+    """
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 0x1000000)
+    s.bind(path)
+    s.settimeout(0.2)
+    ready.set()
+
+    seqs = array('I')
+    arrival_ts = array('d')
+    frame_count = 0x00
+
+    try:
+        while not stop.is_set():
+            try:
+                frame = s.recv(0x800)
+            except socket.timeout:
+                continue
+            frame_count += 0x01
+
+            # only the data segments carry a UMAS payload
+            if len(frame) >= UMAS_PAY_OFFSET + UMAS_SEQ_OFFSET + 0x04 \
+              and frame[TCP_FLAGS_OFFSET] & TCP_PSH:
+                seqs.append(struct.unpack_from('>I', frame, \
+                    UMAS_PAY_OFFSET + UMAS_SEQ_OFFSET)[0])
+                arrival_ts.append(monotonic())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        s.close()
+
+    result_q.put((seqs, arrival_ts, frame_count))
+
+
+class StatsPoller(threading.Thread):
+
+    def __init__(self, path, interval):
+        """
+        Read the pipeline's stats file while traffic is being sent
+
+        Keyword arguments:
+        path -- the --stats_file of the pipeline
+        interval -- seconds between reads
+        """
+
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.snapshots = []
+        self.running = True
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def run(self):
+        while self.running:
+            snapshot = self.read()
+            if snapshot is not None and (not self.snapshots \
+              or snapshot['time'] != self.snapshots[-1]['time']):
+                self.snapshots.append(snapshot)
+            sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+def stage_count(snapshot, stage, counter):
+    return sum(row[counter] for row in snapshot[stage])
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * pct / 100.0), \
+        len(sorted_values) - 0x01)]
+
+
+def stage_rates(snapshots, start, end):
+    """
+    Return the messages/sec each stage sustained between the first and last
+    stats snapshot taken while traffic was being sent
+
+    Keyword arguments:
+    snapshots -- the stats snapshots read during the run
+    start -- the wall clock time sending started
+    end -- the wall clock time sending finished
+    """
+
+    window = [snapshot for snapshot in snapshots \
+        if start <= snapshot['time'] <= end]
+    rates = {}
+    for name, stage, counter in STAGES:
+        if len(window) < 0x02:
+            rates[name] = None
+            continue
+        elapsed = window[-1]['time'] - window[0]['time']
+        rates[name] = (stage_count(window[-1], stage, counter) \
+            - stage_count(window[0], stage, counter)) / elapsed
+    return rates
+
+
+def run_step(rate, workdir):
+    """
+    Run the pipeline at one rate and return the results of the step
+
+    Keyword arguments:
+    rate -- FPGA messages/sec
+    workdir -- a scratch directory for the sink socket and stats file
+    """
+
+    sink_path = os.path.join(workdir, 'sink.sock')
+    stats_path = os.path.join(workdir, 'stats.json')
+    for path in (sink_path, stats_path):
+        if os.path.exists(path):
+            os.unlink(path)
+
+    generator = FpgaTrafficGenerator(args.mix, seed=args.seed)
+    msgs = generator.build_many(int(rate * args.duration))
+    umas_seqs = [seq for seq, (msg, is_umas) in enumerate(msgs) if is_umas]
+
+    ready = Event()
+    stop = Event()
+    result_q = Queue()
+    sink_p = Process(target=run_sink, args=(sink_path, ready, stop, \
+        result_q))
+    sink_p.start()
+    ready.wait()
+
+    pipeline_p = subprocess.Popen([sys.executable, PIPELINE_PATH, \
+        '--lport', str(args.lport), '--emitter', 'capture', \
+        '--capture_socket', sink_path, '--stats_file', stats_path, \
+        '--stats_interval', str(args.stats_interval)] + args.pipeline_args, \
+        start_new_session=True, stdout=subprocess.DEVNULL)
+
+    poller = StatsPoller(stats_path, args.stats_interval / 0x02)
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.connect(('127.0.0.1', args.lport))
+
+    try:
+        sleep(args.startup)
+        check_pipeline(pipeline_p, 'before any traffic was sent')
+        poller.start()
+
+        start = time()
+        send_ts = send_paced(s, [msg for msg, is_umas in msgs], rate)
+        end = time()
+
+        sleep(args.drain)
+        poller.stop()
+        check_pipeline(pipeline_p, 'while traffic was being sent')
+    finally:
+        s.close()
+        if poller.is_alive():
+            poller.stop()
+        # CTRL+C the whole process group so every stage exits cleanly, a 
+        # stage left with a backlog in a multiprocessing Queue blocks on 
+        # exit flushing it so those get killed
+        try:
+            os.killpg(pipeline_p.pid, signal.SIGINT)
+            pipeline_p.wait(timeout=0x05)
+        except subprocess.TimeoutExpired:
+            os.killpg(pipeline_p.pid, signal.SIGKILL)
+            pipeline_p.wait()
+        except ProcessLookupError:
+            # every stage already exited
+            pipeline_p.wait()
+        stop.set()
+        seqs, arrival_ts, frame_count = result_q.get()
+        sink_p.join()
+
+    # match every captured UMAS message back to when it was sent
+    latencies = []
+    delivered = set()
+    for seq, arrived in zip(seqs, arrival_ts):
+        if seq < len(send_ts) and seq not in delivered:
+            delivered.add(seq)
+            latencies.append(arrived - send_ts[seq])
+    latencies.sort()
+
+    totals = poller.read() or (poller.snapshots[-1] if poller.snapshots \
+        else None)
+
+    step = {}
+    step['rate'] = rate
+    step['sent'] = len(msgs)
+    step['sent_rate'] = len(msgs) / (send_ts[-1] - send_ts[0]) \
+        if len(msgs) > 0x01 else 0.0
+    step['umas_sent'] = len(umas_seqs)
+    step['umas_delivered'] = len(delivered)
+    step['loss'] = 1.0 - len(delivered) / len(umas_seqs) if umas_seqs \
+        else 0.0
+    step['frames_captured'] = frame_count
+    step['latency_ms'] = {
+        'p50': None if not latencies else percentile(latencies, 50) * 1e3,
+        'p99': None if not latencies else percentile(latencies, 99) * 1e3,
+        'max': None if not latencies else latencies[-1] * 1e3,
+    }
+    step['stage_msgs_per_sec'] = stage_rates(poller.snapshots, start, end)
+    step['stage_totals'] = {name: stage_count(totals, stage, counter) \
+        for name, stage, counter in STAGES} if totals else None
+    step['max_queue_depth'] = {}
+    for snapshot in poller.snapshots:
+        for name, depth in snapshot['queue_depth'].items():
+            step['max_queue_depth'][name] = max(depth, \
+                step['max_queue_depth'].get(name, 0x00))
+
+    return step
+
+
+def check_pipeline(pipeline_p, when):
+    """
+    Exit with an error when the pipeline under test is no longer running, as
+    the results of a step without it would only measure the sink
+
+    Keyword arguments:
+    pipeline_p -- the Popen of the pipeline
+    when -- the point of the step being checked, for the message
+    """
+
+    if pipeline_p.poll() is not None:
+        print('[!] ERROR: parse_xbus_from_fpga.py exited with status {} {}' \
+            .format(pipeline_p.returncode, when))
+        sys.exit(0x01)
+
+
+def fmt(value, spec):
+    return '-' if value is None else format(value, spec)
+
+
+def main():
+    """
+    Step through every rate, print a table of the results and save them as
+    JSON
+    """
+
+    results = {}
+    results['started'] = datetime.now(timezone.utc).isoformat()
+    results['rates'] = [int(rate) for rate in args.rates.split(',')]
+    results['duration'] = args.duration
+    results['mix'] = args.mix
+    results['seed'] = args.seed
+    results['pipeline_args'] = args.pipeline_args
+    results['steps'] = []
+
+    print('{:>7} {:>8} {:>7} {:>9} {:>9} {:>10} {:>10} {:>10}'.format( \
+        'rate', 'sent/s', 'loss', 'p50 ms', 'p99 ms', 'recv/s', 'decode/s', \
+        'emit/s'))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for rate in results['rates']:
+            step = run_step(rate, workdir)
+            results['steps'].append(step)
+
+            stage_rate = step['stage_msgs_per_sec']
+            print('{:>7} {:>8.0f} {:>6.2f}% {:>9} {:>9} {:>10} {:>10} ' \
+                '{:>10}'.format(rate, step['sent_rate'], \
+                    100.0 * step['loss'], \
+                    fmt(step['latency_ms']['p50'], '.2f'), \
+                    fmt(step['latency_ms']['p99'], '.2f'), \
+                    fmt(stage_rate['UdpServer'], '.0f'), \
+                    fmt(stage_rate['FpgaMsgProcessor'], '.0f'), \
+                    fmt(stage_rate['UmasMsgSpoofer'], '.0f')))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=0x02)
+    print('[*] Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from time import monotonic, sleep
+from datetime import datetime, timezone
+import subprocess
+import tempfile
+import argparse
+import signal
+import socket
+import json
+import sys
+import os
+
+from gen_fpga_traffic import FpgaTrafficGenerator
+
+parser = argparse.ArgumentParser(description='Measure how long the pipeline takes to start and how much memory it uses')
+parser.add_argument('--lport', type=int, default=0x343D, help='The UDP port the pipeline under test listens on')
+parser.add_argument('--runs', type=int, default=0x05, help='The number of times to start the pipeline')
+parser.add_argument('--timeout', type=float, default=30.0, help='Seconds to wait for the pipeline to decode its first message')
+parser.add_argument('--settle', type=float, default=1.0, help='Seconds to wait after the first decoded message before measuring memory')
+parser.add_argument('--output', type=str, default='startup_results.json', help='The JSON file the results are written to')
+parser.add_argument('pipeline_args', nargs=argparse.REMAINDER, help='Extra arguments passed through to parse_xbus_from_fpga.py')
+args = parser.parse_args()
+
+# allow `-- --emitter scapy ...` so pipeline options are not taken as ours
+if args.pipeline_args[:0x01] == ['--']:
+    args.pipeline_args = args.pipeline_args[0x01:]
+
+# the pipeline under test, found next to this script so the benchmark can be
+# started from any directory
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PIPELINE_PATH = os.path.join(SCRIPT_DIR, 'parse_xbus_from_fpga.py')
+
+# imports the pipeline module in a fresh interpreter and reports back as JSON
+IMPORT_PROBE = '''
+from time import perf_counter
+import resource
+import json
+import sys
+start = perf_counter()
+import parse_xbus_from_fpga
+print(json.dumps({
+    'import_sec': perf_counter() - start,
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'scapy_loaded': 'scapy' in sys.modules,
+}))
+'''
+
+
+def measure_import():
+    """
+    Return the time and peak RSS of importing parse_xbus_from_fpga in a new
+    interpreter
+    """
+
+    out = subprocess.run([sys.executable, '-c', IMPORT_PROBE], check=True, \
+        stdout=subprocess.PIPE, cwd=SCRIPT_DIR).stdout
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def session_pids(sid):
+    """
+    Return the pids of every process in a session, which is the pipeline
+    and all of its stages
+
+    Keyword arguments:
+    sid -- the session id, the pid of the pipeline's main process
+    """
+
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the fields after the parenthesized command name start with the
+        # state, so the session id is the fourth of them
+        if int(stat.rsplit(')', 0x01)[0x01].split()[0x03]) == sid:
+            pids.append(int(entry))
+    return pids
+
+
+def process_memory(pid):
+    """
+    Return a (rss, pss) tuple in kB for one process, where pss splits the
+    pages shared with the other stages between them
+
+    Keyword arguments:
+    pid -- the process to measure
+    """
+
+    rss = pss = 0x00
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+            for line in f:
+                if line.startswith('Rss:'):
+                    rss = int(line.split()[0x01])
+                elif line.startswith('Pss:'):
+                    pss = int(line.split()[0x01])
+    except OSError:
+        pass
+    return rss, pss
+
+
+def read_stats(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def measure_pipeline(workdir):
+    """
+    Start the pipeline, feed it a UMAS message until the first one is
+    decoded and return the time that took and the memory of every process
+
+    Keyword arguments:
+    workdir -- a scratch directory for the stats file and any output
+    """
+
+    stats_path = os.path.join(workdir, 'stats.json')
+    if os.path.exists(stats_path):
+        os.unlink(stats_path)
+
+    generator = FpgaTrafficGenerator('request=1', seed=0x01)
+    msg = generator.build(0x00)[0x00]
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.connect(('127.0.0.1', args.lport))
+
+    start = monotonic()
+    pipeline_p = subprocess.Popen([sys.executable, PIPELINE_PATH, \
+        '--lport', str(args.lport), '--emitter', 'pcapng', '--pcap_prefix', \
+        os.path.join(workdir, 'umas'), '--stats_file', stats_path, \
+        '--stats_interval', '0.02'] + args.pipeline_args, \
+        start_new_session=True, stdout=subprocess.DEVNULL)
+
+    result = {}
+    result['ready_sec'] = None
+    try:
+        while monotonic() - start < args.timeout:
+            # nothing is listening until the recv workers are up
+            try:
+                s.send(msg)
+            except ConnectionRefusedError:
+                pass
+            stats = read_stats(stats_path)
+            if stats is not None \
+              and sum(row['fpga_msgs'] for row in stats['decode']):
+                result['ready_sec'] = monotonic() - start
+                break
+            sleep(0.01)
+
+        sleep(args.settle)
+        pids = session_pids(pipeline_p.pid)
+        memory = [process_memory(pid) for pid in pids]
+        result['processes'] = len(pids)
+        result['rss_kb'] = sum(rss for rss, _ in memory)
+        result['pss_kb'] = sum(pss for _, pss in memory)
+    finally:
+        s.close()
+        os.killpg(pipeline_p.pid, signal.SIGINT)
+        try:
+            pipeline_p.wait(timeout=0x05)
+        except subprocess.TimeoutExpired:
+            os.killpg(pipeline_p.pid, signal.SIGKILL)
+            pipeline_p.wait()
+
+    return result
+
+
+def median(values):
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    return values[len(values) // 0x02]
+
+
+def fmt(value, spec):
+    return '-' if value is None else format(value, spec)
+
+
+def main():
+    """
+    Start the pipeline --runs times, print a table of the results and save
+    them as JSON
+    """
+
+    results = {}
+    results['started'] = datetime.now(timezone.utc).isoformat()
+    results['pipeline_args'] = args.pipeline_args
+    results['runs'] = []
+
+    print('{:>4} {:>10} {:>10} {:>7} {:>9} {:>9} {:>9} {:>6}'.format('run', \
+        'import s', 'import MB', 'scapy', 'ready s', 'RSS MB', 'PSS MB', \
+        'procs'))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for idx in range(args.runs):
+            run = measure_import()
+            run.update(measure_pipeline(workdir))
+            results['runs'].append(run)
+
+            print('{:>4} {:>10.3f} {:>10.1f} {:>7} {:>9} {:>9.1f} {:>9.1f} ' \
+                '{:>6}'.format(idx, run['import_sec'], \
+                    run['max_rss_kb'] / 1024.0, \
+                    'yes' if run['scapy_loaded'] else 'no', \
+                    fmt(run['ready_sec'], '.3f'), run['rss_kb'] / 1024.0, \
+                    run['pss_kb'] / 1024.0, run['processes']))
+
+    summary = {}
+    for key in ('import_sec', 'max_rss_kb', 'ready_sec', 'rss_kb', 'pss_kb'):
+        summary[key] = median(run[key] for run in results['runs'])
+    results['median'] = summary
+
+    print('{:>4} {:>10} {:>10.1f} {:>7} {:>9} {:>9.1f} {:>9.1f}'.format( \
+        'med', fmt(summary['import_sec'], '.3f'), \
+        summary['max_rss_kb'] / 1024.0, '', \
+        fmt(summary['ready_sec'], '.3f'), summary['rss_kb'] / 1024.0, \
+        summary['pss_kb'] / 1024.0))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=0x02)
+    print('[*] Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
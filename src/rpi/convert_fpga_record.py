@@ -0,0 +1,291 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from multiprocessing import Pool
+from time import perf_counter
+import tempfile
+import argparse
+import random
+import heapq
+import sys
+import os
+
+from fpga_record import FpgaRecordReader, merged_chunks
+from frame_emitter import FrameEmitter, SyntheticFrameBuilder
+from frame_emitter import PCAP_FILE_HDR, PCAP_RECORD_HDR
+import parse_xbus_from_fpga as pipeline
+import dedup_cache
+
+parser = argparse.ArgumentParser(description='Convert raw FPGA datagrams recorded with parse_xbus_from_fpga.py --record into a pcap of the spoofed Modbus/TCP traffic', epilog='Arguments after -- are passed through to the parse_xbus_from_fpga.py decoding and spoofing, such as -- --reassemble --session_mode persistent')
+parser.add_argument('records', nargs='+', help='The .fpgarec files to convert, the files of every recv worker are merged by receive time')
+parser.add_argument('--output', type=str, default='umas.pcap', help='The pcap file to write')
+parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='The number of worker processes converting chunks in parallel')
+parser.add_argument('--chunk_sz', type=int, default=0x800000, help='The number of record bytes per chunk, taken from the records of every file merged by receive time. Each chunk is converted on its own, so flows, request/response pairs and reassembly do not carry across chunks')
+parser.add_argument('--batch_sz', type=int, default=0x100, help='The number of FPGA messages decoded per batch within a chunk')
+parser.add_argument('--seed', type=int, default=0x00, help='The random seed for ports and sequence numbers, chunk N uses SEED + N so the output is repeatable')
+parser.add_argument('--workdir', type=str, default=None, help='The directory the per-chunk pcaps are written to before being merged, a temporary one by default')
+
+# the record files come first, so pipeline options are split off at `--` 
+# rather than left to argparse
+argv = sys.argv[0x01:]
+pipeline_args = []
+if '--' in argv:
+    pipeline_args = argv[argv.index('--') + 0x01:]
+    argv = argv[:argv.index('--')]
+args = parser.parse_args(argv)
+args.pipeline_args = pipeline_args
+
+# the receive time of the record being converted, which the pipeline's
+# timeouts run on instead of the wall clock
+record_ts = 0.0
+
+
+def record_clock():
+    return record_ts
+
+
+class PcapChunkEmitter(FrameEmitter):
+
+    def __init__(self, path, flush_sz=0x100000):
+        """
+        Initialize an emitter writing the frames of one chunk to a pcap file
+
+        Keyword arguments:
+        path -- the pcap file to write
+        flush_sz -- the number of buffered bytes that triggers a write
+        """
+
+        super().__init__()
+        self.builder = SyntheticFrameBuilder()
+        self.scratch = bytearray(0x800)
+        self.flush_sz = flush_sz
+        self.ts = 0.0
+
+        self.f = open(path, 'wb')
+        self.buf = bytearray(PCAP_FILE_HDR)
+
+    def set_timestamp(self, ts):
+        # frames sent on a timeout or at the end of the chunk keep the time
+        # of the last record rather than the time of the conversion
+        if ts:
+            self.ts = ts
+
+    def add_frame(self, *frame_args, **frame_kwargs):
+        """
+        Buffer a frame as a pcap record, see
+        `SyntheticFrameBuilder.build_into` for the arguments
+        """
+
+        frame_len = self.builder.build_into(self.scratch, 0x00, \
+            *frame_args, **frame_kwargs)
+        ts_us = int(self.ts * 1e6)
+        self.buf += PCAP_RECORD_HDR.pack(ts_us // 0xF4240, ts_us % 0xF4240, \
+            frame_len, frame_len)
+        self.buf += self.scratch[:frame_len]
+        self.frames_sent += 0x01
+
+    def flush(self):
+        if len(self.buf) >= self.flush_sz:
+            self.f.write(self.buf)
+            self.buf.clear()
+
+    def close(self):
+        if self.f is not None:
+            self.f.write(self.buf)
+            self.buf.clear()
+            self.f.close()
+            self.f = None
+
+
+def init_worker(pipeline_args):
+    """
+    Configure the pipeline classes in a worker process
+
+    Keyword arguments:
+    pipeline_args -- the extra parse_xbus_from_fpga.py arguments
+    """
+
+    pipeline.args = pipeline.parser.parse_args(pipeline_args)
+
+    # idle flows, unanswered requests, stale partials and the dedup window
+    # all expire on record time, as they would have live
+    pipeline.monotonic = record_clock
+    dedup_cache.monotonic = record_clock
+
+
+def convert_chunk(chunk):
+    """
+    Decode the records of one chunk and write the spoofed frames to its own
+    pcap, returning the chunk's counts
+
+    The records of every file in the chunk are merged by receive time, so
+    the messages of all recv workers are decoded in the order they arrived
+
+    Keyword arguments:
+    chunk -- a (chunk_idx, [(record path, start, end), ...], pcap path)
+             tuple
+    """
+
+    global record_ts
+
+    chunk_idx, spans, pcap_path = chunk
+    random.seed(args.seed + chunk_idx)
+
+    processor = pipeline.FpgaMsgProcessor()
+    batch_decoder = processor._openBatchDecoder()
+    spoofer = pipeline.UmasMsgSpoofer()
+    spoofer.emitter = PcapChunkEmitter(pcap_path)
+
+    result = {'bytes': sum(end - start for _, start, end in spans), \
+        'fpga_msgs': 0x00, 'umas_txns': 0x00}
+    readers = [FpgaRecordReader(path) for path, _, _ in spans]
+    records = heapq.merge(*[reader.records(start, end) for reader, \
+        (_, start, end) in zip(readers, spans)], key=lambda record: record[0])
+
+    try:
+        while True:
+            batch = [record for _, record in zip(range(args.batch_sz), \
+                records)]
+            if not batch:
+                break
+
+            if batch_decoder is not None:
+                umas_txns = batch_decoder.decode(batch)
+            else:
+                umas_txns = []
+                for ingest_ts, raw_fpga_msg in batch:
+                    record_ts = ingest_ts
+                    umas_txns.append(processor._decodeFpgaMsg(raw_fpga_msg, \
+                        ingest_ts))
+
+            for (ingest_ts, _), umas_txn in zip(batch, umas_txns):
+                if not umas_txn or not umas_txn['payload']:
+                    continue
+                record_ts = ingest_ts
+                processor._classifyUmasTxn(umas_txn)
+                spoofer._spoofUmasMsg(umas_txn)
+                spoofer._expireFlows()
+                result['umas_txns'] += 0x01
+
+            result['fpga_msgs'] += len(batch)
+    finally:
+        spoofer.shutdown()
+        for reader in readers:
+            reader.close()
+
+    return result
+
+
+def read_pcap(path):
+    """
+    Yield a (ts_us, record) tuple for every record of a chunk's pcap
+
+    Keyword arguments:
+    path -- the pcap written by PcapChunkEmitter
+    """
+
+    with open(path, 'rb') as f:
+        f.read(len(PCAP_FILE_HDR))
+        while True:
+            hdr = f.read(PCAP_RECORD_HDR.size)
+            if len(hdr) < PCAP_RECORD_HDR.size:
+                break
+            ts_sec, ts_usec, incl_len, _ = PCAP_RECORD_HDR.unpack(hdr)
+            yield ts_sec * 0xF4240 + ts_usec, hdr + f.read(incl_len)
+
+
+def merge_pcaps(paths, output, flush_sz=0x100000):
+    """
+    Merge the chunk pcaps into one in timestamp order and return the number
+    of frames written
+
+    Frames with the same timestamp keep the order of their chunks
+
+    Keyword arguments:
+    paths -- the chunk pcaps in chunk order
+    output -- the pcap file to write
+    flush_sz -- the number of buffered bytes that triggers a write
+    """
+
+    frame_count = 0x00
+    with open(output, 'wb') as f:
+        buf = bytearray(PCAP_FILE_HDR)
+        for _, record in heapq.merge(*[read_pcap(path) for path in paths], \
+                key=lambda record: record[0]):
+            buf += record
+            frame_count += 0x01
+            if len(buf) >= flush_sz:
+                f.write(buf)
+                buf.clear()
+        f.write(buf)
+
+    return frame_count
+
+
+def main():
+    """
+    Split the records into chunks, convert them in a process pool and merge
+    the results into --output
+    """
+
+    start = perf_counter()
+
+    # catch bad pipeline options here, a pool worker failing to start is 
+    # only ever replaced by another one
+    pipeline.parser.parse_args(args.pipeline_args)
+
+    # chunk the records of every recv worker merged by receive time, so 
+    # each chunk sees the traffic of one stretch of time in order
+    readers = [FpgaRecordReader(path) for path in args.records]
+    chunks = merged_chunks(readers, args.chunk_sz)
+    for reader in readers:
+        reader.close()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        chunks = [(chunk_idx, [(args.records[idx], start, end) \
+            for idx, start, end in spans], os.path.join(workdir, \
+                '{:06d}.pcap'.format(chunk_idx))) \
+            for chunk_idx, spans in enumerate(chunks)]
+        print('[*] Converting {} chunks with {} workers'.format(len(chunks), \
+            args.jobs))
+
+        totals = {'bytes': 0x00, 'fpga_msgs': 0x00, 'umas_txns': 0x00}
+        with Pool(args.jobs, initializer=init_worker, \
+                initargs=(args.pipeline_args, )) as pool:
+            for result in pool.imap_unordered(convert_chunk, chunks):
+                for key in totals:
+                    totals[key] += result[key]
+        convert_end = perf_counter()
+
+        frame_count = merge_pcaps([chunk[-0x01] for chunk in chunks], \
+            args.output)
+        end = perf_counter()
+
+    elapsed = end - start
+    print('[*] Wrote {} frames for {} UMAS transactions to {}'.format( \
+        frame_count, totals['umas_txns'], args.output))
+    print('[*] Converted {} FPGA messages ({:.1f} MB) in {:.2f}s, {:.2f}s ' \
+        'of it merging: {:.1f} MB/s, {:.0f} msgs/s'.format( \
+            totals['fpga_msgs'], totals['bytes'] / 1e6, elapsed, \
+            end - convert_end, totals['bytes'] / 1e6 / elapsed, \
+            totals['fpga_msgs'] / elapsed))
+
+
+if __name__ == '__main__':
+    # require python3
+    if sys.version_info[0] != 0x03:
+        print("Python2 is not supported")
+        exit()
+
+    main()
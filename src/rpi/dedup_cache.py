@@ -0,0 +1,145 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+from time import monotonic, time
+import hashlib
+
+# measured size of one cache entry: the key tuple, the entry list and the
+# OrderedDict bookkeeping
+DEDUP_ENTRY_SZ = 0x140
+
+# positions within an entry
+ENTRY_EMITTED = 0x00
+ENTRY_SUPPRESSED = 0x01
+ENTRY_FNC = 0x02
+ENTRY_PAYLOAD_LEN = 0x03
+
+
+class UmasDedupCache():
+
+    def __init__(self, window, max_bytes=0x400000, summary_interval=10.0):
+        """
+        Initialize a cache that suppresses UMAS transactions repeating one
+        already spoofed within the last `window` seconds
+
+        Transactions are keyed on (src_id, dst_id, payload digest), the
+        digest being a 128-bit BLAKE2b so distinct payloads never collide in
+        practice while every key stays the same small size. The first
+        one is let through and every identical one within the window after
+        it is suppressed and counted, after which the next one is let
+        through again so Snort still sees the polling now and then. Least
+        recently seen entries are evicted to stay within `max_bytes`
+
+        Keyword arguments:
+        window -- seconds during which repeats of a transaction are
+                  suppressed
+        max_bytes -- the memory the cache entries may take up
+        summary_interval -- seconds between summaries of what was
+                            suppressed
+        """
+
+        self.window = window
+        self.max_entries = max(max_bytes // DEDUP_ENTRY_SZ, 0x01)
+        self.summary_interval = summary_interval
+
+        # ordered least recently seen first
+        self.entries = OrderedDict()
+
+        self.suppressed_count = 0x00
+        self.evicted_count = 0x00
+
+        # suppressed repeats of entries evicted since the last summary,
+        # which can only be reported in aggregate
+        self.evicted_suppressed = 0x00
+        self.last_summary = monotonic()
+
+    def suppress(self, umas_txn, now=None):
+        """
+        Return whether a transaction repeats one spoofed within the window,
+        counting it if so
+
+        Keyword arguments:
+        umas_txn -- a dict holding the src_id, dst_id and payload
+        now -- the current monotonic time
+        """
+
+        if now is None:
+            now = monotonic()
+
+        payload = umas_txn['payload']
+        key = (umas_txn['src_id'], umas_txn['dst_id'], \
+            hashlib.blake2b(payload, digest_size=0x10).digest())
+        entry = self.entries.get(key)
+
+        if entry is not None:
+            self.entries.move_to_end(key)
+            if now - entry[ENTRY_EMITTED] < self.window:
+                entry[ENTRY_SUPPRESSED] += 0x01
+                self.suppressed_count += 0x01
+                return True
+            entry[ENTRY_EMITTED] = now
+            return False
+
+        fnc = payload[2] if len(payload) > 0x02 else None
+        self.entries[key] = [now, 0x00, fnc, len(payload)]
+        if len(self.entries) > self.max_entries:
+            evicted = self.entries.popitem(last=False)[1]
+            self.evicted_suppressed += evicted[ENTRY_SUPPRESSED]
+            self.evicted_count += 0x01
+        return False
+
+    def summary(self, now=None, force=False):
+        """
+        Return a dict recording how often each transaction was suppressed
+        since the last summary, or None when the summary interval has not
+        passed yet or nothing was suppressed
+
+        Keyword arguments:
+        now -- the current monotonic time
+        force -- summarize regardless of the summary interval
+        """
+
+        if now is None:
+            now = monotonic()
+        if not force and now - self.last_summary < self.summary_interval:
+            return None
+
+        interval = now - self.last_summary
+        self.last_summary = now
+
+        repeats = []
+        for (src_id, dst_id, _), entry in self.entries.items():
+            if entry[ENTRY_SUPPRESSED]:
+                repeats.append({'src_id': src_id, 'dst_id': dst_id, \
+                    'fnc': entry[ENTRY_FNC], \
+                    'payload_len': entry[ENTRY_PAYLOAD_LEN], \
+                    'suppressed': entry[ENTRY_SUPPRESSED]})
+                entry[ENTRY_SUPPRESSED] = 0x00
+
+        evicted_suppressed = self.evicted_suppressed
+        self.evicted_suppressed = 0x00
+        if not repeats and not evicted_suppressed:
+            return None
+
+        record = {}
+        record['time'] = time()
+        record['interval'] = interval
+        record['window'] = self.window
+        record['suppressed'] = sum(repeat['suppressed'] for repeat in repeats) \
+            + evicted_suppressed
+        record['evicted_suppressed'] = evicted_suppressed
+        record['repeats'] = sorted(repeats, \
+            key=lambda repeat: repeat['suppressed'], reverse=True)
+        return record
@@ -0,0 +1,268 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from time import time
+import struct
+import heapq
+import mmap
+import os
+
+# file header: magic, format version and the size of each record header
+FILE_MAGIC = b'BBFR'
+FILE_VERSION = 0x01
+FILE_HDR = struct.Struct('<4sHH')
+
+# record header: receive time and datagram length, followed by the datagram
+RECORD_HDR = struct.Struct('<dH')
+
+RECORD_SUFFIX = '.fpgarec'
+
+
+class FpgaRecordWriter():
+
+    def __init__(self, prefix, worker_idx=0x00, max_bytes=0x4000000, \
+            max_files=0x00, flush_sz=0x40000, flush_interval=1.0):
+        """
+        Initialize a writer appending raw FPGA datagrams to rotating record
+        files
+
+        Each recv worker records to its own series of files named
+        <prefix>.<worker>.<seq>.fpgarec. Records are gathered in memory and
+        written out in bulk once `flush_sz` bytes are waiting or
+        `flush_interval` seconds have passed. The time is only checked as
+        records come in, so an idle worker has to call `expire` for its
+        last records to be written
+
+        Keyword arguments:
+        prefix -- the path prefix of the record files
+        worker_idx -- the index of the recv worker writing the files
+        max_bytes -- the size after which a new file is started
+        max_files -- the number of files to keep, 0 to keep them all
+        flush_sz -- the number of buffered bytes that triggers a write
+        flush_interval -- the maximum seconds records stay buffered
+        """
+
+        self.prefix = prefix
+        self.worker_idx = worker_idx
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.flush_sz = flush_sz
+        self.flush_interval = flush_interval
+
+        self.buf = bytearray()
+        self.last_flush_ts = 0.0
+        self.file_seq = 0x00
+        self.paths = []
+        self.f = None
+        self.file_sz = 0x00
+
+        self._rotate()
+
+    def _rotate(self):
+        """
+        Close the current file, start the next one and remove the oldest if
+        there are more than `max_files`
+        """
+
+        if self.f is not None:
+            self.f.close()
+
+        path = '{}.{:02d}.{:05d}{}'.format(self.prefix, self.worker_idx, \
+            self.file_seq, RECORD_SUFFIX)
+        self.file_seq += 0x01
+
+        self.f = open(path, 'wb', buffering=0x00)
+        self.f.write(FILE_HDR.pack(FILE_MAGIC, FILE_VERSION, RECORD_HDR.size))
+        self.file_sz = FILE_HDR.size
+        self.paths.append(path)
+
+        while self.max_files and len(self.paths) > self.max_files:
+            os.unlink(self.paths.pop(0x00))
+
+    def write(self, ts, msg):
+        """
+        Buffer one datagram
+
+        Keyword arguments:
+        ts -- the time the datagram was received
+        msg -- the raw datagram
+        """
+
+        self.buf += RECORD_HDR.pack(ts, len(msg))
+        self.buf += msg
+
+        # also write out early so files stay close to `max_bytes`
+        if len(self.buf) >= self.flush_sz \
+          or self.file_sz + len(self.buf) >= self.max_bytes \
+          or ts - self.last_flush_ts >= self.flush_interval:
+            self.flush(ts)
+
+    def expire(self, now=None):
+        """
+        Write out the buffered records once they have waited for
+        `flush_interval`, so they reach the file even when traffic stops
+
+        Keyword arguments:
+        now -- the current time
+        """
+
+        if now is None:
+            now = time()
+        if self.buf and now - self.last_flush_ts >= self.flush_interval:
+            self.flush(now)
+
+    def flush(self, ts=None):
+        """
+        Write out every buffered record with a single write
+
+        Keyword arguments:
+        ts -- the current time, used to schedule the next timed flush
+        """
+
+        if ts is not None:
+            self.last_flush_ts = ts
+        if not self.buf:
+            return
+
+        # rotate before writing so a full file does not leave an empty one
+        # behind on close
+        if self.file_sz >= self.max_bytes:
+            self._rotate()
+
+        self.f.write(self.buf)
+        self.file_sz += len(self.buf)
+        self.buf.clear()
+
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+            self.f = None
+
+
+class FpgaRecordReader():
+
+    def __init__(self, path):
+        """
+        Initialize a reader for a single record file, mapped into memory so
+        large captures do not have to be read up front
+
+        Keyword arguments:
+        path -- the record file
+        """
+
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0x00, access=mmap.ACCESS_READ)
+
+        if len(self.mm) < FILE_HDR.size:
+            raise ValueError('{} is too short to be a record file' \
+                .format(path))
+        magic, version, record_hdr_sz = FILE_HDR.unpack_from(self.mm)
+        if magic != FILE_MAGIC or version != FILE_VERSION \
+          or record_hdr_sz != RECORD_HDR.size:
+            raise ValueError('{} is not a version {} record file' \
+                .format(path, FILE_VERSION))
+
+    def __iter__(self):
+        """
+        Yield a (ts, datagram) tuple per record, stopping at a record cut
+        short by an unclean shutdown
+        """
+
+        return self.records()
+
+    def records(self, start=None, end=None):
+        """
+        Yield a (ts, datagram) tuple per record between two record
+        boundaries, stopping at a record cut short by an unclean shutdown
+
+        Keyword arguments:
+        start -- the offset of the first record, the first in the file by
+                 default
+        end -- the offset to stop at, the end of the file by default
+        """
+
+        mm = self.mm
+        mm_len = len(mm) if end is None else min(end, len(mm))
+        offset = FILE_HDR.size if start is None else start
+
+        while offset + RECORD_HDR.size <= mm_len:
+            ts, msg_len = RECORD_HDR.unpack_from(mm, offset)
+            offset += RECORD_HDR.size
+            if offset + msg_len > mm_len:
+                break
+            yield ts, mm[offset:offset + msg_len]
+            offset += msg_len
+
+    def spans(self):
+        """
+        Yield a (ts, start, end) tuple per record with the offsets of the
+        record, stopping at a record cut short by an unclean shutdown
+
+        Only the record headers are read, hopping from one to the next
+        """
+
+        mm = self.mm
+        mm_len = len(mm)
+        unpack_from = RECORD_HDR.unpack_from
+        hdr_sz = RECORD_HDR.size
+
+        offset = FILE_HDR.size
+        while offset + hdr_sz <= mm_len:
+            ts, msg_len = unpack_from(mm, offset)
+            if offset + hdr_sz + msg_len > mm_len:
+                break
+            yield ts, offset, offset + hdr_sz + msg_len
+            offset += hdr_sz + msg_len
+
+    def close(self):
+        self.mm.close()
+
+
+def merged_chunks(readers, chunk_sz):
+    """
+    Return chunks of at least `chunk_sz` record bytes taken from the records
+    of every file merged by receive time, each chunk a list with a
+    (reader index, start, end) tuple per file that has records in it
+
+    Every recv worker records to its own files in receive order, so a
+    chunk covers one stretch of time across all of them and the records of
+    a file within it are contiguous
+
+    Keyword arguments:
+    readers -- the FpgaRecordReaders of the files
+    chunk_sz -- the number of bytes per chunk
+    """
+
+    def tagged(idx, reader):
+        for ts, start, end in reader.spans():
+            yield ts, idx, start, end
+
+    chunks = []
+    spans = {}
+    chunk_bytes = 0x00
+    for _, idx, start, end in heapq.merge(*[tagged(idx, reader) \
+            for idx, reader in enumerate(readers)]):
+        spans[idx] = (spans[idx][0x00], end) if idx in spans \
+            else (start, end)
+        chunk_bytes += end - start
+        if chunk_bytes >= chunk_sz:
+            chunks.append([(idx, ) + span for idx, span in spans.items()])
+            spans = {}
+            chunk_bytes = 0x00
+
+    if spans:
+        chunks.append([(idx, ) + span for idx, span in spans.items()])
+    return chunks
@@ -0,0 +1,789 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import deque
+from array import array
+from time import time, monotonic
+import socket
+import select
+import struct
+import errno
+import mmap
+import stat
+import sys
+import os
+
+# TCP flag values used by the synthetic sessions
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_PSH = 0x08
+TCP_ACK = 0x10
+
+# linux packet socket values that the socket module does not export
+SOL_PACKET = 0x0107
+PACKET_VERSION = 0x0A
+PACKET_TX_RING = 0x0D
+TPACKET_V2 = 0x01
+TP_STATUS_AVAILABLE = 0x00
+TP_STATUS_SEND_REQUEST = 0x01
+TP_STATUS_WRONG_FORMAT = 0x04
+ETH_P_ALL = 0x0003
+
+# pcapng block types and values
+PCAPNG_SHB_TYPE = 0x0A0D0D0A
+PCAPNG_IDB_TYPE = 0x00000001
+PCAPNG_EPB_TYPE = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+LINKTYPE_ETHERNET = 0x0001
+
+# classic pcap file header values
+PCAP_MAGIC = 0xA1B2C3D4
+PCAP_SNAPLEN = 0xFFFF
+
+# classic pcap file header and the header in front of every record
+PCAP_FILE_HDR = struct.pack('<IHHiIII', PCAP_MAGIC, 0x02, 0x04, 0x00, 0x00, \
+    PCAP_SNAPLEN, LINKTYPE_ETHERNET)
+PCAP_RECORD_HDR = struct.Struct('<IIII')
+
+
+def _csum_fold(csum):
+    """
+    Fold a running one's complement sum down to 16 bits
+
+    Keyword arguments:
+    csum -- the running sum
+    """
+
+    while csum >> 0x10:
+        csum = (csum & 0xFFFF) + (csum >> 0x10)
+    return csum
+
+
+def _csum_add(data):
+    """
+    Return the one's complement sum of the big endian 16-bit words in data
+
+    The words are summed with `array('H')` in native order and the folded
+    result is swapped back afterwards, which gives the same checksum
+
+    Keyword arguments:
+    data -- a bytes-like object to sum
+    """
+
+    words = array('H')
+    if len(data) & 0x01:
+        data = bytes(data) + b'\x00'
+    words.frombytes(data)
+    csum = _csum_fold(sum(words))
+    if sys.byteorder == 'little':
+        csum = ((csum & 0xFF) << 0x08) | (csum >> 0x08)
+    return csum
+
+
+class SyntheticFrameBuilder():
+
+    def __init__(self, source_id=0x00):
+        """
+        Initialize the precomputed header templates for every module ID
+
+        Each module ID maps to DE:AD:BE:EF:{source}:{id} and
+        192.168.{source}.{id}, so the backplanes behind several FPGAs never
+        share an address. The Ethernet and IP headers for a module pair only
+        change in the IP total length and checksum, so those are patched in
+        place per frame
+
+        Keyword arguments:
+        source_id -- the FPGA source, 0 for the first or only one
+        """
+
+        self.eth_hdr_sz = 0x0E
+        self.ip_hdr_sz = 0x14
+        self.tcp_hdr_sz = 0x14
+        self.mbap_len = 0x07
+        self.hdr_sz = self.eth_hdr_sz + self.ip_hdr_sz + self.tcp_hdr_sz
+
+        # values matching the scapy defaults the spoofer used before
+        self.ip_id = 0x01
+        self.ip_ttl = 0x40
+        self.tcp_window = 0x2000
+        self.modbus_unit_id = 0xFF
+
+        self.mac = [bytes.fromhex('DEADBEEF{:02x}{:02x}'.format(source_id, \
+            module_id)) for module_id in range(0x100)]
+        self.ip = [bytes((0xC0, 0xA8, source_id, module_id)) \
+            for module_id in range(0x100)]
+
+        # Ethernet/IP header templates and checksum seeds per module pair,
+        # filled in on first use from the per module values above
+        self.templates = {}
+
+        self.tcp_hdr = struct.Struct('!HHIIBBHHH')
+        self.mbap_hdr = struct.Struct('!HHHB')
+
+    def _template(self, src_id, dst_id):
+        """
+        Return the header template for a module pair, building it on first use
+
+        The template holds the Ethernet/IP header bytes with a zeroed total
+        length and checksum, the partial IP checksum and the partial TCP
+        pseudo header checksum
+
+        Keyword arguments:
+        src_id -- sending module identifier byte
+        dst_id -- receiving module identifier byte
+        """
+
+        template = self.templates.get((src_id, dst_id))
+        if template is None:
+            hdr = bytearray(self.mac[dst_id] + self.mac[src_id] \
+                + b'\x08\x00' + struct.pack('!BBHHHBBH', 0x45, 0x00, 0x00, \
+                    self.ip_id, 0x00, self.ip_ttl, socket.IPPROTO_TCP, 0x00) \
+                + self.ip[src_id] + self.ip[dst_id])
+            ip_csum = _csum_add(hdr[self.eth_hdr_sz:])
+            pseudo_csum = _csum_add(self.ip[src_id] + self.ip[dst_id] \
+                + struct.pack('!BB', 0x00, socket.IPPROTO_TCP))
+            template = (bytes(hdr), ip_csum, pseudo_csum)
+            self.templates[(src_id, dst_id)] = template
+
+        return template
+
+    def build_into(self, buf, offset, src_id, dst_id, sport, dport, seq, ack, \
+            flags, trans_id=None, payload=b''):
+        """
+        Write a complete Ethernet/IP/TCP frame into buf and return its size
+
+        When trans_id is set the payload is wrapped in a Modbus/TCP MBAP
+        header the same way ModbusADURequest did
+
+        Keyword arguments:
+        buf -- a writable buffer big enough for the frame
+        offset -- where in buf to write the frame
+        src_id -- sending module identifier byte
+        dst_id -- receiving module identifier byte
+        sport -- TCP source port
+        dport -- TCP destination port
+        seq -- TCP sequence number
+        ack -- TCP acknowledgement number
+        flags -- TCP flags
+        trans_id -- Modbus transaction ID, None for a bare TCP segment
+        payload -- UMAS message carried in the Modbus ADU
+        """
+
+        hdr, ip_csum, pseudo_csum = self._template(src_id, dst_id)
+
+        tcp_len = self.tcp_hdr_sz + len(payload)
+        if trans_id is not None:
+            tcp_len += self.mbap_len
+        ip_len = self.ip_hdr_sz + tcp_len
+
+        # Ethernet/IP header from the template with the length and checksum
+        # patched in
+        ip_offset = offset + self.eth_hdr_sz
+        buf[offset:ip_offset + self.ip_hdr_sz] = hdr
+        struct.pack_into('!H', buf, ip_offset + 0x02, ip_len)
+        struct.pack_into('!H', buf, ip_offset + 0x0A, \
+            ~_csum_fold(ip_csum + ip_len) & 0xFFFF)
+
+        # TCP header, MBAP header and payload
+        tcp_offset = ip_offset + self.ip_hdr_sz
+        self.tcp_hdr.pack_into(buf, tcp_offset, sport, dport, seq, ack, \
+            0x50, flags, self.tcp_window, 0x00, 0x00)
+        data_offset = tcp_offset + self.tcp_hdr_sz
+        if trans_id is not None:
+            self.mbap_hdr.pack_into(buf, data_offset, trans_id, 0x00, \
+                len(payload) + 0x01, self.modbus_unit_id)
+            data_offset += self.mbap_len
+        buf[data_offset:data_offset + len(payload)] = payload
+
+        # TCP checksum over the pseudo header and the whole segment
+        tcp_csum = _csum_add(memoryview(buf)[tcp_offset:tcp_offset + tcp_len])
+        struct.pack_into('!H', buf, tcp_offset + 0x10, \
+            ~_csum_fold(pseudo_csum + tcp_len + tcp_csum) & 0xFFFF)
+
+        return self.eth_hdr_sz + ip_len
+
+
+class FrameEmitter():
+    """
+    The interface every output sink of the UmasMsgSpoofer implements
+
+    Frames are queued with `add_frame`, which takes the same arguments as
+    `SyntheticFrameBuilder.build_into` minus the buffer and offset, and are
+    sent by `flush` at the latest. Sinks that keep frames instead of sending
+    them stamp them with the time set by `set_timestamp`
+    """
+
+    # sinks that hold frames back between flushes need `flush` called
+    # regularly even when no traffic arrives
+    holds_frames = False
+
+    def __init__(self):
+        # running totals read by the pipeline metrics
+        self.frames_sent = 0x00
+        self.dropped_frames = 0x00
+        self.dropped_bytes = 0x00
+
+        # bytes waiting on a slow consumer, read by the pipeline metrics
+        self.buffered_bytes = 0x00
+
+        # time the frames being added belong to, None for the current time
+        self.ts = None
+        self.last_ts_us = 0x00
+
+    def set_timestamp(self, ts):
+        """
+        Set the time recorded for the frames added from now on
+
+        Keyword arguments:
+        ts -- the time the FPGA message behind the frames was received, or
+              None for the current time
+        """
+
+        self.ts = ts or None
+
+    def _stamp_us(self):
+        """
+        Return the timestamp of the next frame in microseconds
+
+        Flow setup and teardown frames are stamped with the current time
+        while data frames carry the earlier time their FPGA message was
+        received, so the timestamp is held at the previous frame's rather
+        than ever going backwards in the capture
+        """
+
+        ts_us = max(int((self.ts or time()) * 1e6), self.last_ts_us)
+        self.last_ts_us = ts_us
+        return ts_us
+
+    def add_frame(self, *frame_args, **frame_kwargs):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class RawSocketEmitter(FrameEmitter):
+
+    def __init__(self, iface, frame_count=0x80, source_id=0x00):
+        """
+        Initialize a persistent AF_PACKET socket on the send interface
+
+        Frames are written straight into a PACKET_TX_RING shared with the
+        kernel and a whole burst goes out with a single send call. If the
+        ring cannot be set up every frame is sent on its own over the same
+        socket instead
+
+        Keyword arguments:
+        iface -- the interface on which to send the frames
+        frame_count -- the number of frames in the TX ring
+        source_id -- the FPGA source the synthetic addresses belong to
+        """
+
+        super().__init__()
+        self.builder = SyntheticFrameBuilder(source_id)
+
+        # each ring frame holds a tpacket2_hdr followed by the frame data
+        self.ring_frame_sz = 0x800
+        self.ring_block_sz = mmap.PAGESIZE if mmap.PAGESIZE >= 0x1000 \
+            else 0x1000
+        self.ring_data_offset = 0x20
+        self.frame_count = frame_count
+        self.frame_idx = 0x00
+        self.pending = 0x00
+
+        # status checks before a wait for a ring slot falls back to poll, 
+        # and how long each poll may sleep in case a wakeup is missed
+        self.slot_spin_count = 0x40
+        self.slot_poll_timeout_ms = 0x0A
+
+        self.s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, \
+            socket.htons(ETH_P_ALL))
+        self.s.bind((iface, 0x00))
+
+        try:
+            self.ring = self._map_tx_ring()
+            self.poller = select.poll()
+            self.poller.register(self.s, select.POLLOUT)
+        except OSError as e:
+            print('[!] WARNING: PACKET_TX_RING unavailable, sending frames ' \
+                'one at a time: {}'.format(e))
+            self.ring = None
+            self.scratch = bytearray(self.ring_frame_sz)
+            self.frames = []
+
+    def _map_tx_ring(self):
+        """
+        Configure and map the TX ring for the packet socket
+        """
+
+        frames_per_block = self.ring_block_sz // self.ring_frame_sz
+        block_count = self.frame_count // frames_per_block
+        self.frame_count = block_count * frames_per_block
+
+        self.s.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V2)
+        self.s.setsockopt(SOL_PACKET, PACKET_TX_RING, struct.pack('IIII', \
+            self.ring_block_sz, block_count, self.ring_frame_sz, \
+            self.frame_count))
+
+        return mmap.mmap(self.s.fileno(), \
+            self.ring_block_sz * block_count, \
+            mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+    def _wait_slot(self, slot):
+        """
+        Wait for the kernel to hand a TX ring slot back
+
+        A short spin covers a burst that is still going out. After that the
+        socket is polled for POLLOUT, which the kernel reports once the
+        frame at the head of its ring is free again, rather than burning
+        the CPU the spoofer shares with the kernel's transmit path
+
+        Keyword arguments:
+        slot -- the offset of the slot in the ring
+        """
+
+        spin_count = 0x00
+        while True:
+            status = struct.unpack_from('I', self.ring, slot)[0]
+            if status == TP_STATUS_AVAILABLE:
+                return
+            if status & TP_STATUS_WRONG_FORMAT:
+                raise OSError('kernel rejected a frame in the TX ring')
+
+            if spin_count < self.slot_spin_count:
+                spin_count += 0x01
+            else:
+                self.poller.poll(self.slot_poll_timeout_ms)
+
+    def add_frame(self, *frame_args, **frame_kwargs):
+        """
+        Queue a frame for the next flush, see `SyntheticFrameBuilder.build_into`
+        for the arguments
+        """
+
+        if self.ring is None:
+            frame_len = self.builder.build_into(self.scratch, 0x00, \
+                *frame_args, **frame_kwargs)
+            self.frames.append(bytes(self.scratch[:frame_len]))
+            self.frames_sent += 0x01
+            return
+
+        self.frames_sent += 0x01
+        slot = self.frame_idx * self.ring_frame_sz
+
+        # wait for the kernel to hand the slot back, flushing first in case
+        # it is one of ours that has not gone out yet
+        if struct.unpack_from('I', self.ring, slot)[0] != TP_STATUS_AVAILABLE:
+            self.flush()
+            self._wait_slot(slot)
+
+        frame_len = self.builder.build_into(self.ring, \
+            slot + self.ring_data_offset, *frame_args, **frame_kwargs)
+
+        # tp_len and tp_snaplen, then mark the slot ready to send
+        struct.pack_into('II', self.ring, slot + 0x04, frame_len, frame_len)
+        struct.pack_into('I', self.ring, slot, TP_STATUS_SEND_REQUEST)
+
+        self.frame_idx = (self.frame_idx + 0x01) % self.frame_count
+        self.pending += 0x01
+
+    def flush(self):
+        """
+        Send every queued frame
+        """
+
+        if self.ring is None:
+            for frame in self.frames:
+                self.s.send(frame)
+            self.frames = []
+            return
+
+        if self.pending:
+            # a zero length send kicks the kernel to transmit all slots
+            # marked TP_STATUS_SEND_REQUEST
+            self.s.send(b'')
+            self.pending = 0x00
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+        self.s.close()
+
+
+class CaptureSocketEmitter(FrameEmitter):
+
+    def __init__(self, path, source_id=0x00):
+        """
+        Initialize an emitter that writes every frame as one datagram to a
+        local Unix socket instead of an interface
+
+        This lets a capture sink such as bench_pipeline.py collect the
+        spoofed traffic without root or a spare interface
+
+        Keyword arguments:
+        path -- the path of the Unix datagram socket to write to
+        source_id -- the FPGA source the synthetic addresses belong to
+        """
+
+        super().__init__()
+        self.builder = SyntheticFrameBuilder(source_id)
+        self.scratch = bytearray(0x800)
+        self.scratch_view = memoryview(self.scratch)
+
+        self.s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.s.connect(path)
+
+    def add_frame(self, *frame_args, **frame_kwargs):
+        """
+        Write a frame to the socket right away, see
+        `SyntheticFrameBuilder.build_into` for the arguments
+        """
+
+        frame_len = self.builder.build_into(self.scratch, 0x00, \
+            *frame_args, **frame_kwargs)
+        self.s.send(self.scratch_view[:frame_len])
+        self.frames_sent += 0x01
+
+    def close(self):
+        self.scratch_view.release()
+        self.s.close()
+
+
+class PcapngEmitter(FrameEmitter):
+
+    holds_frames = True
+
+    def __init__(self, prefix, max_bytes=0x4000000, rotate_secs=60.0, \
+            flush_sz=0x40000, flush_interval=1.0, source_id=0x00):
+        """
+        Initialize an emitter that writes frames to rotating pcapng files
+        for Snort to read offline with -r or from a watched directory
+
+        Frames are stamped with the time set by `set_timestamp`, which the
+        spoofer sets to when the FPGA message was received. They are kept
+        in memory and written in bulk once `flush_sz` bytes are waiting or
+        on the first flush after `flush_interval` seconds
+
+        Each file is written as <prefix>.<seq>.pcapng.part and renamed to
+        <prefix>.<seq>.pcapng once complete, so a directory watcher never
+        picks up a file that is still being written
+
+        Keyword arguments:
+        prefix -- the path prefix of the pcapng files
+        max_bytes -- the size after which a new file is started
+        rotate_secs -- the age after which a new file is started, 0 to only
+                       rotate by size
+        flush_sz -- the number of buffered bytes that triggers a write
+        flush_interval -- the maximum seconds frames stay buffered while
+                          the spoofer keeps flushing
+        source_id -- the FPGA source the synthetic addresses belong to
+        """
+
+        super().__init__()
+        self.builder = SyntheticFrameBuilder(source_id)
+        self.scratch = bytearray(0x800)
+
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.rotate_secs = rotate_secs
+        self.flush_sz = flush_sz
+        self.flush_interval = flush_interval
+
+        self.epb_hdr = struct.Struct('<IIIIIII')
+        self.epb_trailer = struct.Struct('<I')
+
+        self.buf = bytearray()
+        self.last_write = time()
+        self.file_seq = 0x00
+        self.f = None
+        self.path = None
+        self.file_sz = 0x00
+        self.file_opened = 0.0
+
+        self._rotate()
+
+    def _rotate(self):
+        """
+        Complete the current file and start the next one with a fresh
+        section and interface header
+        """
+
+        self._finish()
+
+        self.path = '{}.{:05d}.pcapng'.format(self.prefix, self.file_seq)
+        self.file_seq += 0x01
+
+        # section header block, no options and an unspecified length
+        shb = struct.pack('<IIIHHqI', PCAPNG_SHB_TYPE, 0x1C, \
+            PCAPNG_BYTE_ORDER_MAGIC, 0x01, 0x00, -0x01, 0x1C)
+
+        # interface description block, microsecond timestamps are the default
+        idb = struct.pack('<IIHHII', PCAPNG_IDB_TYPE, 0x14, \
+            LINKTYPE_ETHERNET, 0x00, 0x00, 0x14)
+
+        self.f = open(self.path + '.part', 'wb', buffering=0x00)
+        self.f.write(shb + idb)
+        self.file_sz = len(shb) + len(idb)
+        self.file_opened = time()
+
+    def _finish(self):
+        if self.f is None:
+            return
+        self.f.close()
+        self.f = None
+        os.replace(self.path + '.part', self.path)
+
+    def add_frame(self, *frame_args, **frame_kwargs):
+        """
+        Buffer a frame as an enhanced packet block, see
+        `SyntheticFrameBuilder.build_into` for the arguments
+        """
+
+        frame_len = self.builder.build_into(self.scratch, 0x00, \
+            *frame_args, **frame_kwargs)
+        pad_len = -frame_len & 0x03
+        block_len = self.epb_hdr.size + frame_len + pad_len \
+            + self.epb_trailer.size
+
+        ts_us = self._stamp_us()
+        self.buf += self.epb_hdr.pack(PCAPNG_EPB_TYPE, block_len, 0x00, \
+            ts_us >> 0x20, ts_us & 0xFFFFFFFF, frame_len, frame_len)
+        self.buf += self.scratch[:frame_len]
+        self.buf += bytes(pad_len)
+        self.buf += self.epb_trailer.pack(block_len)
+        self.frames_sent += 0x01
+
+        # also write out early so files stay close to `max_bytes`
+        if len(self.buf) >= self.flush_sz \
+          or self.file_sz + len(self.buf) >= self.max_bytes:
+            self._write()
+
+    def _write(self):
+        """
+        Write out the buffered blocks with a single write, rotating first if
+        the current file is full or too old
+        """
+
+        now = time()
+        self.last_write = now
+        if not self.buf:
+            return
+
+        if self.file_sz >= self.max_bytes or (self.rotate_secs \
+          and now - self.file_opened >= self.rotate_secs):
+            self._rotate()
+
+        self.f.write(self.buf)
+        self.file_sz += len(self.buf)
+        self.buf.clear()
+
+    def flush(self):
+        # the spoofer flushes after every message, only actually write once
+        # the buffer has been held for long enough
+        if self.buf and time() - self.last_write >= self.flush_interval:
+            self._write()
+
+    def close(self):
+        if self.f is not None:
+            self._write()
+            self._finish()
+
+
+class PcapStreamEmitter(FrameEmitter):
+
+    holds_frames = True
+
+    def __init__(self, path, max_buffered=0x400000, flush_sz=0x10000, \
+            flush_interval=0.05, reconnect_interval=1.0, source_id=0x00):
+        """
+        Initialize an emitter that streams frames in the pcap format to a
+        named pipe or Unix stream socket, for Snort to read directly with
+        `-r <fifo>` or `-r -`
+
+        Writes never block. Whatever the consumer cannot take yet stays
+        buffered, and once `max_buffered` bytes are waiting new frames are
+        dropped and counted instead of stalling the spoofer. A consumer that
+        goes away is reconnected to, starting a fresh pcap stream
+
+        Keyword arguments:
+        path -- a Unix stream socket to connect to or a named pipe to open,
+                created as a named pipe if it does not exist
+        max_buffered -- the number of bytes to hold for a slow consumer
+        flush_sz -- the number of buffered bytes that triggers a write
+        flush_interval -- the maximum seconds frames stay buffered while
+                          the spoofer keeps flushing
+        reconnect_interval -- seconds between attempts to reach a consumer
+        source_id -- the FPGA source the synthetic addresses belong to
+        """
+
+        super().__init__()
+        self.builder = SyntheticFrameBuilder(source_id)
+        self.scratch = bytearray(0x800)
+
+        self.path = path
+        self.max_buffered = max_buffered
+        self.flush_sz = flush_sz
+        self.flush_interval = flush_interval
+        self.reconnect_interval = reconnect_interval
+
+        # lengths of the records in the buffer, so a lost consumer only
+        # drops whole records and they can be counted
+        self.buf = bytearray()
+        self.record_lens = deque()
+        self.head_written = 0x00
+
+        self.fd = None
+        self.s = None
+        self.last_write = 0.0
+        self.last_connect = 0.0
+
+        if not os.path.exists(path):
+            os.mkfifo(path)
+        self.is_fifo = stat.S_ISFIFO(os.stat(path).st_mode)
+
+        self._connect()
+
+    def _connect(self):
+        """
+        Try to reach the consumer and start a new pcap stream, returning
+        whether it is connected
+        """
+
+        self.last_connect = monotonic()
+        try:
+            if self.is_fifo:
+                # fails with ENXIO until a reader has the pipe open
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+            else:
+                self.s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.s.connect(self.path)
+                self.s.setblocking(False)
+                self.fd = self.s.fileno()
+        except OSError as e:
+            if self.s is not None:
+                self.s.close()
+                self.s = None
+            self.fd = None
+            if e.errno not in (errno.ENXIO, errno.ENOENT, errno.ECONNREFUSED):
+                raise
+            return False
+
+        # the header fits in an empty pipe or socket buffer
+        os.write(self.fd, PCAP_FILE_HDR)
+        print('[*] Streaming pcap to {}'.format(self.path))
+        return True
+
+    def _disconnect(self):
+        """
+        Drop the lost consumer along with every buffered record, the next
+        one gets a fresh stream
+        """
+
+        if self.s is not None:
+            self.s.close()
+            self.s = None
+        elif self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+
+        self.dropped_frames += len(self.record_lens)
+        self.dropped_bytes += len(self.buf)
+        self.buf.clear()
+        self.record_lens.clear()
+        self.head_written = 0x00
+        self.buffered_bytes = 0x00
+        print('[!] WARNING: Lost the pcap consumer on {}'.format(self.path))
+
+    def add_frame(self, *frame_args, **frame_kwargs):
+        """
+        Buffer a frame as a pcap record, see
+        `SyntheticFrameBuilder.build_into` for the arguments
+        """
+
+        frame_len = self.builder.build_into(self.scratch, 0x00, \
+            *frame_args, **frame_kwargs)
+        record_len = PCAP_RECORD_HDR.size + frame_len
+
+        # shed the newest frames rather than block on a slow consumer
+        if len(self.buf) + record_len > self.max_buffered:
+            self.dropped_frames += 0x01
+            self.dropped_bytes += record_len
+            return
+
+        ts_us = self._stamp_us()
+        self.buf += PCAP_RECORD_HDR.pack(ts_us // 0xF4240, ts_us % 0xF4240, \
+            frame_len, frame_len)
+        self.buf += self.scratch[:frame_len]
+        self.record_lens.append(record_len)
+        self.buffered_bytes = len(self.buf)
+        self.frames_sent += 0x01
+
+        if len(self.buf) >= self.flush_sz:
+            self._write()
+
+    def _write(self):
+        """
+        Write as much of the buffer as the consumer takes without blocking
+        """
+
+        self.last_write = monotonic()
+        if self.fd is None:
+            if self.last_write - self.last_connect < self.reconnect_interval \
+              or not self._connect():
+                return
+
+        written = 0x00
+        try:
+            with memoryview(self.buf) as view:
+                while written < len(view):
+                    written += os.write(self.fd, view[written:])
+        except BlockingIOError:
+            pass
+        except (BrokenPipeError, ConnectionResetError):
+            self._disconnect()
+            return
+
+        if written:
+            del self.buf[:written]
+            self.buffered_bytes = len(self.buf)
+
+            # forget the records that made it out in full
+            self.head_written += written
+            record_lens = self.record_lens
+            while record_lens and self.head_written >= record_lens[0]:
+                self.head_written -= record_lens.popleft()
+
+    def flush(self):
+        # the spoofer flushes after every message, only actually write once
+        # the buffer has been held for long enough
+        if self.buf and monotonic() - self.last_write >= self.flush_interval:
+            self._write()
+
+    def close(self):
+        if self.fd is not None and self.buf:
+            self._write()
+        if self.buf:
+            self.dropped_frames += len(self.record_lens)
+            self.dropped_bytes += len(self.buf)
+        if self.s is not None:
+            self.s.close()
+        elif self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+        self.s = None
@@ -0,0 +1,303 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from time import monotonic, sleep
+from array import array
+import argparse
+import random
+import socket
+import struct
+import sys
+
+# the three part UMAS message from the `_extractUmasTraffic` docstring, used
+# as the template for the XBUS headers and tails of generated messages
+UMAS_SAMPLE = bytes.fromhex(
+    '04 05 00 27 04 26 05 ea 98 08 43 00 0c 0a 5c 06'
+    '1b 00 00 40 08 64 01 00 00 7f d9 d9 06 5a 00 fe'
+    '02 0d 00 00 a2 9b 02 00 00 02 70 a9 00 05 ef de'
+    '04 05 08 27 04 26 04 f8 94 08 0d 00 00 a2 9b 02'
+    '00 00 02 0e 00 0d 0a 03 e4 07 02 0e 08 0c 0a 03'
+    'e4 07 02 00 00 00 08 50 72 6f c8 a4 00 0b 9f bc'
+    '04 55 90 27 04 26 05 bc 86 08 6a 65 63 74 00 43')
+
+XBUS_MSG_MAX_SZ = 0x30
+XBUS_PAY_START_OFFSET = 0x0A
+XBUS_MAX_PAY_SZ = 0x20
+XBUS_TAIL_SZ = 0x06
+XBUS_UMAS_MSG_SZ_OFFSET = 0x0A
+XBUS_UMAS_DST_ID_OFFSET = 0x0C
+XBUS_UMAS_SRC_ID_OFFSET = 0x0D
+XBUS_UMAS_HDR_SZ = 0x13
+XBUS_UMAS_LEN_FIELD_SZ = 0x02
+
+# where the UMAS payload starts in the first XBUS part and how much of it
+# fits before the tail
+XBUS_UMAS_PAY_OFFSET = XBUS_PAY_START_OFFSET + XBUS_UMAS_HDR_SZ
+XBUS_UMAS_FIRST_PAY_SZ = XBUS_MSG_MAX_SZ - XBUS_TAIL_SZ - XBUS_UMAS_PAY_OFFSET
+
+# the FPGA sends at most 64 registers per datagram, which leaves room for the
+# first part and four continuations
+FPGA_MSG_MAX_SZ = 0x100
+MULTI_PAY_MIN_SZ = 0x10
+MULTI_PAY_MAX_SZ = XBUS_UMAS_FIRST_PAY_SZ + XBUS_MAX_PAY_SZ * 0x04
+
+FIRST_PART = UMAS_SAMPLE[:XBUS_MSG_MAX_SZ]
+CONT_PART = UMAS_SAMPLE[XBUS_MSG_MAX_SZ:XBUS_MSG_MAX_SZ * 0x02]
+LAST_CONT_PREFIX = UMAS_SAMPLE[XBUS_MSG_MAX_SZ * 0x02 \
+    : XBUS_MSG_MAX_SZ * 0x02 + XBUS_PAY_START_OFFSET]
+
+# every generated UMAS payload is 5A <session> <fnc> <seq> ..., with the
+# sequence number used to match spoofed frames back to the datagram
+UMAS_MODBUS_FNC = 0x5A
+UMAS_SEQ_OFFSET = 0x03
+UMAS_SEQ_SZ = 0x04
+UMAS_MIN_PAY_SZ = UMAS_SEQ_OFFSET + UMAS_SEQ_SZ
+
+# function codes used for each kind of generated message
+REQUEST_FNC_CODES = (0x02, 0x03, 0x04, 0x20, 0x22, 0x24, 0x58)
+MULTI_FNC_CODES = (0x21, 0x28, 0x31, 0x33)
+RESPONSE_FNC_CODES = (0xFE, )
+
+# routine polling repeats the same READ_PROJECT_INFO request without a
+# sequence number
+POLL_PAYLOAD = bytes((UMAS_MODBUS_FNC, 0x00, 0x03))
+
+MSG_KINDS = ('request', 'multi', 'response', 'other', 'poll')
+DEFAULT_MIX = 'request=5,multi=2,response=2,other=1'
+
+
+def to_fpga_words(msg):
+    """
+    Convert a big endian message into the little endian 32-bit words the FPGA
+    sends, padding it out to a whole word
+
+    Keyword arguments:
+    msg -- the big endian message
+    """
+
+    words = array('I')
+    words.frombytes(bytes(msg) + bytes(-len(msg) & 0x03))
+    words.byteswap()
+    return words.tobytes()
+
+
+def build_umas_msg(src_id, dst_id, payload):
+    """
+    Return the big endian XBUS parts carrying a UMAS payload, laid out the
+    same way as the sample in the `_extractUmasTraffic` docstring
+
+    Payloads of up to 13 bytes fit in a single part followed by its tail,
+    anything longer fills the first part and continues in 32 byte chunks
+    with the last part cut short after its data
+
+    Keyword arguments:
+    src_id -- sending module identifier byte
+    dst_id -- receiving module identifier byte
+    payload -- the UMAS payload
+    """
+
+    payload_sz = len(payload)
+    if XBUS_UMAS_FIRST_PAY_SZ < payload_sz < MULTI_PAY_MIN_SZ \
+      or payload_sz > MULTI_PAY_MAX_SZ:
+        raise ValueError('a UMAS payload of {} bytes cannot be sent in one ' \
+            'FPGA message'.format(payload_sz))
+
+    first = bytearray(FIRST_PART)
+    first[XBUS_UMAS_MSG_SZ_OFFSET] = payload_sz + XBUS_UMAS_HDR_SZ \
+        - XBUS_UMAS_LEN_FIELD_SZ
+    first[XBUS_UMAS_DST_ID_OFFSET] = dst_id
+    first[XBUS_UMAS_SRC_ID_OFFSET] = src_id
+
+    if payload_sz <= XBUS_UMAS_FIRST_PAY_SZ:
+        return first[:XBUS_UMAS_PAY_OFFSET] + payload \
+            + first[-XBUS_TAIL_SZ:]
+
+    first[XBUS_UMAS_PAY_OFFSET:-XBUS_TAIL_SZ] = \
+        payload[:XBUS_UMAS_FIRST_PAY_SZ]
+    msg = first
+
+    remaining = payload[XBUS_UMAS_FIRST_PAY_SZ:]
+    while len(remaining) > XBUS_MAX_PAY_SZ:
+        part = bytearray(CONT_PART)
+        part[XBUS_PAY_START_OFFSET:XBUS_PAY_START_OFFSET \
+            + XBUS_MAX_PAY_SZ] = remaining[:XBUS_MAX_PAY_SZ]
+        msg += part
+        remaining = remaining[XBUS_MAX_PAY_SZ:]
+
+    return msg + LAST_CONT_PREFIX + remaining
+
+
+class FpgaTrafficGenerator():
+
+    def __init__(self, mix=DEFAULT_MIX, pair_count=0x08, seed=None):
+        """
+        Initialize a generator of FPGA datagrams with a weighted mix of
+        message kinds
+
+        The kinds are:
+          * request - a single part UMAS request
+          * multi - a UMAS message split over several XBUS parts
+          * response - a single part UMAS response
+          * other - an XBUS message without the UMAS flag
+          * poll - the same UMAS request over and over for each module pair
+
+        Keyword arguments:
+        mix -- comma separated kind=weight pairs
+        pair_count -- the number of module pairs the messages are spread over
+        seed -- the random seed, for repeatable runs
+        """
+
+        self.rand = random.Random(seed)
+
+        self.kinds = []
+        self.weights = []
+        for entry in mix.split(','):
+            kind, weight = entry.split('=')
+            if kind not in MSG_KINDS:
+                raise ValueError('unknown message kind `{}`'.format(kind))
+            self.kinds.append(kind)
+            self.weights.append(float(weight))
+
+        self.pairs = [(self.rand.randint(0x01, 0xFE), \
+            self.rand.randint(0x01, 0xFE)) for _ in range(pair_count)]
+
+    def _payload(self, fnc_codes, payload_sz, seq):
+        payload = bytearray(self.rand.getrandbits(0x08) \
+            for _ in range(payload_sz))
+        payload[0x00] = UMAS_MODBUS_FNC
+        payload[0x01] = 0x00
+        payload[0x02] = self.rand.choice(fnc_codes)
+        struct.pack_into('>I', payload, UMAS_SEQ_OFFSET, seq & 0xFFFFFFFF)
+        return bytes(payload)
+
+    def build(self, seq):
+        """
+        Return a (raw FPGA datagram, is_umas) tuple for the next message,
+        where is_umas is only set for messages carrying a sequence number
+
+        Keyword arguments:
+        seq -- the sequence number embedded in UMAS payloads
+        """
+
+        kind = self.rand.choices(self.kinds, self.weights)[0]
+        src_id, dst_id = self.rand.choice(self.pairs)
+
+        if kind == 'other':
+            part = bytearray(CONT_PART)
+            part[XBUS_PAY_START_OFFSET:XBUS_PAY_START_OFFSET \
+                + XBUS_MAX_PAY_SZ] = bytes(self.rand.getrandbits(0x08) \
+                    for _ in range(XBUS_MAX_PAY_SZ))
+            return to_fpga_words(part), False
+
+        if kind == 'poll':
+            return to_fpga_words(build_umas_msg(src_id, dst_id, \
+                POLL_PAYLOAD)), False
+
+        if kind == 'multi':
+            payload = self._payload(MULTI_FNC_CODES, \
+                self.rand.randint(MULTI_PAY_MIN_SZ, MULTI_PAY_MAX_SZ), seq)
+        elif kind == 'response':
+            payload = self._payload(RESPONSE_FNC_CODES, \
+                self.rand.randint(UMAS_MIN_PAY_SZ, XBUS_UMAS_FIRST_PAY_SZ), \
+                seq)
+            # answer from the module the requests go to
+            src_id, dst_id = dst_id, src_id
+        else:
+            payload = self._payload(REQUEST_FNC_CODES, \
+                self.rand.randint(UMAS_MIN_PAY_SZ, XBUS_UMAS_FIRST_PAY_SZ), \
+                seq)
+
+        return to_fpga_words(build_umas_msg(src_id, dst_id, payload)), True
+
+    def build_many(self, count):
+        """
+        Return a list of `count` (raw FPGA datagram, is_umas) tuples with the
+        list index as sequence number
+
+        Keyword arguments:
+        count -- the number of messages
+        """
+
+        return [self.build(seq) for seq in range(count)]
+
+
+def send_paced(s, msgs, rate):
+    """
+    Send prebuilt datagrams at a fixed rate and return an array of the
+    monotonic time each one was sent at
+
+    When the sender falls behind it catches up without sleeping, so short
+    bursts are sent back to back
+
+    Keyword arguments:
+    s -- a connected UDP socket
+    msgs -- a list of datagrams
+    rate -- datagrams/sec, 0 for as fast as possible
+    """
+
+    send_ts = array('d', bytes(0x08 * len(msgs)))
+    start = monotonic()
+
+    for idx, msg in enumerate(msgs):
+        if rate:
+            delay = start + idx / rate - monotonic()
+            if delay > 0.0005:
+                sleep(delay)
+        send_ts[idx] = monotonic()
+        try:
+            s.send(msg)
+        except ConnectionRefusedError:
+            # nothing was listening when the previous datagram arrived
+            pass
+
+    return send_ts
+
+
+def main():
+    """
+    Send synthetic FPGA traffic to a running parse_xbus_from_fpga.py
+    """
+
+    parser = argparse.ArgumentParser(description='Send synthetic FPGA UDP traffic')
+    parser.add_argument('--lhost', type=str, default='127.0.0.1', help='The address parse_xbus_from_fpga.py listens on')
+    parser.add_argument('--lport', type=int, default=0x343A, help='The port parse_xbus_from_fpga.py listens on')
+    parser.add_argument('--rate', type=float, default=1000.0, help='FPGA messages/sec to send, 0 for as fast as possible')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds to send traffic for')
+    parser.add_argument('--mix', type=str, default=DEFAULT_MIX, help='Comma separated kind=weight pairs, kinds are {}'.format(', '.join(MSG_KINDS)))
+    parser.add_argument('--pairs', type=int, default=0x08, help='The number of module pairs to spread messages over')
+    parser.add_argument('--seed', type=int, default=None, help='The random seed, for repeatable traffic')
+    args = parser.parse_args()
+
+    count = int(args.rate * args.duration) if args.rate else 0x186A0
+    generator = FpgaTrafficGenerator(args.mix, args.pairs, args.seed)
+    msgs = [msg for msg, is_umas in generator.build_many(count)]
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.connect((args.lhost, args.lport))
+
+    try:
+        send_ts = send_paced(s, msgs, args.rate)
+    except KeyboardInterrupt:
+        print('\r[*] Stopped sending')
+        sys.exit(0x00)
+    finally:
+        s.close()
+
+    elapsed = send_ts[-1] - send_ts[0] if len(send_ts) > 0x01 else 0.0
+    print('[*] Sent {} FPGA messages in {:.2f}s ({:.0f}/s)'.format(len(msgs), \
+        elapsed, len(msgs) / elapsed if elapsed else 0.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from multiprocessing import queues, get_context
+from queue import Empty, Full
+
+# what a producer does with a message when the queue it feeds is full
+#  - block: wait for room, pushing back on the previous stage
+#  - drop_newest: drop the message being added
+#  - drop_oldest: drop the longest waiting message to make room
+#  - sample: keep every Nth message while above the high watermark
+SHED_POLICIES = ('block', 'drop_newest', 'drop_oldest', 'sample')
+
+# reasons a message was shed, in counter order
+SHED_FULL = 0x00
+SHED_OLDEST = 0x01
+SHED_SAMPLED = 0x02
+SHED_REASONS = ('full', 'oldest', 'sampled')
+
+
+class LoadShedder():
+
+    def __init__(self, capacity, policy='block', sample_nth=0x0A, \
+            high_watermark=0.8, low_watermark=0.5):
+        """
+        Initialize the overflow policy and watermark signal of a bounded
+        queue
+
+        The queue is congested from when its depth reaches the high
+        watermark until it falls back to the low watermark. Each process
+        tracks that on its own copy, so stages can check it on every message
+        without any locking
+
+        Keyword arguments:
+        capacity -- the number of entries the queue holds
+        policy -- one of SHED_POLICIES
+        sample_nth -- with the sample policy, keep one in this many messages
+                      while congested
+        high_watermark -- the fraction of `capacity` that starts congestion
+        low_watermark -- the fraction of `capacity` that ends congestion
+        """
+
+        if policy not in SHED_POLICIES:
+            raise ValueError('unknown shed policy {}'.format(policy))
+        if not 0.0 <= low_watermark <= high_watermark <= 1.0:
+            raise ValueError('watermarks must satisfy 0 <= low <= high <= 1')
+
+        self.capacity = capacity
+        self.policy = policy
+        self.sample_nth = max(sample_nth, 0x01)
+        self.high_count = max(int(capacity * high_watermark), 0x01)
+        self.low_count = int(capacity * low_watermark)
+
+        self.congested = False
+        self.sample_idx = 0x00
+
+    def update(self, depth):
+        """
+        Update and return the congestion state for the current queue depth
+
+        Keyword arguments:
+        depth -- the number of entries waiting in the queue
+        """
+
+        if depth >= self.high_count:
+            self.congested = True
+        elif depth <= self.low_count:
+            self.congested = False
+        return self.congested
+
+    def sampled(self):
+        """
+        Return whether the next message is kept while sampling
+        """
+
+        self.sample_idx += 0x01
+        if self.sample_idx >= self.sample_nth:
+            self.sample_idx = 0x00
+            return True
+        return False
+
+
+def msg_count(msg):
+    # batch receive workers queue a list of messages per entry
+    return len(msg) if isinstance(msg, list) else 0x01
+
+
+class SheddingQueue(queues.Queue):
+
+    def __init__(self, maxsize, shedder=None):
+        """
+        Initialize a bounded multiprocessing Queue that applies the overflow
+        policy of `shedder` on put and counts every message it sheds
+
+        Keyword arguments:
+        maxsize -- the maximum number of entries waiting in the queue
+        shedder -- the LoadShedder to use, blocking by default
+        """
+
+        ctx = get_context()
+        super().__init__(maxsize, ctx=ctx)
+        self.shedder = shedder or LoadShedder(maxsize)
+
+        # several producers may shed at once, so the counts take a lock
+        self.shed = ctx.Array('Q', len(SHED_REASONS))
+
+    def __getstate__(self):
+        return super().__getstate__() + (self.shedder, self.shed)
+
+    def __setstate__(self, state):
+        super().__setstate__(state[:-0x02])
+        self.shedder, self.shed = state[-0x02:]
+
+    def _count_shed(self, reason, count):
+        with self.shed.get_lock():
+            self.shed[reason] += count
+
+    def congested(self):
+        """
+        Return whether the queue is between its high and low watermarks
+        """
+
+        return self.shedder.update(self.qsize())
+
+    def put(self, obj, block=True, timeout=None):
+        """
+        Add an entry, shedding it or an older one as the policy requires
+
+        Returns whether the queue grew by the entry, which is False both
+        when it was shed and when it took the place of an evicted one, so a
+        producer signalling the consumer per entry keeps one signal per
+        entry waiting
+
+        Keyword arguments:
+        obj -- the entry to add
+        block -- wait for room when the policy is block
+        timeout -- the maximum number of seconds to wait for room
+        """
+
+        shedder = self.shedder
+        if shedder.policy == 'block':
+            super().put(obj, block, timeout)
+            return True
+
+        if shedder.policy == 'sample' and self.congested() \
+          and not shedder.sampled():
+            self._count_shed(SHED_SAMPLED, msg_count(obj))
+            return False
+
+        try:
+            super().put(obj, False)
+            return True
+        except Full:
+            if shedder.policy != 'drop_oldest':
+                self._count_shed(SHED_FULL, msg_count(obj))
+                return False
+
+        # make room by taking the oldest entry off the consumer's end, the
+        # entry then only takes its place
+        try:
+            self._count_shed(SHED_OLDEST, msg_count(super().get(False)))
+            super().put(obj, False)
+        except (Empty, Full):
+            self._count_shed(SHED_FULL, msg_count(obj))
+        return False
+
+    def take_evicted(self):
+        """
+        Return the number of entries the consumer skipped since the last
+        call, always 0 as drop_oldest evicts on the producer's side here
+        """
+
+        return 0x00
+
+    def shed_counts(self):
+        """
+        Return a dict of shed reason to the number of messages shed
+        """
+
+        return dict(zip(SHED_REASONS, self.shed[:]))
@@ -0,0 +1,417 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import shared_memory
+from bisect import bisect_left
+from time import time
+import threading
+import json
+import os
+
+# counter positions within a row, each stage writer owns one row
+RECV_DATAGRAMS = 0x00
+RECV_BYTES = 0x01
+RECV_TRUNCATED = 0x02
+RECV_KERNEL_DROPS = 0x03
+RECV_QUEUE_DROPS = 0x04
+
+DECODE_FPGA_MSGS = 0x00
+DECODE_UMAS_TXNS = 0x01
+DECODE_EMPTY_PAYLOADS = 0x02
+DECODE_REASSEMBLED = 0x03
+DECODE_DROPPED_PARTIALS = 0x04
+DECODE_PRIORITY_TXNS = 0x05
+DECODE_FNC_CODES = 0x06
+
+EMIT_UMAS_TXNS = 0x00
+EMIT_FRAMES = 0x01
+EMIT_LATENCY_SUM_US = 0x02
+EMIT_DROPPED_FRAMES = 0x03
+EMIT_DROPPED_BYTES = 0x04
+EMIT_PRIORITY_TXNS = 0x05
+EMIT_PRIORITY_LATENCY_SUM_US = 0x06
+EMIT_SUPPRESSED_TXNS = 0x07
+EMIT_BUFFERED_BYTES = 0x08
+EMIT_LATENCY_BUCKETS = 0x09
+
+# names of the plain counters of each stage, in row order
+#
+# some are copied from a running total kept elsewhere, such as the kernel
+# drop count reported with SO_RXQ_OVFL, but all of them only ever go up
+STAGE_COUNTERS = {
+    'recv': ('datagrams', 'bytes', 'truncated', 'kernel_drops', \
+        'queue_drops'),
+    'decode': ('fpga_msgs', 'umas_txns', 'empty_payloads', 'reassembled', \
+        'dropped_partials', 'priority_txns'),
+    'emit': ('umas_txns', 'frames', 'latency_sum_us', 'dropped_frames', \
+        'dropped_bytes', 'priority_txns', 'priority_latency_sum_us', \
+        'suppressed_txns'),
+}
+
+# names of the values that go up and down, following the counters
+STAGE_GAUGES = {
+    'recv': (),
+    'decode': (),
+    'emit': ('buffered_bytes', ),
+}
+
+# upper bounds of the ingest to emit latency histogram buckets, anything
+# slower lands in a final overflow bucket
+LATENCY_BUCKETS_US = (0x64, 0xFA, 0x1F4, 0x3E8, 0x9C4, 0x1388, 0x2710, \
+    0x61A8, 0xC350, 0x186A0, 0x3D090, 0xF4240)
+
+# the priority lane has a histogram of its own following the first one
+EMIT_PRIORITY_LATENCY_BUCKETS = EMIT_LATENCY_BUCKETS \
+    + len(LATENCY_BUCKETS_US) + 0x01
+
+# number of UMAS function code counters
+FNC_CODE_COUNT = 0x100
+
+METRIC_PREFIX = 'badgerboard'
+
+
+def latency_bucket(latency_us, first_bucket=EMIT_LATENCY_BUCKETS):
+    """
+    Return the histogram bucket index for a latency
+
+    Keyword arguments:
+    latency_us -- the latency in microseconds
+    first_bucket -- the index of the first bucket of the histogram
+    """
+
+    return first_bucket + bisect_left(LATENCY_BUCKETS_US, latency_us)
+
+
+class PipelineMetrics():
+
+    def __init__(self, recv_count, decode_count, name=None, create=True):
+        """
+        Initialize a block of uint64 counters in shared memory
+
+        Every recv worker, FPGA message processor and the spoofer gets a row
+        of its own, so each counter only ever has a single writer and no
+        locking is needed. Readers may see a row mid update, which is fine
+        for monitoring
+
+        Keyword arguments:
+        recv_count -- the number of recv workers
+        decode_count -- the number of FPGA message processors
+        name -- the name of an existing shared memory block to attach to
+        create -- create a new shared memory block instead of attaching
+        """
+
+        self.recv_count = recv_count
+        self.decode_count = decode_count
+
+        self.row_counts = {'recv': recv_count, 'decode': decode_count, \
+            'emit': 0x01}
+        self.row_szs = {
+            'recv': len(STAGE_COUNTERS['recv']),
+            'decode': DECODE_FNC_CODES + FNC_CODE_COUNT,
+            'emit': EMIT_PRIORITY_LATENCY_BUCKETS + len(LATENCY_BUCKETS_US) \
+                + 0x01,
+        }
+
+        # stages are laid out one after the other, row by row
+        self.stage_offsets = {}
+        counter_count = 0x00
+        for stage in ('recv', 'decode', 'emit'):
+            self.stage_offsets[stage] = counter_count
+            counter_count += self.row_counts[stage] * self.row_szs[stage]
+
+        self.shm = shared_memory.SharedMemory(name=name, create=create, \
+            size=counter_count * 0x08)
+        self.counters = self.shm.buf.cast('Q')
+
+        # rows handed out to the stages, which keep the block mapped until
+        # they are released
+        self.row_views = []
+
+        if create:
+            for idx in range(counter_count):
+                self.counters[idx] = 0x00
+
+    def __reduce__(self):
+        # attach to the existing block by name instead of copying it
+        return (self.__class__, (self.recv_count, self.decode_count, \
+            self.shm.name, False))
+
+    def _row(self, stage, idx=0x00):
+        start = self.stage_offsets[stage] \
+            + (idx % self.row_counts[stage]) * self.row_szs[stage]
+        return self.counters[start:start + self.row_szs[stage]]
+
+    def row(self, stage, idx=0x00):
+        """
+        Return a writable view of the counters of one stage writer, which
+        stays valid until `close`
+
+        Keyword arguments:
+        stage -- 'recv', 'decode' or 'emit'
+        idx -- the index of the writer within its stage
+        """
+
+        row_view = self._row(stage, idx)
+        self.row_views.append(row_view)
+        return row_view
+
+    def read(self, stage, idx=0x00):
+        """
+        Return a list copy of the counters of one stage writer
+
+        Keyword arguments:
+        stage -- 'recv', 'decode' or 'emit'
+        idx -- the index of the writer within its stage
+        """
+
+        with self._row(stage, idx) as row_view:
+            return row_view.tolist()
+
+    def _rows(self, stage):
+        return [self.read(stage, idx) for idx in range(self.row_counts[stage])]
+
+    def snapshot(self, gauges=None, queues=None):
+        """
+        Return a dict copy of every counter, suitable for JSON
+
+        Keyword arguments:
+        gauges -- a dict of name to callables returning queue depths
+        queues -- a dict of name to queues that shed messages
+        """
+
+        stats = {}
+        stats['time'] = time()
+
+        for stage, names in STAGE_COUNTERS.items():
+            names += STAGE_GAUGES[stage]
+            stats[stage] = [dict(zip(names, row[:len(names)])) \
+                for row in self._rows(stage)]
+
+        stats['umas_fnc_codes'] = self._fnc_codes()
+
+        stats['latency_us'] = self._latency_histogram(EMIT_LATENCY_BUCKETS, \
+            EMIT_LATENCY_SUM_US)
+        stats['priority_latency_us'] = self._latency_histogram( \
+            EMIT_PRIORITY_LATENCY_BUCKETS, EMIT_PRIORITY_LATENCY_SUM_US)
+
+        stats['queue_depth'] = self._read_gauges(gauges)
+        stats['queue_shed'] = {name: q.shed_counts() \
+            for name, q in (queues or {}).items()}
+        stats['queue_congested'] = {name: q.congested() \
+            for name, q in (queues or {}).items()}
+
+        return stats
+
+    def _latency_histogram(self, first_bucket, sum_idx):
+        emit_row = self.read('emit')
+        bucket_counts = emit_row[first_bucket:first_bucket \
+            + len(LATENCY_BUCKETS_US) + 0x01]
+        return {
+            'buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS_US] \
+                + ['+Inf'], bucket_counts)),
+            'sum': emit_row[sum_idx],
+            'count': sum(bucket_counts),
+        }
+
+    def _fnc_codes(self):
+        # UMAS function code counts summed over every processor
+        fnc_codes = [0x00] * FNC_CODE_COUNT
+        for row in self._rows('decode'):
+            for fnc, count in enumerate(row[DECODE_FNC_CODES:]):
+                fnc_codes[fnc] += count
+        return {'0x{:02x}'.format(fnc): count \
+            for fnc, count in enumerate(fnc_codes) if count}
+
+    def _read_gauges(self, gauges):
+        depths = {}
+        for name, qsize in (gauges or {}).items():
+            # multiprocessing.Queue.qsize is not available on every platform
+            try:
+                depths[name] = qsize()
+            except NotImplementedError:
+                pass
+        return depths
+
+    def render_prometheus(self, gauges=None, queues=None):
+        """
+        Return every counter in the Prometheus text exposition format
+
+        Keyword arguments:
+        gauges -- a dict of name to callables returning queue depths
+        queues -- a dict of name to queues that shed messages
+        """
+
+        lines = []
+        labels = {'recv': 'worker', 'decode': 'processor', 'emit': 'spoofer'}
+
+        for stage, names in STAGE_COUNTERS.items():
+            rows = self._rows(stage)
+            for counter_idx, counter_name in enumerate(names):
+                metric = '{}_{}_{}_total'.format(METRIC_PREFIX, stage, \
+                    counter_name)
+                lines.append('# TYPE {} counter'.format(metric))
+                for row_idx, row in enumerate(rows):
+                    lines.append('{}{{{}="{}"}} {}'.format(metric, \
+                        labels[stage], row_idx, row[counter_idx]))
+
+            for gauge_idx, gauge_name in enumerate(STAGE_GAUGES[stage], \
+                    len(names)):
+                metric = '{}_{}_{}'.format(METRIC_PREFIX, stage, gauge_name)
+                lines.append('# TYPE {} gauge'.format(metric))
+                for row_idx, row in enumerate(rows):
+                    lines.append('{}{{{}="{}"}} {}'.format(metric, \
+                        labels[stage], row_idx, row[gauge_idx]))
+
+        metric = '{}_decode_umas_fnc_total'.format(METRIC_PREFIX)
+        lines.append('# TYPE {} counter'.format(metric))
+        for fnc, count in self._fnc_codes().items():
+            lines.append('{}{{fnc="{}"}} {}'.format(metric, fnc, count))
+
+        emit_row = self.read('emit')
+        for name, first_bucket, sum_idx in \
+                (('latency', EMIT_LATENCY_BUCKETS, EMIT_LATENCY_SUM_US), \
+                ('priority_latency', EMIT_PRIORITY_LATENCY_BUCKETS, \
+                    EMIT_PRIORITY_LATENCY_SUM_US)):
+            metric = '{}_emit_{}_seconds'.format(METRIC_PREFIX, name)
+            lines.append('# TYPE {} histogram'.format(metric))
+            cumulative = 0x00
+            for bucket_idx, bound in enumerate(LATENCY_BUCKETS_US + (None, )):
+                cumulative += emit_row[first_bucket + bucket_idx]
+                le = '+Inf' if bound is None else repr(bound / 1e6)
+                lines.append('{}_bucket{{le="{}"}} {}'.format(metric, le, \
+                    cumulative))
+            lines.append('{}_sum {}'.format(metric, emit_row[sum_idx] / 1e6))
+            lines.append('{}_count {}'.format(metric, cumulative))
+
+        metric = '{}_queue_depth'.format(METRIC_PREFIX)
+        lines.append('# TYPE {} gauge'.format(metric))
+        for name, depth in self._read_gauges(gauges).items():
+            lines.append('{}{{queue="{}"}} {}'.format(metric, name, depth))
+
+        if queues:
+            metric = '{}_queue_shed_total'.format(METRIC_PREFIX)
+            lines.append('# TYPE {} counter'.format(metric))
+            for name, q in queues.items():
+                for reason, count in q.shed_counts().items():
+                    lines.append('{}{{queue="{}",reason="{}"}} {}'.format( \
+                        metric, name, reason, count))
+
+            metric = '{}_queue_congested'.format(METRIC_PREFIX)
+            lines.append('# TYPE {} gauge'.format(metric))
+            for name, q in queues.items():
+                lines.append('{}{{queue="{}"}} {}'.format(metric, name, \
+                    int(q.congested())))
+
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        # every view of the block has to be released before it can be
+        # unmapped, rows used after this raise ValueError
+        for row_view in self.row_views:
+            row_view.release()
+        self.row_views = []
+        self.counters.release()
+        self.counters = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class MetricsExporter(threading.Thread):
+
+    def __init__(self, metrics, gauges, port=None, stats_file=None, \
+            interval=5.0, lhost='127.0.0.1', queues=None):
+        """
+        Initialize a thread in the main process that publishes the pipeline
+        metrics on a Prometheus text endpoint and/or in a stats file
+
+        Keyword arguments:
+        metrics -- the PipelineMetrics to publish
+        gauges -- a dict of name to callables returning queue depths
+        port -- the local port for the HTTP endpoint, None to disable it
+        stats_file -- the path of the JSON stats file, None to disable it
+        interval -- seconds between stats file writes
+        lhost -- the address the HTTP endpoint listens on
+        queues -- a dict of name to queues that shed messages
+        """
+
+        super().__init__(daemon=True)
+        self.metrics = metrics
+        self.gauges = gauges
+        self.queues = queues
+        self.stats_file = stats_file
+        self.interval = interval
+        self.stopped = threading.Event()
+
+        self.httpd = None
+        if port is not None:
+            exporter = self
+
+            class MetricsHandler(BaseHTTPRequestHandler):
+
+                def do_GET(self):
+                    if self.path not in ('/', '/metrics'):
+                        self.send_error(404)
+                        return
+                    body = exporter.metrics.render_prometheus( \
+                        exporter.gauges, exporter.queues).encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', \
+                        'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *log_args):
+                    pass
+
+            self.httpd = ThreadingHTTPServer((lhost, port), MetricsHandler)
+            self.httpd.daemon_threads = True
+
+    def _write_stats(self):
+        """
+        Replace the stats file with a fresh snapshot
+
+        The snapshot is written to a temporary file and renamed so readers
+        never see a half written file
+        """
+
+        tmp_path = '{}.tmp'.format(self.stats_file)
+        with open(tmp_path, 'w') as f:
+            json.dump(self.metrics.snapshot(self.gauges, self.queues), f, \
+                indent=0x02)
+        os.replace(tmp_path, self.stats_file)
+
+    def run(self):
+        if self.httpd is not None:
+            threading.Thread(target=self.httpd.serve_forever, \
+                daemon=True).start()
+
+        while not self.stopped.wait(self.interval):
+            if self.stats_file is not None:
+                self._write_stats()
+
+    def stop(self):
+        """
+        Stop publishing, writing the stats file one last time
+        """
+
+        self.stopped.set()
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        if self.stats_file is not None:
+            self._write_stats()
@@ -12,51 +12,175 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Semaphore, active_children
+from collections import OrderedDict, deque
 from queue import Empty
-from time import sleep
+from time import sleep, monotonic, time
+from array import array
+from itertools import count
 import socketserver
+import asyncio
 import argparse
+import select
 import random
 import struct
+import json
 import socket
 import math
 import sys
+import os
+
+from shm_ring import ShmRing, ShmRingSet, UmasTxnRing
+from load_shedding import LoadShedder, SheddingQueue, SHED_POLICIES
+from frame_emitter import RawSocketEmitter, CaptureSocketEmitter
+from frame_emitter import PcapngEmitter, PcapStreamEmitter
+from frame_emitter import TCP_FIN, TCP_SYN, TCP_RST, TCP_PSH, TCP_ACK
+from fpga_record import FpgaRecordWriter
+from dedup_cache import UmasDedupCache
+from txn_store import UmasTxnStore
+from recv_autoscaler import RecvWorkerAutoscaler, udp_socket_stats
+from stage_profiler import StageProfiler, print_profile_summary
+from xbus_signatures import XbusSignatureTable, parse_signatures
+from xbus_signatures import XBUS_SIGNATURES
+from metrics import PipelineMetrics, MetricsExporter, latency_bucket
+from metrics import RECV_DATAGRAMS, RECV_BYTES, RECV_TRUNCATED
+from metrics import RECV_KERNEL_DROPS, RECV_QUEUE_DROPS
+from metrics import DECODE_FPGA_MSGS, DECODE_UMAS_TXNS, DECODE_EMPTY_PAYLOADS
+from metrics import DECODE_REASSEMBLED, DECODE_DROPPED_PARTIALS
+from metrics import DECODE_PRIORITY_TXNS, DECODE_FNC_CODES
+from metrics import EMIT_UMAS_TXNS, EMIT_FRAMES, EMIT_LATENCY_SUM_US
+from metrics import EMIT_DROPPED_FRAMES, EMIT_DROPPED_BYTES, EMIT_BUFFERED_BYTES
+from metrics import EMIT_PRIORITY_TXNS, EMIT_PRIORITY_LATENCY_SUM_US
+from metrics import EMIT_PRIORITY_LATENCY_BUCKETS, EMIT_SUPPRESSED_TXNS
 
-from scapy.all import Ether, IP, TCP, sendp, Raw
-from scapy.contrib.modbus import ModbusADURequest
-from scapy.contrib.modbus import ModbusADUResponse
 
 parser = argparse.ArgumentParser(description='Process raw backplane data from FPGA')
+parser.add_argument('--mode', type=str, default='multiprocess', choices=['multiprocess', 'asyncio'], help='Run each stage in its own process (multiprocess) or the whole pipeline in one asyncio event loop (asyncio)')
+parser.add_argument('--asyncio_queue_sz', type=int, default=0x400, help='The maximum number of messages waiting between stages in asyncio mode')
 parser.add_argument('--lhost', type=str, default='', help='The address to listen on for UDP traffic from the FPGA')
-parser.add_argument('--lport', type=int, default=0x343A, help='The port to listen on for UDP traffic from the FPGA')
+parser.add_argument('--lport', type=int, nargs='+', default=[0x343A], help='The port to listen on for UDP traffic from the FPGA, or one port per FPGA source to run an independent pipeline for each of them')
+parser.add_argument('--source_cpus', type=str, default=None, help='Colon separated CPU lists to pin the pipeline of each --lport source to, such as 0-1:2-3, by default the available CPUs are split evenly between sources')
 parser.add_argument('--sendinterface', type=str, default='lo', help='The interface on which to send messages out for Snort ingestion')
-parser.add_argument('--recvworker_count', type=int, default=0x0A, help='The number of workers to put on UDP recv from the FPGA')
+parser.add_argument('--reassemble', action='store_true', help='Reassemble UMAS messages whose XBUS parts are split across several FPGA messages')
+parser.add_argument('--reassembly_timeout', type=float, default=1.0, help='Seconds a partially reassembled UMAS message is kept waiting for its remaining parts')
+parser.add_argument('--xbus_signatures', type=str, default=XBUS_SIGNATURES, help='Comma separated name=hex pairs of the big endian bytes marking each XBUS message type to decode, matched against the raw FPGA words so other messages are never byte swapped (default: %(default)s)')
+parser.add_argument('--batch_decoder', type=str, default='auto', choices=['auto', 'numpy', 'python'], help='Decode each batch of raw FPGA messages with vectorized NumPy operations (numpy), one message at a time (python) or with NumPy when it is installed (auto). Batches are only decoded at once without -v/-vv and --reassemble')
+parser.add_argument('--batch_decoder_min', type=int, default=0x08, help='The smallest batch of raw FPGA messages worth decoding with NumPy, smaller ones are decoded one message at a time')
+parser.add_argument('--emitter', type=str, default='raw', choices=['raw', 'scapy', 'capture', 'pcapng', 'stream'], help='Send spoofed frames through a persistent AF_PACKET socket with prebuilt headers (raw), through scapy sendp (scapy), as datagrams to the --capture_socket Unix socket (capture), write them to rotating pcapng files (pcapng) or stream them as pcap to --stream_path (stream)')
+parser.add_argument('--pcap_prefix', type=str, default='umas', help='The path prefix of the <PCAP_PREFIX>.<seq>.pcapng files written with --emitter pcapng')
+parser.add_argument('--pcap_max_bytes', type=int, default=0x4000000, help='The size after which a new pcapng file is started')
+parser.add_argument('--pcap_rotate_secs', type=float, default=60.0, help='The age after which a new pcapng file is started, 0 to only rotate by size')
+parser.add_argument('--stream_path', type=str, default='/tmp/badgerboard.pcap', help='The Unix stream socket or named pipe to stream pcap to with --emitter stream, created as a named pipe if missing')
+parser.add_argument('--stream_max_buffered', type=int, default=0x400000, help='The bytes of pcap to hold for a slow --stream_path consumer before dropping frames')
+parser.add_argument('--capture_socket', type=str, default=None, help='The Unix datagram socket spoofed frames are written to with --emitter capture')
+parser.add_argument('--session_mode', type=str, default='txn', choices=['txn', 'persistent'], help='Spoof a full TCP handshake and teardown per UMAS message (txn) or keep one long-lived flow per module pair (persistent)')
+parser.add_argument('--session_idle_timeout', type=float, default=30.0, help='Seconds without traffic before a persistent flow is torn down')
+parser.add_argument('--session_max_msgs', type=int, default=0x400, help='The number of messages after which a persistent flow is torn down and reopened')
+parser.add_argument('--correlate_responses', action='store_true', help='Send UMAS responses as server-to-client Modbus responses on the flow of the request they answer')
+parser.add_argument('--response_timeout', type=float, default=5.0, help='Seconds to wait for the response to a UMAS request before forgetting it')
+parser.add_argument('--recvworker_count', type=int, default=0x0A, help='The number of workers to put on UDP recv from the FPGA, or to start with when autoscaling')
+parser.add_argument('--recvworker_autoscale', action='store_true', help='Add recv workers when the kernel drops datagrams or the socket receive buffer backs up and remove them again once traffic calms down, between --recvworker_min and --recvworker_max')
+parser.add_argument('--recvworker_min', type=int, default=0x01, help='The fewest recv workers to scale down to')
+parser.add_argument('--recvworker_max', type=int, default=0x10, help='The most recv workers to scale up to')
+parser.add_argument('--recvworker_scale_interval', type=float, default=1.0, help='Seconds between checks of the kernel drop count and receive buffer backlog when autoscaling')
+parser.add_argument('--processor_count', type=int, default=0x01, help='The number of FPGA message processors, raw messages are sharded between them by module pair')
+parser.add_argument('--recv_mode', type=str, default='single', choices=['single', 'batch'], help='Receive one datagram per syscall/queue put (single) or drain datagrams into preallocated buffers and queue them in batches (batch)')
+parser.add_argument('--recv_batch_sz', type=int, default=0x40, help='The maximum number of datagrams handed off per queue put in batch receive mode')
+parser.add_argument('--recv_reuseport', action='store_true', help='In batch receive mode, give each recv worker its own SO_REUSEPORT socket instead of sharing one')
+parser.add_argument('--record', type=str, default=None, help='Record every raw FPGA datagram to <RECORD>.<worker>.<seq>.fpgarec files for replay_fpga_record.py')
+parser.add_argument('--record_max_bytes', type=int, default=0x4000000, help='The size after which a new record file is started')
+parser.add_argument('--record_max_files', type=int, default=0x00, help='The number of record files each recv worker keeps, 0 to keep them all')
+parser.add_argument('--transport', type=str, default='queue', choices=['queue', 'shm'], help='Pass messages between stages with pickled multiprocessing Queues (queue) or shared memory ring buffers (shm)')
+parser.add_argument('--shm_slot_count', type=int, default=0x1000, help='The number of slots in each shared memory ring, must be a power of two')
+parser.add_argument('--queue_sz', type=int, default=0x4000, help='The maximum number of entries waiting in each multiprocessing Queue between stages')
+parser.add_argument('--shed_policy', type=str, default='block', choices=SHED_POLICIES, help='What to do when a queue between stages is full: wait for room (block), drop the new message (drop_newest), drop the oldest waiting message (drop_oldest) or keep every --shed_sample_nth message while above the high watermark (sample)')
+parser.add_argument('--shed_sample_nth', type=int, default=0x0A, help='Keep one in this many messages while sampling')
+parser.add_argument('--shed_high_watermark', type=float, default=0.8, help='The fraction of a queue that marks it congested, upstream stages skip debug output while it is')
+parser.add_argument('--shed_low_watermark', type=float, default=0.5, help='The fraction of a queue below which it is no longer congested')
+parser.add_argument('--dedup_window', type=float, default=0.0, help='Seconds during which UMAS transactions repeating one already spoofed between the same modules are suppressed, 0 to spoof every one')
+parser.add_argument('--dedup_max_bytes', type=int, default=0x400000, help='The memory the deduplication cache may take up before evicting the least recently seen transactions')
+parser.add_argument('--dedup_summary_interval', type=float, default=10.0, help='Seconds between summaries of the suppressed transactions')
+parser.add_argument('--dedup_summary_file', type=str, default=None, help='Append the suppression summaries to this file as JSON lines instead of printing them')
+parser.add_argument('--txn_store', type=str, default=None, help='Index every UMAS transaction in compact columnar segments spilled to this directory, for query_umas_txns.py')
+parser.add_argument('--txn_store_segment_secs', type=float, default=60.0, help='Seconds of transactions per --txn_store segment, which is also the longest a transaction waits before it can be queried')
+parser.add_argument('--txn_store_segment_bytes', type=int, default=0x1000000, help='The size after which a --txn_store segment is spilled early')
+parser.add_argument('--txn_store_max_segments', type=int, default=0x00, help='The number of --txn_store segments to keep, 0 to keep them all')
+parser.add_argument('--priority_fnc_codes', type=str, default='0x21,0x23,0x25,0x33,0x34,0x35,0x40,0x41', help='Comma separated UMAS function codes sent through a priority lane the spoofer drains first and that is never shed, empty to disable it (default: WRITE_MEMORY_BLOCK, WRITE_VARIABLES, WRITE_COILS_REGISTERS, INITIALIZE_DOWNLOAD, DOWNLOAD_BLOCK, END_STRATEGY_DOWNLOAD, START_PLC, STOP_PLC)')
+parser.add_argument('--metrics_port', type=int, default=None, help='Serve live pipeline metrics in the Prometheus text format on this local port')
+parser.add_argument('--stats_file', type=str, default=None, help='Periodically write the live pipeline metrics as JSON to this file')
+parser.add_argument('--stats_interval', type=float, default=5.0, help='Seconds between writes of --stats_file')
+parser.add_argument('--profile', type=str, default=None, help='Sample the CPU time of every recv worker, processor and the spoofer and write collapsed stacks per stage for flamegraphs to this directory, printing a CPU time summary per stage on exit')
+parser.add_argument('--profile_interval', type=float, default=0.01, help='Seconds of CPU time between --profile samples')
 parser.add_argument('-v', '--v', action='store_true', help='Enable verbose output')
 parser.add_argument('-vv', '--vv', action='store_true', help='Enable REALLY verbose output')
-args = parser.parse_args()
+
+# only read the command line when run as a script so the classes below can be
+# imported by the benchmark and tooling scripts with the default options
+if __name__ == '__main__':
+    args = parser.parse_args()
+else:
+    args = parser.parse_args([])
+
+# linux socket option that the socket module does not export, it makes the
+# kernel report its receive drop count alongside each datagram
+SO_RXQ_OVFL = 0x28
 
 class UdpServer():
 
-    def __init__(self, lhost, lport):
+    def __init__(self, lhost, lport, recv_mode='single', batch_sz=0x40, \
+            reuseport=False, metrics=None, record=None):
         """
         Initialize a UdpServer Object
 
         Keyword arguments:
         lhost -- the ip address on which to listen for FPGA traffic
         lport -- the port on which to listen for FPGA traffic
+        recv_mode -- 'single' to queue each datagram on its own or 'batch' to
+                     queue lists of datagrams drained from the socket
+        batch_sz -- the maximum number of datagrams per batch
+        reuseport -- give each batch worker its own SO_REUSEPORT socket
+        metrics -- the PipelineMetrics the workers count into, or None
+        record -- the path prefix raw datagrams are recorded to, or None
         """
 
         self.lhost = lhost
         self.lport = lport
-        self.recv_sz = 0x7E
+        self.recv_mode = recv_mode
+        self.batch_sz = batch_sz
+        self.reuseport = reuseport
+        self.metrics = metrics
+        self.record = record
+
+        # the FPGA BackplaneInterruptHandler sends at most 64 registers
+        # (0x100 bytes) per datagram, anything smaller than that will
+        # silently truncate the larger messages
+        self.recv_sz = 0x100
         self.socket_recv_buf = 0x010000 * 0xC8
 
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.s.setsockopt(socket.SOL_SOCKET, \
-                            socket.SO_RCVBUF, \
-                            self.socket_recv_buf)
-        self.s.bind((self.lhost, self.lport))
+        # room for the SO_RXQ_OVFL drop count ancillary data
+        self.anc_buf_sz = socket.CMSG_SPACE(0x04)
+
+        self.s = self._open_socket()
+
+    def _open_socket(self):
+        """
+        Create and bind a UDP socket for receiving FPGA traffic
+
+        When SO_REUSEPORT sharding is enabled every socket bound to the port
+        needs the option set before bind, including the one created here
+        """
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setsockopt(socket.SOL_SOCKET, \
+                        socket.SO_RCVBUF, \
+                        self.socket_recv_buf)
+        if self.reuseport:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 0x01)
+        if self.metrics is not None:
+            s.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 0x01)
+        s.bind((self.lhost, self.lport))
+
+        return s
 
     def serve_forever(self, fpga_msg_q, worker_count):
         """
@@ -66,7 +190,8 @@ class UdpServer():
         This approach is taken to help avoid missing messages sent by the FPGA
 
         In testing we found that exceeding 10 workers did not appear to make a
-        meaningful difference
+        meaningful difference, with --recvworker_autoscale the count follows
+        the traffic instead
 
         Keyword arguments:
         fpga_msg_q -- a Queue used to store received messages
@@ -77,10 +202,21 @@ class UdpServer():
             # list to save off handles to workers
             workers = []
 
-            # run the `self._spawn_receive_process` function as a new process
-            for _ in range(worker_count):
-                cur_recv_p = Process(target=self._spawn_receive_process, \
-                    args=(fpga_msg_q,))
+            # pick the receive loop for the configured mode
+            if self.recv_mode == 'batch':
+                recv_target = self._spawn_batch_receive_process
+            else:
+                recv_target = self._spawn_receive_process
+
+            if args.recvworker_autoscale:
+                self._superviseWorkers(fpga_msg_q, recv_target, worker_count)
+                return
+
+            # run the receive loop as a new process
+            for worker_idx in range(worker_count):
+                cur_recv_p = Process(target=recv_target, \
+                    args=(self._workerQueue(fpga_msg_q, worker_idx), \
+                        worker_idx))
                 workers.append(cur_recv_p)
                 cur_recv_p.start()
 
@@ -97,24 +233,355 @@ class UdpServer():
         finally:
             self.shutdown()
 
-    def _spawn_receive_process(self, fpga_msg_q):
+    def _workerQueue(self, fpga_msg_q, worker_idx):
+        # shared memory rings are single producer so every worker writes to 
+        # its own ring
+        if isinstance(fpga_msg_q, ShmRingSet):
+            return fpga_msg_q.producer(worker_idx)
+        return fpga_msg_q
+
+    def _superviseWorkers(self, fpga_msg_q, recv_target, worker_count):
+        """
+        Run between --recvworker_min and --recvworker_max workers, checking 
+        the kernel's drop count and receive buffer backlog for the port 
+        every --recvworker_scale_interval seconds to decide how many
+
+        Workers are removed from the highest index down, each is told to 
+        stop through a pipe of its own and joined before its index (and 
+        with shared memory, its ring) is handed out again
+
+        Keyword arguments:
+        fpga_msg_q -- a Queue used to store received messages
+        recv_target -- the receive loop the workers run
+        worker_count -- the number of workers to start with
+        """
+
+        autoscaler = RecvWorkerAutoscaler(args.recvworker_min, \
+            args.recvworker_max, worker_count, \
+            self.s.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+
+        # (process, stop pipe write end) per running worker
+        workers = []
+        try:
+            while True:
+                while len(workers) < autoscaler.count:
+                    worker_idx = len(workers)
+                    stop_r, stop_w = os.pipe()
+                    cur_recv_p = Process(target=recv_target, \
+                        args=(self._workerQueue(fpga_msg_q, worker_idx), \
+                            worker_idx, stop_r))
+                    cur_recv_p.start()
+                    os.close(stop_r)
+                    workers.append((cur_recv_p, stop_w))
+
+                while len(workers) > autoscaler.count:
+                    cur_recv_p, stop_w = workers.pop()
+                    os.write(stop_w, b'\x00')
+                    cur_recv_p.join()
+                    os.close(stop_w)
+
+                sleep(args.recvworker_scale_interval)
+
+                datagrams = None
+                if self.metrics is not None:
+                    datagrams = sum(self.metrics.read('recv', worker_idx) \
+                        [RECV_DATAGRAMS] for worker_idx \
+                        in range(self.metrics.recv_count))
+                backlog, drops = udp_socket_stats(self.lport)
+                autoscaler.update(drops, backlog, fpga_msg_q.congested(), \
+                    datagrams)
+
+        finally:
+            autoscaler.report()
+            for cur_recv_p, stop_w in workers:
+                cur_recv_p.join()
+                os.close(stop_w)
+
+    def _openPoller(self, s, stop_fd, recorder):
+        """
+        Return an epoll object waking a worker for its socket or its stop 
+        pipe, or None for a worker that is never stopped and does not record
+
+        The socket is registered exclusively so a datagram only wakes one of
+        the workers sharing it, like a blocking recv would
+
+        Keyword arguments:
+        s -- the socket the worker reads from
+        stop_fd -- the read end of the worker's stop pipe, or None
+        recorder -- the worker's FpgaRecordWriter, or None
+        """
+
+        if stop_fd is None and recorder is None:
+            return None
+
+        poller = select.epoll()
+        poller.register(s, select.EPOLLIN | select.EPOLLEXCLUSIVE)
+        if stop_fd is not None:
+            poller.register(stop_fd, select.EPOLLIN)
+        return poller
+
+    def _waitReadable(self, poller, stop_fd, recorder):
+        """
+        Block until the worker's socket may have a datagram, returning False
+        once the worker has been told to stop
+
+        A recording worker wakes up every flush interval while idle, so the
+        records it buffered are written out even when traffic stops
+
+        Keyword arguments:
+        poller -- the epoll object from `_openPoller`
+        stop_fd -- the read end of the worker's stop pipe, or None
+        recorder -- the worker's FpgaRecordWriter, or None
+        """
+
+        timeout = -0x01 if recorder is None else recorder.flush_interval
+        while True:
+            events = poller.poll(timeout)
+            if events:
+                return not any(fd == stop_fd for fd, _ in events)
+            recorder.expire()
+
+    def _spawn_receive_process(self, fpga_msg_q, worker_idx=0x00, \
+            stop_fd=None):
         """
         Wait for a message from the FPGA and then place that message into a
         shared multiprocessing Queue
 
         Keyword arguments:
         fpga_msg_q -- a Queue used to store received messages
+        worker_idx -- the index of this worker within the pool
+        stop_fd -- the read end of a pipe that stops the worker once written
+                   to, or None
         """
 
+        metrics_row, drops_row = self._metricsRows(self.s, worker_idx)
+        recorder = self._openRecorder(worker_idx)
+        profiler = start_profiler('recv.{}'.format(worker_idx))
+
+        # a worker that can be stopped or records waits in epoll and never 
+        # blocks in the read itself
+        poller = self._openPoller(self.s, stop_fd, recorder)
+        flags = 0x00 if poller is None else socket.MSG_DONTWAIT
+
         try:
-            # receive the new message and add it to the Queue
+            # receive the new message and add it to the Queue along with 
+            # the time it arrived
             while True:
-                msg = self.s.recvfrom(self.recv_sz)[0]
-                fpga_msg_q.put(msg)
+                if poller is not None \
+                  and not self._waitReadable(poller, stop_fd, recorder):
+                    break
+                try:
+                    if metrics_row is None:
+                        msg = self.s.recvfrom(self.recv_sz, flags)[0]
+                    else:
+                        msg, ancdata, msg_flags = self.s.recvmsg( \
+                            self.recv_sz, self.anc_buf_sz, flags)[:0x03]
+                        self._countDatagram(metrics_row, drops_row, \
+                            len(msg), msg_flags & socket.MSG_TRUNC, ancdata)
+                except BlockingIOError:
+                    continue
+                ingest_ts = time()
+                if recorder is not None:
+                    recorder.write(ingest_ts, msg)
+                fpga_msg_q.put((ingest_ts, msg))
 
         except KeyboardInterrupt:
             print('\r[*] Cleaning up spawned recv process')
 
+        finally:
+            if poller is not None:
+                poller.close()
+            if recorder is not None:
+                recorder.close()
+            if profiler is not None:
+                profiler.stop()
+
+    def _spawn_batch_receive_process(self, fpga_msg_q, worker_idx=0x00, \
+            stop_fd=None):
+        """
+        Drain messages from the FPGA into a preallocated buffer and place
+        them into a shared multiprocessing Queue as a single list per batch
+
+        Python does not expose recvmmsg so the batch is built by blocking
+        for the first datagram and then reading with MSG_DONTWAIT until the
+        socket is empty or the batch is full. MSG_TRUNC makes the kernel
+        report the real datagram size so truncated reads can be counted
+
+        When SO_REUSEPORT is enabled the first worker keeps the socket opened
+        by the server and all others bind their own. Note the kernel shards
+        by source address/port, so a single FPGA sender lands on one socket.
+        A stopped worker with a socket of its own drains it before closing
+
+        Keyword arguments:
+        fpga_msg_q -- a Queue used to store received messages
+        worker_idx -- the index of this worker within the pool
+        stop_fd -- the read end of a pipe that stops the worker once written
+                   to, or None
+        """
+
+        # pick the socket this worker reads from
+        if self.reuseport and worker_idx != 0x00:
+            s = self._open_socket()
+        else:
+            s = self.s
+
+        # one fixed-size slot per datagram in the batch
+        slot_sz = self.recv_sz
+        recv_buf = bytearray(slot_sz * self.batch_sz)
+        recv_view = memoryview(recv_buf)
+        msg_lens = [0x00] * self.batch_sz
+        msg_tss = [0.0] * self.batch_sz
+
+        # count of datagrams larger than a slot
+        trunc_count = 0x00
+
+        metrics_row, drops_row = self._metricsRows(s, worker_idx)
+        recorder = self._openRecorder(worker_idx)
+        profiler = start_profiler('recv.{}'.format(worker_idx))
+
+        poller = self._openPoller(s, stop_fd, recorder)
+        stopping = False
+
+        try:
+            while True:
+                batch_len = 0x00
+                flags = socket.MSG_TRUNC
+
+                # a worker that can be stopped or records waits in epoll 
+                # and never blocks in the reads themselves
+                if poller is not None:
+                    if not stopping and not self._waitReadable(poller, \
+                            stop_fd, recorder):
+                        if s is self.s:
+                            break
+                        stopping = True
+                    flags |= socket.MSG_DONTWAIT
+
+                # fill slots until the socket runs dry or the batch is full
+                while batch_len < self.batch_sz:
+                    offset = batch_len * slot_sz
+                    try:
+                        if metrics_row is None:
+                            msg_len = s.recvfrom_into( \
+                                recv_view[offset:offset + slot_sz], \
+                                slot_sz, flags)[0]
+                        else:
+                            msg_len, ancdata = s.recvmsg_into( \
+                                [recv_view[offset:offset + slot_sz]], \
+                                self.anc_buf_sz, flags)[:0x02]
+                            self._countDatagram(metrics_row, drops_row, \
+                                msg_len, msg_len > slot_sz, ancdata)
+                    except BlockingIOError:
+                        break
+                    msg_tss[batch_len] = time()
+                    if recorder is not None:
+                        recorder.write(msg_tss[batch_len], \
+                            recv_view[offset:offset + min(msg_len, slot_sz)])
+
+                    if msg_len > slot_sz:
+                        trunc_count += 0x01
+                        if args.v:
+                            print("[!] WARNING: Truncated FPGA message of " \
+                                "{} bytes ({} total)".format(msg_len, \
+                                    trunc_count))
+                        msg_len = slot_sz
+
+                    msg_lens[batch_len] = msg_len
+                    batch_len += 0x01
+
+                    # only the first read in a batch is allowed to block
+                    flags = socket.MSG_TRUNC | socket.MSG_DONTWAIT
+
+                if not batch_len:
+                    if stopping:
+                        break
+                    continue
+
+                # hand off the whole batch with a single queue put
+                fpga_msg_q.put([(msg_tss[idx], bytes(recv_view[idx * slot_sz \
+                    : idx * slot_sz + msg_lens[idx]])) \
+                    for idx in range(batch_len)])
+
+        except KeyboardInterrupt:
+            print('\r[*] Cleaning up spawned batch recv process ' \
+                '({} truncated)'.format(trunc_count))
+
+        finally:
+            if poller is not None:
+                poller.close()
+            if s is not self.s:
+                s.close()
+            if recorder is not None:
+                recorder.close()
+            if profiler is not None:
+                profiler.stop()
+
+    def _openRecorder(self, worker_idx):
+        """
+        Return the FpgaRecordWriter a worker records raw datagrams to, or 
+        None when not recording
+
+        Keyword arguments:
+        worker_idx -- the index of the worker within the pool
+        """
+
+        if self.record is None:
+            return None
+
+        return FpgaRecordWriter(self.record, worker_idx, \
+            args.record_max_bytes, args.record_max_files)
+
+    def _metricsRows(self, s, worker_idx):
+        """
+        Return the metrics row a recv worker counts into and the row its 
+        socket's kernel drop count is kept in, or (None, None)
+
+        Workers sharing the server socket would all read the same drop 
+        count, so only the first worker records it, keeping each row to a
+        single writer. The other workers on that socket get no drops row
+
+        Keyword arguments:
+        s -- the socket the worker reads from
+        worker_idx -- the index of this worker within the pool
+        """
+
+        if self.metrics is None:
+            return None, None
+
+        metrics_row = self.metrics.row('recv', worker_idx)
+        if s is self.s and worker_idx != 0x00:
+            return metrics_row, None
+        return metrics_row, metrics_row
+
+    def _countDatagram(self, metrics_row, drops_row, msg_len, truncated, \
+            ancdata):
+        """
+        Count a received datagram and pick up the kernel drop count
+
+        The kernel only attaches SO_RXQ_OVFL data once the socket has 
+        dropped something, the value is the running total for the socket
+
+        Keyword arguments:
+        metrics_row -- the recv metrics row of this worker
+        drops_row -- the recv metrics row holding the socket's drop count,
+                     or None when another worker records it
+        msg_len -- the size of the datagram
+        truncated -- whether the datagram did not fit the receive buffer
+        ancdata -- the ancillary data returned by recvmsg
+        """
+
+        metrics_row[RECV_DATAGRAMS] += 0x01
+        metrics_row[RECV_BYTES] += msg_len
+        if truncated:
+            metrics_row[RECV_TRUNCATED] += 0x01
+
+        if drops_row is None:
+            return
+
+        for cmsg_level, cmsg_type, cmsg_data in ancdata:
+            if cmsg_level == socket.SOL_SOCKET and cmsg_type == SO_RXQ_OVFL:
+                drops_row[RECV_KERNEL_DROPS] = \
+                    struct.unpack_from('I', cmsg_data)[0]
 
     def shutdown(self):
         self.s.close()
@@ -125,9 +592,13 @@ class UdpServer():
 
 class FpgaMsgProcessor():
 
-    def __init__(self):
+    def __init__(self, metrics=None, metrics_idx=0x00):
         """
         Initialize a FpgaMsgProcessor object 
+
+        Keyword arguments:
+        metrics -- the PipelineMetrics to count into, or None
+        metrics_idx -- the index of this processor's metrics row
         """
         self.xbus_msg_start_bytes = [0x04, 0x05]
         self.xbus_umas_msg_sz_offset = 0x0A
@@ -137,10 +608,67 @@ class FpgaMsgProcessor():
         self.xbus_pay_start_offset = 0x0A
         self.xbus_max_pay_sz = 0x20
         self.xbus_msg_max_sz = 0x30
-        self.xbus_msg_flag = b'\x08\x64\x01\x00\x00\x7F'
         self.uint16 = 0x02
         self.uint32 = 0x04
 
+        # reusable buffer the raw FPGA words are byteswapped in, sized for the
+        # 64 registers the FPGA sends at most
+        self.swap_words = array('I', bytes(0x100))
+        self.swap_bytes = memoryview(self.swap_words).cast('B')
+
+        # partially reassembled UMAS messages keyed by (src_id, dst_id),
+        # ordered least recently updated first
+        self.partials = OrderedDict()
+        self.max_partials = 0x40
+        self.max_partial_bytes = 0x4000
+        self.partial_bytes = 0x00
+
+        # XBUS header bytes that stay the same across all parts of one
+        # transfer, used to route continuations to their partial. In the
+        # `_extractUmasTraffic` sample byte 1 flags the last part (05/55) and
+        # byte 2 counts the parts (00/08/90), while bytes 3-4 (27 04) repeat
+        self.xbus_chan_offset = 0x03
+        self.xbus_chan_sz = 0x02
+        self.partial_chans = {}
+
+        # counters for messages completed from more than one FPGA message
+        # and for partials that were given up on
+        self.recovered_count = 0x00
+        self.dropped_partial_count = 0x00
+
+        # messages with trailing bytes that do not make up a half word
+        self.malformed_count = 0x00
+
+        # the metrics row is only looked up once running in its own process
+        self.metrics = metrics
+        self.metrics_idx = metrics_idx
+        self.metrics_row = None
+
+        # set while the spoofer's queue is congested, which sheds the debug 
+        # output to free up time for decoding
+        self.quiet = False
+
+        # UMAS function codes that go through the priority lane, which is 
+        # only handed over once running
+        self.priority_fnc_codes = frozenset(int(fnc, 0x00) \
+            for fnc in args.priority_fnc_codes.split(',') if fnc.strip())
+        self.priority_q = None
+        self.lane_ready = None
+
+        # NumPy decoder for whole batches of messages, only loaded once 
+        # running so the parent process never imports NumPy
+        self.batch_decoder = None
+
+        # XBUS message types to decode, looked up in the raw FPGA words, and 
+        # the decoder for each
+        self.xbus_signatures = XbusSignatureTable( \
+            parse_signatures(args.xbus_signatures))
+        self.xbus_decoders = {'umas': self._decodeUmasMsg}
+        for name in self.xbus_signatures.names:
+            if name not in self.xbus_decoders:
+                raise ValueError('no decoder for XBUS message type `{}`' \
+                    .format(name))
+
     # TODO: may want to flip this down the road to take the entire packet
     # TODO: this is probably already implemented in some stdlib package
     def _fix_endianess(self, input_data):
@@ -180,6 +708,46 @@ class FpgaMsgProcessor():
         # return our fixed data
         return fixed_msg
 
+    def _swapFpgaMsg(self, raw_fpga_msg):
+        """
+        Reverses the endianess of an entire UDP message from the FPGA
+
+        All of the 4-byte words are swapped with a single bulk byteswap in
+        the reusable `self.swap_words` buffer. A trailing half word is
+        handed to `_fix_endianess` so it behaves the same as before, while
+        a trailing 1 or 3 bytes cannot be swapped and are dropped, counting
+        the message as malformed
+
+        Keyword arguments:
+        raw_fpga_msg -- the raw little endian FPGA message
+        """
+
+        msg_len = len(raw_fpga_msg)
+        word_len = msg_len & ~0x03
+
+        # grow the buffer if the FPGA ever sends more than expected
+        if word_len > len(self.swap_bytes):
+            self.swap_words = array('I', bytes(word_len))
+            self.swap_bytes = memoryview(self.swap_words).cast('B')
+
+        # swap every full word in place
+        self.swap_bytes[:word_len] = raw_fpga_msg[:word_len]
+        self.swap_words.byteswap()
+        cur_fpga_msg = self.swap_bytes[:word_len].tobytes()
+
+        # swap a leftover half word the old way, anything else is not a 
+        # valid FPGA word and is dropped rather than killing the processor
+        tail_len = msg_len - word_len
+        if tail_len == self.uint16:
+            cur_fpga_msg += self._fix_endianess(raw_fpga_msg[word_len:])
+        elif tail_len:
+            self.malformed_count += 0x01
+            if args.v and not self.quiet:
+                print("[!] WARNING: Dropping {} trailing bytes of a {} byte " \
+                    "FPGA message".format(tail_len, msg_len))
+
+        return cur_fpga_msg
+
     def _extractUmasTraffic(self, xbus_umas_data):
         """
         Extract the length field and remove the size of the data before UMAS 
@@ -239,9 +807,13 @@ class FpgaMsgProcessor():
             offset=xbus_umas_src_id_offset)[0]
 
         # initialize storage variables for message processing
+        #
+        # the payload is gathered as a list of memoryview slices and joined 
+        # once at the end so only one output buffer is allocated per txn
         idx = 0x00
         last_idx = len(xbus_umas_data) - 0x01 
-        umas_txn_data = b''
+        umas_txn_parts = []
+        umas_txn_parts_sz = 0x00
 
         # handle cases where only one XBUS message exists specially
         #
@@ -251,13 +823,16 @@ class FpgaMsgProcessor():
         # READ_PROJECT_INFO which only need 0x03 bytes
         if last_idx == 0x00:
             offset = self.xbus_pay_start_offset+self.xbus_umas_hdr_sz
-            umas_txn_data = xbus_umas_data[0][offset:offset + payload_sz]
+            umas_txn_parts.append(memoryview(xbus_umas_data[0]) \
+                [offset:offset + payload_sz])
 
         # handle cases with more than one XBUS message part
         else:
             # loop over each of the messages and pull out the embedded 
             # Umas data
             for xbus_umas_msg_part in xbus_umas_data:
+                xbus_umas_msg_part = memoryview(xbus_umas_msg_part)
+
                 # on the first message we cannot pull the entire XBUS payload 
                 # as it contains information other than just Umas
                 #
@@ -265,7 +840,7 @@ class FpgaMsgProcessor():
                 # xbus Umas header as well as the start offset used for 
                 # all messages
                 if idx == 0x00:
-                    umas_txn_data = xbus_umas_msg_part[ \
+                    umas_txn_part = xbus_umas_msg_part[ \
                                       self.xbus_pay_start_offset \
                                       + self.xbus_umas_hdr_sz \
                                       : self.xbus_pay_end_offset]
@@ -277,8 +852,8 @@ class FpgaMsgProcessor():
                 # read based on the total expected compared against the 
                 # number already read
                 elif idx == last_idx:
-                    remaining_data_sz = payload_sz - len(umas_txn_data)
-                    umas_txn_data += xbus_umas_msg_part[ \
+                    remaining_data_sz = payload_sz - umas_txn_parts_sz
+                    umas_txn_part = xbus_umas_msg_part[ \
                                        self.xbus_pay_start_offset \
                                        : self.xbus_pay_start_offset \
                                        + remaining_data_sz]
@@ -291,14 +866,19 @@ class FpgaMsgProcessor():
                 # - the xbus tail may or may not exist, but we don't care 
                 #   since the data size is static
                 else:
-                    umas_txn_data += xbus_umas_msg_part[ \
+                    umas_txn_part = xbus_umas_msg_part[ \
                                        self.xbus_pay_start_offset \
                                        : self.xbus_pay_start_offset \
                                        + self.xbus_max_pay_sz]
+
+                umas_txn_parts.append(umas_txn_part)
+                umas_txn_parts_sz += len(umas_txn_part)
                 
                 # keep our counter in line
                 idx += 0x01
 
+        umas_txn_data = b''.join(umas_txn_parts)
+
         if args.v:
             if umas_txn_data == b'':
                 print("[!] ")
@@ -335,7 +915,10 @@ class FpgaMsgProcessor():
 
         # store an array of XBUS messages that will be combined to get a 
         # single UMAS message
+        #
+        # the messages are memoryview slices so splitting does not copy
         xbus_txns = []
+        cur_fpga_view = memoryview(cur_fpga_msg)
 
         # when the Umas message is greater than the maximum size possible 
         # for a single XBUS message, there will be multiple XBUS messages 
@@ -353,7 +936,7 @@ class FpgaMsgProcessor():
                 end = start + self.xbus_msg_max_sz
                 if end > cur_fpga_msg_len:
                     end = cur_fpga_msg_len
-                xbus_txns.append(cur_fpga_msg[start:end])
+                xbus_txns.append(cur_fpga_view[start:end])
 
                 if args.v:
                     # log times where the next message getting added doesn't 
@@ -369,315 +952,1919 @@ class FpgaMsgProcessor():
         # when the reported message size is smaller than the max available 
         # for one message just add it and move on
         else:
-            xbus_txns.append(cur_fpga_msg)
+            xbus_txns.append(cur_fpga_view)
 
         # return the parsed txns for processing
         return xbus_txns
 
 
-    def run(self, fpga_msg_q, xbus_msg_q):
+    def _startPartial(self, xbus_txns, ingest_ts=0.0):
         """
-        Starts the FPGA message processor
+        Begin reassembling a UMAS message from the XBUS parts carrying the
+        UMAS flag and return the `umas_txn` dict if it is already complete
+
+        Unlike `_extractUmasTraffic` every part after the first contributes 
+        at most `self.xbus_max_pay_sz` bytes, since the last part in the FPGA 
+        message is not necessarily the last part of the UMAS message
 
         Keyword arguments:
-        fpga_msg_q -- a Queue containing the raw msgs from UdpServer workers
-        xbus_msg_q -- a Queue containing processed XBUS messages
+        xbus_txns -- the XBUS messages split out of the FPGA message
+        ingest_ts -- the time the FPGA message was received
         """
 
-        # counter for verifying all expected messages have gone through
-        msg_count = 0x00
+        first_part = xbus_txns[0]
+
+        payload_sz = first_part[self.xbus_umas_msg_sz_offset] \
+            - self.xbus_umas_hdr_sz + self.xbus_umas_len_field_sz
+
+        partial = {}
+        partial['dst_id'] = first_part[0x0C]
+        partial['src_id'] = first_part[0x0D]
+        partial['payload_sz'] = payload_sz
+        partial['chan'] = bytes(first_part[self.xbus_chan_offset \
+            : self.xbus_chan_offset + self.xbus_chan_sz])
+        partial['parts'] = []
+        partial['len'] = 0x00
+        partial['fpga_msg_count'] = 0x01
+        partial['ingest_ts'] = ingest_ts
+
+        # the first part can only be treated as the whole message when the
+        # FPGA message was not split, otherwise its tail has to be skipped
+        offset = self.xbus_pay_start_offset + self.xbus_umas_hdr_sz
+        if first_part[self.xbus_umas_msg_sz_offset] <= self.xbus_max_pay_sz:
+            first_data = first_part[offset:offset + payload_sz]
+        else:
+            first_data = first_part[offset \
+                : self.xbus_msg_max_sz + self.xbus_pay_end_offset]
+        partial['parts'].append(bytes(first_data))
+        partial['len'] += len(first_data)
 
-        try:
-            # loop forever, reading and processing the next FPGA message on 
-            # each loop
-            while True:
-                # get the next UDP message from the FPGA that is sitting in 
-                # the queue
-                raw_fpga_msg = fpga_msg_q.get()
-
-                # convert the 4-byte based little endian data in the UDP 
-                # packet to the needed big endian version for later 
-                # processing
-                cur_fpga_msg = b''
-                for idx in range(0x00, len(raw_fpga_msg), self.uint32):
-                    cur_fpga_msg += self._fix_endianess( \
-                        raw_fpga_msg[idx:idx+self.uint32])
-
-                # only process messages that contain UMAS traffic at this time
-                if self.xbus_msg_flag in cur_fpga_msg:
-                    # extract the individual XBUS messages from the combined 
-                    # FPGA message
-                    xbus_txns = self._extractXbusTraffic(cur_fpga_msg)
-
-                    # print each of the split XBUS messages for debugging
-                    # only really useful for debugging
-                    if args.vv:
-                        print("[*] XBUS UMAS Message: {} packets" \
-                            .format(len(xbus_txns)))
-                        for txn in xbus_txns:
-                            print("[*]\t{}".format(txn.hex()))
-
-                    # rebuild the UMAS message from the XBUS parts
-                    umas_txn = self._extractUmasTraffic(xbus_txns)
-                    if umas_txn['payload']:
-                        # add the txn to the Umas message queue for future 
-                        # processing
-                        xbus_msg_q.put(umas_txn)
-
-                        # print debug messages if desired
-                        if args.v:
-                            # print out responses differently
-                            if umas_txn['payload'][2] == 0xFD \
-                              or umas_txn['payload'][2] == 0xFE:
-                                print("[*] UMAS Response:\t\t{}" \
-                                    .format(umas_txn['payload']))
-                            # otherwise just print out the data and fnc code
-                            else: 
-                                print("[*] UMAS Request FNC {}:\t{}" \
-                                    .format(hex(umas_txn['payload'][2]), \
-                                        umas_txn['payload']))
-
-                # keep a running count of the number of messages processed
-                # this is only remotely useful for debugging
-                msg_count += 0x01
-                if args.v:
-                    print("[*] Messages Processed: {}".format(msg_count))
+        for xbus_msg_part in xbus_txns[0x01:]:
+            self._appendPartial(partial, xbus_msg_part)
 
-        except KeyboardInterrupt:
-            print("\r[*] Cleaning up FPGA message processor")
+        if partial['len'] >= payload_sz:
+            return self._finishPartial(partial)
 
+        # a new transfer replaces anything left over for the same pair
+        flow_key = (partial['src_id'], partial['dst_id'])
+        if flow_key in self.partials:
+            self._dropPartial(flow_key)
 
-class UmasMsgSpoofer():
+        self.partials[flow_key] = partial
+        self.partial_chans[partial['chan']] = flow_key
+        self.partial_bytes += partial['len']
+        partial['last_seen'] = monotonic()
 
-    def __init__(self):
+        # stay within the memory budget by dropping the stalest partials
+        while len(self.partials) > self.max_partials \
+          or self.partial_bytes > self.max_partial_bytes:
+            self._dropPartial(next(iter(self.partials)))
+
+        return None
+
+    def _appendPartial(self, partial, xbus_msg_part):
         """
-        Initializes the UmasMsgSpoofer
+        Add the UMAS data of a continuation XBUS part to a partial message
+
+        Keyword arguments:
+        partial -- the partial message state
+        xbus_msg_part -- the continuation XBUS message
         """
-        self.mbap_len = 0x07
-        self.modbus_port = 0x01F6
 
-    def run(self, umas_msg_q):
+        remaining_data_sz = partial['payload_sz'] - partial['len']
+        if remaining_data_sz <= 0x00:
+            return
+
+        if remaining_data_sz > self.xbus_max_pay_sz:
+            remaining_data_sz = self.xbus_max_pay_sz
+
+        data = bytes(xbus_msg_part[self.xbus_pay_start_offset \
+            : self.xbus_pay_start_offset + remaining_data_sz])
+        partial['parts'].append(data)
+        partial['len'] += len(data)
+
+    def _continuePartial(self, cur_fpga_msg):
         """
-        Loops through the passed UMAS message Queue, kicking off a spoofed
-        transaction to assist in Snort traffic ingestion
+        Feed an FPGA message without the UMAS flag to the partial message it
+        continues and return the `umas_txn` dict once it is complete
+
+        Continuations are routed by the XBUS channel bytes, falling back to 
+        the most recently updated partial
 
         Keyword arguments:
-        umas_msg_q -- a Queue containing the rebuilt UMAS messages
+        cur_fpga_msg -- the byteswapped FPGA message
         """
 
-        try:
-            while True:
-                # get the next message in the queue
-                cur_umas_msg = umas_msg_q.get()
+        cur_fpga_view = memoryview(cur_fpga_msg)
+        chan = bytes(cur_fpga_view[self.xbus_chan_offset \
+            : self.xbus_chan_offset + self.xbus_chan_sz])
 
-                print(cur_umas_msg)
+        flow_key = self.partial_chans.get(chan)
+        if flow_key not in self.partials:
+            flow_key = next(reversed(self.partials))
+        partial = self.partials[flow_key]
 
-                # iterate over each of the extracted txns and spoof a 
-                # TCP stream containing the communication
-                self._spoofTransaction(cur_umas_msg['src_id'], \
-                    cur_umas_msg['dst_id'], self.modbus_port, \
-                    cur_umas_msg['payload'])
+        self.partial_bytes -= partial['len']
+        for start in range(0x00, len(cur_fpga_view), self.xbus_msg_max_sz):
+            self._appendPartial(partial, \
+                cur_fpga_view[start:start + self.xbus_msg_max_sz])
+        partial['fpga_msg_count'] += 0x01
 
-        except KeyboardInterrupt:
-            print("\r[*] Cleaning up UMAS msg spoofer server")
+        if partial['len'] >= partial['payload_sz']:
+            self._forgetPartial(flow_key)
+            return self._finishPartial(partial)
+
+        self.partial_bytes += partial['len']
+        partial['last_seen'] = monotonic()
+        self.partials.move_to_end(flow_key)
 
-    def _spoofTransaction(self, src_id, dst_id, dport, payload):
+        return None
+
+    def _finishPartial(self, partial):
         """
-        Creates spoofed TCP transactions on the specified interface 
+        Build the `umas_txn` dict for a completed partial message
 
         Keyword arguments:
-        src_id -- sending module identifier byte
-        dst_id -- receiving module identifier byte
-        dport -- port on which to spoof the transaction
-        payload -- UMAS message to send in the transaction
+        partial -- the partial message state
         """
 
-        # get a new ISN for each txn
-        src_isn = random.randint(0x400, 0xFFFFFFF)
-        dst_isn = random.randint(0x400, 0xFFFFFFF)
+        if partial['fpga_msg_count'] > 0x01:
+            self.recovered_count += 0x01
+            if args.v:
+                print("[*] Reassembled UMAS message from {} FPGA messages " \
+                    "({} recovered)".format(partial['fpga_msg_count'], \
+                        self.recovered_count))
 
-        # get a new source port for each txn
-        sport = random.randint(0x400, 0xFFFF)
+        umas_txn = {}
+        umas_txn['src_id'] = partial['src_id']
+        umas_txn['dst_id'] = partial['dst_id']
+        umas_txn['payload'] = b''.join(partial['parts'])
+        umas_txn['ingest_ts'] = partial['ingest_ts']
 
-        # get a new modbus txn id for each txn
-        trans_id = random.randint(0x01, 0xFFFF)
+        return umas_txn
 
-        # Ether
-        src_mac = "DE:AD:BE:EF:00:{:02x}".format(src_id)
-        dst_mac = "DE:AD:BE:EF:00:{:02x}".format(dst_id)
-        req_ether = Ether(src=src_mac, dst=dst_mac)
-        resp_ether = Ether(src=dst_mac, dst=src_mac)
-        # TODO: should probably make sure this exists
-        iface = args.sendinterface
+    def _forgetPartial(self, flow_key):
+        """
+        Remove a partial message from the reassembly state
 
-        # IP
-        dst = "192.168.0.{}".format(dst_id)
-        src = "192.168.0.{}".format(src_id)
-        req_ip = IP(src=src, dst=dst)
-        resp_ip = IP(src=dst, dst=src)
+        Keyword arguments:
+        flow_key -- the (src_id, dst_id) key of the partial
+        """
 
-        # SYN
-        SYN = TCP(sport=sport, \
-            dport=dport, \
-            flags='S', \
-            seq=src_isn)
-        sendp(req_ether/req_ip/SYN, iface=iface)
+        partial = self.partials.pop(flow_key)
+        if self.partial_chans.get(partial['chan']) == flow_key:
+            del self.partial_chans[partial['chan']]
+        return partial
 
-        # SYNACK
-        SYNACK = TCP(sport=dport, \
-            dport=sport, \
-            flags='SA', \
-            seq=dst_isn, \
-            ack=SYN.seq+0x01)
-        sendp(resp_ether/resp_ip/SYNACK, iface=iface)
+    def _dropPartial(self, flow_key):
+        """
+        Give up on a partial message
 
-        # ACK
-        ACK = TCP(sport=sport, \
-            dport=dport, \
-            flags='A', \
-            seq=SYNACK.ack, \
-            ack=SYNACK.seq+0x01)
-        sendp(req_ether/req_ip/ACK, iface=iface)
+        Keyword arguments:
+        flow_key -- the (src_id, dst_id) key of the partial
+        """
 
-        # XBUS Message
-        payload_layer = Raw(payload)
-        XBUSUMAS = TCP(sport=sport, dport=dport, flags='PA', seq=SYNACK.ack, ack=SYNACK.seq+0x01)/ModbusADURequest(trans_id=trans_id)/payload_layer
-        sendp(req_ether/req_ip/XBUSUMAS, iface=iface)
+        partial = self._forgetPartial(flow_key)
+        self.partial_bytes -= partial['len']
+        self.dropped_partial_count += 0x01
 
-        # XBUS Message ACK
-        XBUSUMASACK = TCP(sport=dport, \
-            dport=sport, \
-            flags='A', \
-            seq=XBUSUMAS.ack, \
-            ack=XBUSUMAS.seq+len(payload_layer)+MBAPLEN)
-        sendp(resp_ether/resp_ip/XBUSUMASACK, iface=iface)
+        if args.v:
+            print("[!] WARNING: Dropping partial UMAS message {:02x} -> " \
+                "{:02x} with {} of {} bytes".format(partial['src_id'], \
+                    partial['dst_id'], partial['len'], partial['payload_sz']))
 
-        #
-        # RST teardown
-        # tearing down to prevent Snort from combining streams
-        #
+    def _expirePartials(self):
+        """
+        Drop partial messages that have not been continued within 
+        --reassembly_timeout
+        """
 
-        # FINACK
-        FINACK = TCP(sport=sport, \
-            dport=dport, \
-            flags='FA', \
-            seq=XBUSUMASACK.seq, \
-            ack=XBUSUMASACK.ack)
-        sendp(req_ether/req_ip/FINACK, iface=iface)
+        now = monotonic()
+        while self.partials:
+            flow_key, partial = next(iter(self.partials.items()))
+            if now - partial['last_seen'] <= args.reassembly_timeout:
+                break
+            self._dropPartial(flow_key)
 
-        # LASTACK
-        LASTACK = TCP(sport=dport, \
-            dport=sport, \
-            flags='A', \
-            seq=FINACK.ack, \
-            ack=FINACK.seq+0x01)
-        sendp(resp_ether/resp_ip/LASTACK, iface=iface)
+    def _matchXbusType(self, raw_fpga_msg):
+        """
+        Return a (type, cur_fpga_msg) tuple naming the XBUS message type 
+        found in a raw FPGA message, or None as the type. cur_fpga_msg is 
+        the big endian message if it had to be swapped already, or None
 
-        # RSTACK
-        RSTACK = TCP(sport=dport, \
-            dport=sport, \
-            flags='RA', \
-            seq=LASTACK.seq, \
-            ack=LASTACK.ack)
-        sendp(resp_ether/resp_ip/RSTACK, iface=iface)
+        Keyword arguments:
+        raw_fpga_msg -- the raw little endian FPGA message
+        """
 
+        # the signatures only line up with whole words, so a message with a 
+        # trailing partial word is swapped first
+        if len(raw_fpga_msg) & 0x03:
+            cur_fpga_msg = self._swapFpgaMsg(raw_fpga_msg)
+            return self.xbus_signatures.match_swapped(cur_fpga_msg), \
+                cur_fpga_msg
 
-def main():
-    """
-    Kicks off the following:
-       * UdpServer to receive messages from the FGPA
-       * FpgaMsgProcessor to extract XBUS messages from raw FPGA messages
-       * UmasMsgSpoofer to take processed XBUS messages and send them to Snort
-    """
+        return self.xbus_signatures.match(raw_fpga_msg), None
 
-    # queue to hold raw messages from the FPGA
-    fpga_msg_q = Queue()
+    def _decodeFpgaMsg(self, raw_fpga_msg, ingest_ts=0.0):
+        """
+        Convert a single raw FPGA message and return the UMAS transaction
+        found within it, or None
 
-    # queue to hold cleaned up raw XBUS messages broken out of the FPGA msgs
-    xbus_msg_q = Queue()
+        Messages are matched against the XBUS signatures before being byte
+        swapped, so the ones no decoder wants are discarded cheaply
 
-    # queue to keep track of how many messages have been processed
-    # 
-    # it is initialized at 0x00 as it will get incremented each time a 
-    # message is processed successfully
-    # 
-    # NOTE: probably don't need this outside of testing
-    msg_count_q = Queue()
-    msg_count_q.put(0x00)
+        Keyword arguments:
+        raw_fpga_msg -- a raw little endian message from the FPGA
+        ingest_ts -- the time the FPGA message was received
+        """
 
-    # server object to handle requests from the FPGA
-    #
-    # there should only ever be one of these unless we start using multiple 
-    # ports for faster data transfer
-    server = UdpServer(lhost=args.lhost, lport=args.lport)
+        if args.reassemble:
+            self._expirePartials()
+
+        xbus_type, cur_fpga_msg = self._matchXbusType(raw_fpga_msg)
+
+        if xbus_type is not None:
+            # convert the 4-byte based little endian data in the UDP 
+            # packet to the needed big endian version for later 
+            # processing
+            if cur_fpga_msg is None:
+                cur_fpga_msg = self._swapFpgaMsg(raw_fpga_msg)
+            return self.xbus_decoders[xbus_type](cur_fpga_msg, ingest_ts)
+
+        # messages without the flag may carry the rest of a UMAS message 
+        # that did not fit in the previous FPGA message, the first big 
+        # endian byte being the last byte of the first raw word
+        if args.reassemble and self.partials and raw_fpga_msg:
+            if cur_fpga_msg is None:
+                if len(raw_fpga_msg) < self.uint32 or raw_fpga_msg[0x03] \
+                        not in self.xbus_msg_start_bytes:
+                    return None
+                cur_fpga_msg = self._swapFpgaMsg(raw_fpga_msg)
+            if cur_fpga_msg[0] in self.xbus_msg_start_bytes:
+                return self._continuePartial(cur_fpga_msg)
+
+        return None
+
+    def _decodeUmasMsg(self, cur_fpga_msg, ingest_ts):
+        """
+        Return the UMAS transaction found in an FPGA message carrying the
+        UMAS flag, or None while it is still being reassembled
 
-    # message processor to take raw FPGA messages and extract XBUS messages
-    fpga_msg_processor = FpgaMsgProcessor()
+        Keyword arguments:
+        cur_fpga_msg -- the big endian FPGA message
+        ingest_ts -- the time the FPGA message was received
+        """
 
-    # processor to take extracted Umas messages and prepare/send them across 
-    # the wire to Snort
-    umas_msg_spoofer = UmasMsgSpoofer()
+        # extract the individual XBUS messages from the combined 
+        # FPGA message
+        xbus_txns = self._extractXbusTraffic(cur_fpga_msg)
+
+        # print each of the split XBUS messages for debugging
+        # only really useful for debugging
+        if args.vv and not self.quiet:
+            print("[*] XBUS UMAS Message: {} packets" \
+                .format(len(xbus_txns)))
+            for txn in xbus_txns:
+                print("[*]\t{}".format(txn.hex()))
+
+        # rebuild the UMAS message from the XBUS parts
+        if args.reassemble:
+            return self._startPartial(xbus_txns, ingest_ts)
+        umas_txn = self._extractUmasTraffic(xbus_txns)
+        umas_txn['ingest_ts'] = ingest_ts
+        return umas_txn
 
-    # begin processing
-    try:
-        # create a process in which to run the UDP server
-        #
-        # this will listen for traffic from the FPGA
-        #
-        # a separate process is used as the FPGA is going to send traffic 
-        # as fast as it can, which is usually faster than we can receive 
-        #
-        # a queue is used to store the messages because they are going need 
-        # to be accessed by a differrent process
-        server_p = Process(target=server.serve_forever, \
-            args=(fpga_msg_q, args.recvworker_count))
-        server_p.start()
+    def _countFpgaMsg(self, umas_txn):
+        """
+        Count a decoded FPGA message in the metrics row
 
-        # create a process to run the FPGA message processor
-        #
-        # this is needed because we can't spend the time to process each 
-        # message on the fly
-        #
-        # data is transferred between the server and the processor via the 
-        # fpga_msg_q
-        #
-        # messages extracted from the FPGA messages are put into the 
-        # xbus_msg_q for later processing
-        #
-        # a msg_count_q is kept for testing purposes to ensure all sent 
-        # messages are processed
-        #
-        # NOTE: may need to build a pool of these if the queue gets too big
-        fpga_msg_processor_p = Process(target=fpga_msg_processor.run, \
-            args=(fpga_msg_q, xbus_msg_q, ))
-        fpga_msg_processor_p.start()
+        Keyword arguments:
+        umas_txn -- the UMAS transaction decoded from it, or None
+        """
 
-        # create a process to handle sending of prepared UMAS messages from 
-        # the queue
-        #
-        # each queue entry will contain a dict with the following keys:
-        #  - src_id: the one byte src field from the request packet, 
-        #            converted to an int
-        #  - dst_id: the one byte dst field from the request packet, 
-        #            converted to an int
-        #  - payload: a bytestring containing the entire message, built from 
-        #             multiple XBUS messages where necessary
-        umas_msg_spoofer_p = Process(target=umas_msg_spoofer.run, \
-            args=(xbus_msg_q, ))
-        umas_msg_spoofer_p.start()
+        metrics_row = self.metrics_row
+        metrics_row[DECODE_FPGA_MSGS] += 0x01
 
-        # block for the sub processes to finish
-        server_p.join()
-        fpga_msg_processor_p.join()
-        umas_msg_spoofer_p.join()
+        if umas_txn is not None:
+            payload = umas_txn['payload']
+            if not payload:
+                metrics_row[DECODE_EMPTY_PAYLOADS] += 0x01
+            else:
+                metrics_row[DECODE_UMAS_TXNS] += 0x01
+                if len(payload) > 0x02:
+                    metrics_row[DECODE_FNC_CODES + payload[2]] += 0x01
+                if umas_txn.get('priority'):
+                    metrics_row[DECODE_PRIORITY_TXNS] += 0x01
 
-    # catch CTRL+C
-    except KeyboardInterrupt:
-        print("\r[*] Exiting...")
+        metrics_row[DECODE_REASSEMBLED] = self.recovered_count
+        metrics_row[DECODE_DROPPED_PARTIALS] = self.dropped_partial_count
 
-    # make sure to clean up the server if needed
-    finally:
-        server.shutdown()
+    def _classifyUmasTxn(self, umas_txn):
+        """
+        Tag a UMAS transaction as priority when its function code is one of
+        --priority_fnc_codes and return the tag
+
+        Keyword arguments:
+        umas_txn -- a dict holding the src_id, dst_id and payload
+        """
+
+        payload = umas_txn['payload']
+        priority = len(payload) > 0x02 \
+            and payload[2] in self.priority_fnc_codes
+        umas_txn['priority'] = priority
+        return priority
+
+    def _openBatchDecoder(self):
+        """
+        Return the decoder for whole batches of messages picked by 
+        --batch_decoder, or None to decode one message at a time
+        """
+
+        # debug output and reassembly both work one message at a time
+        if args.batch_decoder == 'python' or args.v or args.vv \
+          or args.reassemble:
+            return None
+
+        from batch_decoder import FpgaBatchDecoder, HAVE_NUMPY
+        if HAVE_NUMPY:
+            return FpgaBatchDecoder(self)
+        if args.batch_decoder == 'numpy':
+            print("[!] WARNING: NumPy is not installed, decoding one FPGA " \
+                "message at a time")
+        return None
+
+    def _processFpgaMsgs(self, raw_fpga_msgs, xbus_msg_q):
+        """
+        Convert a batch of raw FPGA messages and queue the UMAS transactions
+        found within them
+
+        Keyword arguments:
+        raw_fpga_msgs -- a list of (ingest_ts, raw FPGA message) tuples
+        xbus_msg_q -- a Queue containing processed XBUS messages
+        """
+
+        if self.batch_decoder is None \
+          or len(raw_fpga_msgs) < args.batch_decoder_min:
+            for ingest_ts, raw_fpga_msg in raw_fpga_msgs:
+                self._processFpgaMsg(raw_fpga_msg, xbus_msg_q, ingest_ts)
+            return
+
+        for umas_txn in self.batch_decoder.decode(raw_fpga_msgs):
+            self._queueUmasTxn(umas_txn, xbus_msg_q)
+
+    def _processFpgaMsg(self, raw_fpga_msg, xbus_msg_q, ingest_ts=0.0):
+        """
+        Convert a single raw FPGA message and queue any UMAS transaction
+        found within it
+
+        Keyword arguments:
+        raw_fpga_msg -- a raw little endian message from the FPGA
+        xbus_msg_q -- a Queue containing processed XBUS messages
+        ingest_ts -- the time the FPGA message was received
+        """
+
+        # the watermark check is only worth its cost when there is debug 
+        # output to shed
+        if args.v or args.vv:
+            self.quiet = xbus_msg_q.congested()
+
+        umas_txn = self._decodeFpgaMsg(raw_fpga_msg, ingest_ts)
+        self._queueUmasTxn(umas_txn, xbus_msg_q)
+
+    def _queueUmasTxn(self, umas_txn, xbus_msg_q):
+        """
+        Count the result of decoding one FPGA message and queue the UMAS 
+        transaction found within it, if any
+
+        Keyword arguments:
+        umas_txn -- the decoded UMAS transaction, or None
+        xbus_msg_q -- a Queue containing processed XBUS messages
+        """
+
+        if umas_txn and umas_txn['payload']:
+            self._classifyUmasTxn(umas_txn)
+        if self.metrics_row is not None:
+            self._countFpgaMsg(umas_txn)
+
+        if umas_txn and umas_txn['payload']:
+            # add the txn to the Umas message queue for future 
+            # processing
+            #
+            # security critical commands skip the backlog of routine 
+            # traffic and are never shed
+            if umas_txn['priority'] and self.priority_q is not None:
+                queued = self.priority_q.put(umas_txn)
+            else:
+                queued = xbus_msg_q.put(umas_txn)
+
+            # wake the spoofer, which waits on both lanes at once, only for 
+            # a message it will find, as a stale wakeup costs it a settle
+            if queued and self.lane_ready is not None:
+                self.lane_ready.release()
+
+            # print debug messages if desired
+            if args.v and not self.quiet:
+                # print out responses differently
+                if umas_txn['payload'][2] == 0xFD \
+                  or umas_txn['payload'][2] == 0xFE:
+                    print("[*] UMAS Response:\t\t{}" \
+                        .format(umas_txn['payload']))
+                # otherwise just print out the data and fnc code
+                else: 
+                    print("[*] UMAS Request FNC {}:\t{}" \
+                        .format(hex(umas_txn['payload'][2]), \
+                            umas_txn['payload']))
+
+    def run(self, fpga_msg_q, xbus_msg_q, priority_q=None, lane_ready=None):
+        """
+        Starts the FPGA message processor
+
+        Keyword arguments:
+        fpga_msg_q -- a Queue containing the raw msgs from UdpServer workers
+        xbus_msg_q -- a Queue containing processed XBUS messages
+        priority_q -- a Queue for the XBUS messages of the priority lane, or
+                      None to send everything through xbus_msg_q
+        lane_ready -- a Semaphore released for every message queued in 
+                      either lane, or None without a priority lane
+        """
+
+        # counter for verifying all expected messages have gone through
+        msg_count = 0x00
+
+        self.priority_q = priority_q
+        self.lane_ready = lane_ready
+        self.batch_decoder = self._openBatchDecoder()
+
+        if self.metrics is not None:
+            self.metrics_row = self.metrics.row('decode', self.metrics_idx)
+
+        profiler = start_profiler('decode.{}'.format(self.metrics_idx))
+
+        try:
+            # loop forever, reading and processing the next FPGA message on 
+            # each loop
+            while True:
+                # shared memory rings are read in place and only handed 
+                # back once every message has been processed
+                if isinstance(fpga_msg_q, (ShmRing, ShmRingSet)):
+                    raw_fpga_msgs = fpga_msg_q.get_views()
+                    self._processFpgaMsgs(raw_fpga_msgs, xbus_msg_q)
+                    fpga_msg_q.release(len(raw_fpga_msgs))
+
+                    msg_count += len(raw_fpga_msgs)
+                    if args.v and not self.quiet:
+                        print("[*] Messages Processed: {}".format(msg_count))
+                    continue
+
+                # get the next UDP message from the FPGA that is sitting in 
+                # the queue
+                #
+                # each entry is an (ingest_ts, msg) tuple and batch receive 
+                # workers queue a list of them per put
+                raw_fpga_msgs = fpga_msg_q.get()
+                if not isinstance(raw_fpga_msgs, list):
+                    raw_fpga_msgs = [raw_fpga_msgs]
+
+                if self.batch_decoder is not None:
+                    self._processFpgaMsgs(raw_fpga_msgs, xbus_msg_q)
+                    continue
+
+                for ingest_ts, raw_fpga_msg in raw_fpga_msgs:
+                    self._processFpgaMsg(raw_fpga_msg, xbus_msg_q, ingest_ts)
+
+                    # keep a running count of the number of messages 
+                    # processed, this is only remotely useful for debugging
+                    msg_count += 0x01
+                    if args.v and not self.quiet:
+                        print("[*] Messages Processed: {}".format(msg_count))
+
+        except KeyboardInterrupt:
+            print("\r[*] Cleaning up FPGA message processor")
+            if args.reassemble:
+                print("[*] Reassembly: {} recovered, {} dropped" \
+                    .format(self.recovered_count, \
+                        self.dropped_partial_count))
+            if self.malformed_count:
+                print("[*] Malformed FPGA messages: {} with a partial " \
+                    "trailing word".format(self.malformed_count))
+
+        finally:
+            if profiler is not None:
+                profiler.stop()
+
+
+class FpgaMsgDispatcher():
+
+    def __init__(self):
+        """
+        Initialize a FpgaMsgDispatcher object
+
+        The offsets below point into the raw little endian FPGA message, so
+        the module IDs at 0x0C/0x0D and the start of the UMAS flag at 0x14 
+        of the byteswapped message can be read without swapping anything
+        """
+        self.raw_dst_id_offset = 0x0F
+        self.raw_src_id_offset = 0x0E
+        self.raw_flag_offset = 0x14
+        self.raw_flag = b'\x00\x01\x64\x08'
+
+        # shard used by the last UMAS message, FPGA messages without a UMAS 
+        # header follow it so continuations stay with their first part
+        self.last_shard = 0x00
+
+    def _shard(self, raw_fpga_msg, shard_count):
+        """
+        Pick the processor shard for a raw FPGA message
+
+        The hash is symmetric in src_id and dst_id so a request and its 
+        response are decoded in order by the same processor
+
+        Keyword arguments:
+        raw_fpga_msg -- a raw little endian message from the FPGA
+        shard_count -- the number of processors
+        """
+
+        flag_end = self.raw_flag_offset + len(self.raw_flag)
+        if raw_fpga_msg[self.raw_flag_offset:flag_end] == self.raw_flag:
+            self.last_shard = (raw_fpga_msg[self.raw_src_id_offset] \
+                + raw_fpga_msg[self.raw_dst_id_offset]) % shard_count
+
+        return self.last_shard
+
+    def run(self, fpga_msg_q, shard_qs):
+        """
+        Starts the dispatcher feeding a pool of FpgaMsgProcessors
+
+        Keyword arguments:
+        fpga_msg_q -- a Queue containing the (ingest_ts, msg) tuples from the
+                      UdpServer workers
+        shard_qs -- a list with one Queue per FpgaMsgProcessor
+        """
+
+        shard_count = len(shard_qs)
+        profiler = start_profiler('dispatch')
+
+        try:
+            while True:
+                # read the next batch of messages, in place for shared 
+                # memory rings
+                if isinstance(fpga_msg_q, ShmRingSet):
+                    raw_fpga_msgs = fpga_msg_q.get_views()
+                else:
+                    raw_fpga_msgs = fpga_msg_q.get()
+                    if not isinstance(raw_fpga_msgs, list):
+                        raw_fpga_msgs = [raw_fpga_msgs]
+
+                # group the batch per shard so each shard gets one put
+                shard_batches = [[] for _ in range(shard_count)]
+                for fpga_msg in raw_fpga_msgs:
+                    shard_batches[self._shard(fpga_msg[1], shard_count)] \
+                        .append(fpga_msg)
+
+                for shard_idx, shard_batch in enumerate(shard_batches):
+                    if shard_batch:
+                        shard_qs[shard_idx].put(shard_batch)
+
+                if isinstance(fpga_msg_q, ShmRingSet):
+                    fpga_msg_q.release(len(raw_fpga_msgs))
+
+        except KeyboardInterrupt:
+            print("\r[*] Cleaning up FPGA message dispatcher")
+
+        finally:
+            if profiler is not None:
+                profiler.stop()
+
+
+class UmasMsgSpoofer():
+
+    def __init__(self, metrics=None, source_id=0x00):
+        """
+        Initializes the UmasMsgSpoofer
+
+        Keyword arguments:
+        metrics -- the PipelineMetrics to count into, or None
+        source_id -- the FPGA source whose synthetic addresses and outputs 
+                     are used
+        """
+        self.mbap_len = 0x07
+        self.source_id = source_id
+        self.modbus_port = 0x01F6
+        self.emitter = None
+
+        # persistent flows keyed by (src_id, dst_id)
+        self.flows = {}
+        self.flow_sweep_interval = 1.0
+        self.last_flow_sweep = 0.0
+
+        # UMAS function codes used by responses
+        self.umas_response_codes = (0xFD, 0xFE)
+
+        # how long to keep looking for the message behind a wakeup before 
+        # taking the wakeup as spurious, and how often to look meanwhile
+        self.lane_settle_interval = 0.01
+        self.lane_poll_interval = 0.0005
+
+        # requests still waiting on a response, keyed by (client_id, 
+        # server_id) and ordered oldest pair first
+        #
+        # both the number of pairs and the requests per pair are capped so 
+        # a module that never answers cannot grow the table
+        self.pending_requests = OrderedDict()
+        self.max_pending_pairs = 0x400
+        self.max_pending_per_pair = 0x08
+        self.unmatched_responses = 0x00
+
+        # when requests suppressed by deduplication were seen, keyed the 
+        # same way, so their responses are suppressed along with them
+        self.suppressed_requests = {}
+
+        # the metrics row is only looked up once running in its own process
+        self.metrics = metrics
+        self.metrics_row = None
+
+        # repeats of recently spoofed transactions are suppressed when 
+        # --dedup_window is set
+        self.dedup = None
+        if args.dedup_window > 0.0:
+            self.dedup = UmasDedupCache(args.dedup_window, \
+                args.dedup_max_bytes, args.dedup_summary_interval)
+
+        # every transaction taken off the queue is indexed for forensic 
+        # queries when --txn_store is set
+        self.txn_store = None
+        if args.txn_store is not None:
+            self.txn_store = UmasTxnStore( \
+                source_path(args.txn_store, source_id), \
+                args.txn_store_segment_secs, args.txn_store_segment_bytes, \
+                args.txn_store_max_segments)
+
+    def _open_emitter(self):
+        """
+        Create the configured frame emitter
+
+        This happens inside the spoofer process so the send socket is never
+        shared with the parent
+        """
+
+        # TODO: should probably make sure this exists
+        iface = args.sendinterface
+
+        if args.emitter == 'scapy':
+            # scapy takes seconds to import, so only load it when asked to
+            from scapy_emitter import ScapyEmitter
+            return ScapyEmitter(iface, source_id=self.source_id)
+        if args.emitter == 'capture':
+            return CaptureSocketEmitter(source_path(args.capture_socket, \
+                self.source_id), source_id=self.source_id)
+        if args.emitter == 'pcapng':
+            return PcapngEmitter(source_path(args.pcap_prefix, \
+                self.source_id), args.pcap_max_bytes, args.pcap_rotate_secs, \
+                source_id=self.source_id)
+        if args.emitter == 'stream':
+            return PcapStreamEmitter(source_path(args.stream_path, \
+                self.source_id), args.stream_max_buffered, \
+                source_id=self.source_id)
+        return RawSocketEmitter(iface, source_id=self.source_id)
+
+    def run(self, umas_msg_q, priority_q=None, lane_ready=None):
+        """
+        Loops through the passed UMAS message Queue, kicking off a spoofed
+        transaction to assist in Snort traffic ingestion
+
+        Keyword arguments:
+        umas_msg_q -- a Queue containing the rebuilt UMAS messages
+        priority_q -- a Queue of priority UMAS messages, always drained
+                      before umas_msg_q, or None
+        lane_ready -- a Semaphore released for every message queued in 
+                      either lane, needed with priority_q
+        """
+
+        if self.metrics is not None:
+            self.metrics_row = self.metrics.row('emit')
+
+        profiler = start_profiler('emit')
+
+        try:
+            self.emitter = self._open_emitter()
+
+            while True:
+                # get the next message in the queue
+                #
+                # persistent flows and outstanding requests need a timeout 
+                # so idle ones still get cleaned up when no traffic arrives,
+                # as do frames held back by the emitter so they still go out
+                try:
+                    timeout = None
+                    if args.session_mode == 'persistent' \
+                      or args.correlate_responses \
+                      or self.emitter.holds_frames:
+                        timeout = self.flow_sweep_interval
+
+                    if priority_q is not None:
+                        cur_umas_msg = self._nextUmasMsg(umas_msg_q, \
+                            priority_q, lane_ready, timeout)
+                    else:
+                        cur_umas_msg = umas_msg_q.get(timeout=timeout)
+                except Empty:
+                    self._expireFlows()
+                    if self.metrics_row is not None:
+                        self._countEmitter()
+                    continue
+
+                if args.v:
+                    print(cur_umas_msg)
+
+                # iterate over each of the extracted txns and spoof a 
+                # TCP stream containing the communication
+                self._spoofUmasMsg(cur_umas_msg)
+                if self.metrics_row is not None:
+                    self._countUmasMsg(cur_umas_msg)
+                self._expireFlows()
+
+        except KeyboardInterrupt:
+            print("\r[*] Cleaning up UMAS msg spoofer server")
+
+        finally:
+            self.shutdown()
+            if profiler is not None:
+                profiler.stop()
+
+    def shutdown(self):
+        """
+        Close out any open flows so Snort sees them end and close the
+        emitter
+        """
+
+        if self.emitter is not None:
+            self.emitter.set_timestamp(None)
+            for flow_key in list(self.pending_requests):
+                self._dropPendingRequests(flow_key)
+            for flow_key in list(self.flows):
+                self._closeFlow(flow_key)
+            self.emitter.flush()
+            self.emitter.close()
+            self.emitter = None
+
+        if self.dedup is not None:
+            self._writeDedupSummary(self.dedup.summary(force=True))
+
+        if self.txn_store is not None:
+            self.txn_store.close()
+
+    def _writeDedupSummary(self, record):
+        """
+        Record how often each suppressed transaction repeated, either in
+        --dedup_summary_file or on stdout
+
+        Keyword arguments:
+        record -- a summary from UmasDedupCache.summary, or None
+        """
+
+        if record is None:
+            return
+
+        if args.dedup_summary_file is not None:
+            with open(args.dedup_summary_file, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            return
+
+        print("[*] Suppressed {} repeated UMAS transactions over the last " \
+            "{:.0f}s".format(record['suppressed'], record['interval']))
+        for repeat in record['repeats']:
+            fnc = '--' if repeat['fnc'] is None \
+                else '{:02x}'.format(repeat['fnc'])
+            print("[*]\t{:02x} -> {:02x} FNC {}: {}".format(repeat['src_id'], \
+                repeat['dst_id'], fnc, repeat['suppressed']))
+
+    def _nextUmasMsg(self, umas_msg_q, priority_q, lane_ready, timeout=None):
+        """
+        Return the next UMAS message, taking any waiting in the priority lane
+        before the routine ones
+
+        The processors release `lane_ready` once per message they add to 
+        either lane, but not for the ones shed, so this sleeps on it rather 
+        than polling both queues. Messages the spoofer's own end of a ring 
+        skips with drop_oldest take their wakeups back with them
+
+        Keyword arguments:
+        umas_msg_q -- a Queue containing the rebuilt UMAS messages
+        priority_q -- a Queue of priority UMAS messages
+        lane_ready -- a Semaphore released for every message queued in 
+                      either lane
+        timeout -- the maximum number of seconds to wait, None for forever
+        """
+
+        if not lane_ready.acquire(True, timeout):
+            raise Empty
+
+        # a Queue's feeder thread may not have flushed the message into its 
+        # pipe yet, so look for a short while before giving up on the wakeup
+        deadline = monotonic() + self.lane_settle_interval
+        while True:
+            try:
+                umas_txn = priority_q.get(block=False)
+                umas_txn['priority'] = True
+                return umas_txn
+            except Empty:
+                pass
+
+            try:
+                umas_txn = umas_msg_q.get(block=False)
+            except Empty:
+                if monotonic() >= deadline:
+                    raise
+                sleep(self.lane_poll_interval)
+                continue
+
+            # the wakeups of skipped messages are taken back
+            for _ in range(umas_msg_q.take_evicted()):
+                lane_ready.acquire(False)
+            return umas_txn
+
+    def _countUmasMsg(self, umas_txn):
+        """
+        Count a spoofed UMAS message and its ingest to emit latency in the
+        metrics row
+
+        Keyword arguments:
+        umas_txn -- a dict holding the src_id, dst_id, payload and ingest_ts
+        """
+
+        metrics_row = self.metrics_row
+        metrics_row[EMIT_UMAS_TXNS] += 0x01
+        self._countEmitter()
+
+        priority = umas_txn.get('priority')
+        if priority:
+            metrics_row[EMIT_PRIORITY_TXNS] += 0x01
+
+        ingest_ts = umas_txn.get('ingest_ts')
+        if ingest_ts:
+            latency_us = max(int((time() - ingest_ts) * 1e6), 0x00)
+            metrics_row[EMIT_LATENCY_SUM_US] += latency_us
+            metrics_row[latency_bucket(latency_us)] += 0x01
+            if priority:
+                metrics_row[EMIT_PRIORITY_LATENCY_SUM_US] += latency_us
+                metrics_row[latency_bucket(latency_us, \
+                    EMIT_PRIORITY_LATENCY_BUCKETS)] += 0x01
+
+    def _countEmitter(self):
+        """
+        Copy the running totals of the emitter into the metrics row
+        """
+
+        metrics_row = self.metrics_row
+        emitter = self.emitter
+        metrics_row[EMIT_FRAMES] = emitter.frames_sent
+        metrics_row[EMIT_DROPPED_FRAMES] = emitter.dropped_frames
+        metrics_row[EMIT_DROPPED_BYTES] = emitter.dropped_bytes
+        metrics_row[EMIT_BUFFERED_BYTES] = emitter.buffered_bytes
+        if self.dedup is not None:
+            metrics_row[EMIT_SUPPRESSED_TXNS] = self.dedup.suppressed_count
+
+    def _openFlow(self, src_id, dst_id, dport):
+        """
+        Queue a spoofed 3-way handshake and return the state of the new flow
+
+        Keyword arguments:
+        src_id -- sending module identifier byte
+        dst_id -- receiving module identifier byte
+        dport -- port on which to spoof the flow
+        """
+
+        # get a new ISN for each flow
+        src_isn = random.randint(0x400, 0xFFFFFFF)
+        dst_isn = random.randint(0x400, 0xFFFFFFF)
+
+        # get a new source port for each flow
+        sport = random.randint(0x400, 0xFFFF)
+
+        # flow state, seq numbers are the next ones each side will send
+        flow = {}
+        flow['src_id'] = src_id
+        flow['dst_id'] = dst_id
+        flow['sport'] = sport
+        flow['dport'] = dport
+        flow['src_seq'] = (src_isn + 0x01) & 0xFFFFFFFF
+        flow['dst_seq'] = (dst_isn + 0x01) & 0xFFFFFFFF
+        flow['trans_id'] = random.randint(0x01, 0xFFFF)
+        flow['msg_count'] = 0x00
+        flow['last_seen'] = monotonic()
+
+        emitter = self.emitter
+
+        # SYN
+        emitter.add_frame(src_id, dst_id, sport, dport, src_isn, 0x00, \
+            TCP_SYN)
+
+        # SYNACK
+        emitter.add_frame(dst_id, src_id, dport, sport, dst_isn, \
+            flow['src_seq'], TCP_SYN | TCP_ACK)
+
+        # ACK
+        emitter.add_frame(src_id, dst_id, sport, dport, flow['src_seq'], \
+            flow['dst_seq'], TCP_ACK)
+
+        return flow
+
+    def _sendFlowMessage(self, flow, payload):
+        """
+        Queue a Modbus/TCP data segment and its ACK on an open flow
+
+        Keyword arguments:
+        flow -- the flow state returned by `_openFlow`
+        payload -- UMAS message to send in the flow
+        """
+
+        src_id = flow['src_id']
+        dst_id = flow['dst_id']
+        sport = flow['sport']
+        dport = flow['dport']
+        trans_id = flow['trans_id']
+        next_src_seq = (flow['src_seq'] + len(payload) + self.mbap_len) \
+            & 0xFFFFFFFF
+
+        # XBUS Message
+        self.emitter.add_frame(src_id, dst_id, sport, dport, \
+            flow['src_seq'], flow['dst_seq'], TCP_PSH | TCP_ACK, \
+            trans_id, payload)
+
+        # XBUS Message ACK
+        self.emitter.add_frame(dst_id, src_id, dport, sport, \
+            flow['dst_seq'], next_src_seq, TCP_ACK)
+
+        flow['src_seq'] = next_src_seq
+        flow['trans_id'] = trans_id % 0xFFFF + 0x01
+        flow['msg_count'] += 0x01
+        flow['last_seen'] = monotonic()
+
+        return trans_id
+
+    def _sendFlowResponse(self, flow, trans_id, payload):
+        """
+        Queue a Modbus/TCP response segment from the server side of a flow
+        and the client's ACK
+
+        Keyword arguments:
+        flow -- the flow state returned by `_openFlow`
+        trans_id -- the Modbus transaction ID of the request being answered
+        payload -- UMAS response to send in the flow
+        """
+
+        src_id = flow['src_id']
+        dst_id = flow['dst_id']
+        sport = flow['sport']
+        dport = flow['dport']
+        next_dst_seq = (flow['dst_seq'] + len(payload) + self.mbap_len) \
+            & 0xFFFFFFFF
+
+        # UMAS Response
+        self.emitter.add_frame(dst_id, src_id, dport, sport, \
+            flow['dst_seq'], flow['src_seq'], TCP_PSH | TCP_ACK, \
+            trans_id, payload)
+
+        # UMAS Response ACK
+        self.emitter.add_frame(src_id, dst_id, sport, dport, \
+            flow['src_seq'], next_dst_seq, TCP_ACK)
+
+        flow['dst_seq'] = next_dst_seq
+        flow['last_seen'] = monotonic()
+
+    def _teardownFlow(self, flow):
+        """
+        Queue the FIN/ACK and RST teardown for a flow
+
+        tearing down to prevent Snort from combining streams
+
+        Keyword arguments:
+        flow -- the flow state returned by `_openFlow`
+        """
+
+        src_id = flow['src_id']
+        dst_id = flow['dst_id']
+        sport = flow['sport']
+        dport = flow['dport']
+        fin_ack = (flow['src_seq'] + 0x01) & 0xFFFFFFFF
+
+        # FINACK
+        self.emitter.add_frame(src_id, dst_id, sport, dport, \
+            flow['src_seq'], flow['dst_seq'], TCP_FIN | TCP_ACK)
+
+        # LASTACK
+        self.emitter.add_frame(dst_id, src_id, dport, sport, \
+            flow['dst_seq'], fin_ack, TCP_ACK)
+
+        # RSTACK
+        self.emitter.add_frame(dst_id, src_id, dport, sport, \
+            flow['dst_seq'], fin_ack, TCP_RST | TCP_ACK)
+
+    def _closeFlow(self, flow_key):
+        """
+        Tear down a persistent flow and forget about it
+
+        Keyword arguments:
+        flow_key -- the (src_id, dst_id) key of the flow
+        """
+
+        self._teardownFlow(self.flows.pop(flow_key))
+
+    def _expireFlows(self):
+        """
+        Tear down persistent flows that have been idle for longer than 
+        --session_idle_timeout
+
+        The check runs at most once per `self.flow_sweep_interval`, which is 
+        also when the deduplication summary is written and the transaction 
+        store segment spilled once due
+        """
+
+        now = monotonic()
+        if now - self.last_flow_sweep < self.flow_sweep_interval:
+            # still give buffering emitters a chance to write out
+            self.emitter.flush()
+            return
+        self.last_flow_sweep = now
+
+        if self.dedup is not None:
+            self._writeDedupSummary(self.dedup.summary(now))
+
+        # segments are spilled on time even when traffic stops
+        if self.txn_store is not None:
+            self.txn_store.expire()
+
+        # teardown frames are stamped with the time they are sent
+        self.emitter.set_timestamp(None)
+
+        # the oldest pairs are at the front so stop at the first one still 
+        # waiting within the timeout
+        expired_requests = 0x00
+        while self.pending_requests:
+            flow_key, requests = next(iter(self.pending_requests.items()))
+            while requests \
+              and now - requests[0]['sent'] > args.response_timeout:
+                self._forgetRequest(requests.popleft())
+                expired_requests += 0x01
+            if requests:
+                break
+            del self.pending_requests[flow_key]
+
+        expired = [flow_key for flow_key, flow in self.flows.items() \
+            if now - flow['last_seen'] > args.session_idle_timeout]
+        for flow_key in expired:
+            if args.v:
+                print("[*] Closing idle flow {:02x} -> {:02x}" \
+                    .format(flow_key[0], flow_key[1]))
+            self._closeFlow(flow_key)
+
+        # also writes out frames buffering emitters are holding back
+        self.emitter.flush()
+
+    def _addPendingRequest(self, flow_key, flow, trans_id, owned):
+        """
+        Remember a request so its response can be sent on the same flow
+
+        Keyword arguments:
+        flow_key -- the (client_id, server_id) key of the request
+        flow -- the flow state the request was sent on
+        trans_id -- the Modbus transaction ID of the request
+        owned -- whether the flow only exists for this request and has to be 
+                 torn down once the request is answered or forgotten
+        """
+
+        requests = self.pending_requests.get(flow_key)
+        if requests is None:
+            # make room by forgetting the pair that has been quiet longest
+            if len(self.pending_requests) >= self.max_pending_pairs:
+                self._dropPendingRequests(next(iter(self.pending_requests)))
+            requests = deque()
+            self.pending_requests[flow_key] = requests
+        else:
+            self.pending_requests.move_to_end(flow_key)
+
+        if len(requests) >= self.max_pending_per_pair:
+            self._forgetRequest(requests.popleft())
+
+        request = {}
+        request['flow'] = flow
+        request['trans_id'] = trans_id
+        request['owned'] = owned
+        request['sent'] = monotonic()
+        requests.append(request)
+
+    def _forgetRequest(self, request):
+        """
+        Tear down the flow of a request that will never be answered if the 
+        flow was opened just for it
+
+        Keyword arguments:
+        request -- the pending request entry
+        """
+
+        if request['owned']:
+            self._teardownFlow(request['flow'])
+
+    def _dropPendingRequests(self, flow_key):
+        """
+        Forget every outstanding request for a module pair
+
+        Keyword arguments:
+        flow_key -- the (client_id, server_id) key of the requests
+        """
+
+        for request in self.pending_requests.pop(flow_key):
+            self._forgetRequest(request)
+
+    def _spoofResponse(self, src_id, dst_id, payload):
+        """
+        Sends a UMAS response on the flow of the oldest outstanding request
+        it answers and returns False if there is no such request
+
+        The responding module is the server of the flow, so the request is 
+        looked up with the ids swapped
+
+        Keyword arguments:
+        src_id -- responding module identifier byte
+        dst_id -- requesting module identifier byte
+        payload -- UMAS response to send
+        """
+
+        flow_key = (dst_id, src_id)
+        requests = self.pending_requests.get(flow_key)
+
+        while requests:
+            request = requests.popleft()
+            flow = request['flow']
+
+            # a persistent flow may have been rotated since the request
+            if not request['owned'] and self.flows.get(flow_key) is not flow:
+                continue
+
+            self._sendFlowResponse(flow, request['trans_id'], payload)
+            if request['owned']:
+                self._teardownFlow(flow)
+            self.emitter.flush()
+
+            if not requests:
+                del self.pending_requests[flow_key]
+            return True
+
+        if requests is not None:
+            del self.pending_requests[flow_key]
+        return False
+
+    def _spoofUmasMsg(self, umas_txn):
+        """
+        Spoofs a rebuilt UMAS message using the configured session mode
+
+        Keyword arguments:
+        umas_txn -- a dict holding the src_id, dst_id, payload and ingest_ts
+        """
+
+        # indexed ahead of deduplication so queries still see every repeat
+        if self.txn_store is not None:
+            self.txn_store.append(umas_txn)
+
+        src_id = umas_txn['src_id']
+        dst_id = umas_txn['dst_id']
+        payload = umas_txn['payload']
+
+        is_response = args.correlate_responses and len(payload) > 0x02 \
+          and payload[2] in self.umas_response_codes
+
+        # repeated polling is only spoofed once per --dedup_window, while 
+        # priority commands are always spoofed
+        if self.dedup is not None and not umas_txn.get('priority') \
+          and self._suppressUmasMsg(umas_txn, is_response):
+            return
+
+        # stamp the frames with when the FPGA message arrived for emitters
+        # that keep them
+        self.emitter.set_timestamp(umas_txn.get('ingest_ts'))
+
+        # only requests get remembered for correlation
+        track_response = args.correlate_responses and not is_response
+
+        if is_response:
+            if self._spoofResponse(src_id, dst_id, payload):
+                return
+
+            # send responses without a request the same way as requests
+            self.unmatched_responses += 0x01
+            if args.v:
+                print("[!] WARNING: No request found for UMAS response " \
+                    "{:02x} -> {:02x} ({} unmatched)".format(src_id, dst_id, \
+                        self.unmatched_responses))
+
+        if args.session_mode == 'persistent':
+            self._spoofSessionMessage(src_id, dst_id, self.modbus_port, \
+                payload, track_response)
+        else:
+            self._spoofTransaction(src_id, dst_id, self.modbus_port, \
+                payload, track_response)
+
+    def _suppressUmasMsg(self, umas_txn, is_response):
+        """
+        Returns whether deduplication suppresses a UMAS message
+
+        With --correlate_responses requests and their responses are 
+        suppressed in pairs. A response to a spoofed request that is still 
+        outstanding is always spoofed, and one arriving after a suppressed 
+        request of the pair is suppressed along with it instead of being 
+        sent on a flow of its own
+
+        Keyword arguments:
+        umas_txn -- a dict holding the src_id, dst_id and payload
+        is_response -- whether the message is a response to correlate
+        """
+
+        if not args.correlate_responses:
+            return self.dedup.suppress(umas_txn)
+
+        now = monotonic()
+        if is_response:
+            flow_key = (umas_txn['dst_id'], umas_txn['src_id'])
+            if self.pending_requests.get(flow_key):
+                return False
+
+            # requests that went unanswered no longer take a response
+            suppressed = self.suppressed_requests.get(flow_key)
+            while suppressed and now - suppressed[0] > args.response_timeout:
+                suppressed.popleft()
+            if suppressed:
+                suppressed.popleft()
+                self.dedup.suppressed_count += 0x01
+                return True
+            if suppressed is not None:
+                del self.suppressed_requests[flow_key]
+            return self.dedup.suppress(umas_txn, now)
+
+        if not self.dedup.suppress(umas_txn, now):
+            return False
+
+        flow_key = (umas_txn['src_id'], umas_txn['dst_id'])
+        suppressed = self.suppressed_requests.get(flow_key)
+        if suppressed is None:
+            suppressed = deque(maxlen=self.max_pending_per_pair)
+            self.suppressed_requests[flow_key] = suppressed
+        suppressed.append(now)
+        return True
+
+    def _spoofSessionMessage(self, src_id, dst_id, dport, payload, \
+            track_response=False):
+        """
+        Sends a UMAS message on the persistent flow for the module pair
+
+        A flow is opened on the first message for a pair and reopened once it
+        has carried --session_max_msgs messages, so most messages only add a
+        data segment and an ACK
+
+        Keyword arguments:
+        src_id -- sending module identifier byte
+        dst_id -- receiving module identifier byte
+        dport -- port on which to spoof the flow
+        payload -- UMAS message to send in the flow
+        track_response -- remember the request for response correlation
+        """
+
+        flow_key = (src_id, dst_id)
+        flow = self.flows.get(flow_key)
+
+        # rotate flows that have carried enough messages
+        if flow is not None and flow['msg_count'] >= args.session_max_msgs:
+            self._closeFlow(flow_key)
+            flow = None
+
+        if flow is None:
+            flow = self._openFlow(src_id, dst_id, dport)
+            self.flows[flow_key] = flow
+
+        trans_id = self._sendFlowMessage(flow, payload)
+        if track_response:
+            self._addPendingRequest(flow_key, flow, trans_id, False)
+        self.emitter.flush()
+
+    def _spoofTransaction(self, src_id, dst_id, dport, payload, \
+            track_response=False):
+        """
+        Creates spoofed TCP transactions on the specified interface 
+
+        All eight frames are queued on the emitter and sent as one burst
+
+        When responses are correlated the teardown is held back until the 
+        response has been sent on the same flow
+
+        Keyword arguments:
+        src_id -- sending module identifier byte
+        dst_id -- receiving module identifier byte
+        dport -- port on which to spoof the transaction
+        payload -- UMAS message to send in the transaction
+        track_response -- remember the request for response correlation
+        """
+
+        flow = self._openFlow(src_id, dst_id, dport)
+        trans_id = self._sendFlowMessage(flow, payload)
+        if track_response:
+            self._addPendingRequest((src_id, dst_id), flow, trans_id, True)
+        else:
+            self._teardownFlow(flow)
+        self.emitter.flush()
+
+
+class FpgaDatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, fpga_msg_q, metrics_row=None, recorder=None):
+        """
+        Initialize the asyncio receiver for FPGA messages
+
+        The event loop does not hand over ancillary data, so kernel drops 
+        are not counted in this mode
+
+        Keyword arguments:
+        fpga_msg_q -- a bounded asyncio.Queue used to store received messages
+        metrics_row -- the recv metrics row to count into, or None
+        recorder -- the FpgaRecordWriter raw datagrams go to, or None
+        """
+
+        self.fpga_msg_q = fpga_msg_q
+        self.metrics_row = metrics_row
+        self.recorder = recorder
+        self.drop_count = 0x00
+
+    def datagram_received(self, data, addr):
+        if self.metrics_row is not None:
+            self.metrics_row[RECV_DATAGRAMS] += 0x01
+            self.metrics_row[RECV_BYTES] += len(data)
+
+        ingest_ts = time()
+        if self.recorder is not None:
+            self.recorder.write(ingest_ts, data)
+
+        # never block the event loop on a full queue, drop and count instead
+        try:
+            self.fpga_msg_q.put_nowait((ingest_ts, data))
+        except asyncio.QueueFull:
+            self.drop_count += 0x01
+            if self.metrics_row is not None:
+                self.metrics_row[RECV_QUEUE_DROPS] += 0x01
+            if args.v:
+                print("[!] WARNING: FPGA message queue full, {} dropped" \
+                    .format(self.drop_count))
+
+
+class AsyncioPipeline():
+
+    def __init__(self, server, metrics=None, source_id=0x00):
+        """
+        Initialize a single process pipeline running ingest, decoding and
+        emission in one event loop
+
+        This is meant for hosts with very few cores where the context 
+        switching between the multiprocess stages costs more than the work
+
+        Keyword arguments:
+        server -- the UdpServer whose bound socket is read from
+        metrics -- the PipelineMetrics to count into, or None
+        source_id -- the FPGA source the server receives from
+        """
+
+        self.server = server
+        self.metrics = metrics
+        self.source_id = source_id
+        self.fpga_msg_processor = FpgaMsgProcessor(metrics)
+        self.umas_msg_spoofer = UmasMsgSpoofer(metrics, source_id)
+
+        # keeps UMAS transactions of the same lane in arrival order
+        self.txn_seq = count()
+
+    async def _decode(self, fpga_msg_q, xbus_msg_q):
+        """
+        Decode raw FPGA messages from one bounded queue into the next
+
+        Keyword arguments:
+        fpga_msg_q -- a bounded asyncio.Queue holding raw FPGA messages
+        xbus_msg_q -- a bounded asyncio.PriorityQueue holding (lane, seq,
+                      UMAS transaction) tuples
+        """
+
+        processor = self.fpga_msg_processor
+        while True:
+            ingest_ts, raw_fpga_msg = await fpga_msg_q.get()
+            umas_txn = processor._decodeFpgaMsg(raw_fpga_msg, ingest_ts)
+            if umas_txn and umas_txn['payload']:
+                processor._classifyUmasTxn(umas_txn)
+            if processor.metrics_row is not None:
+                processor._countFpgaMsg(umas_txn)
+            if umas_txn and umas_txn['payload']:
+                # waiting here is what pushes back on the receiver, the 
+                # priority lane sorts first
+                lane = 0x00 if umas_txn['priority'] else 0x01
+                await xbus_msg_q.put((lane, next(self.txn_seq), umas_txn))
+
+    async def _emit(self, xbus_msg_q):
+        """
+        Spoof every decoded UMAS transaction
+
+        Keyword arguments:
+        xbus_msg_q -- a bounded asyncio.PriorityQueue holding (lane, seq,
+                      UMAS transaction) tuples
+        """
+
+        spoofer = self.umas_msg_spoofer
+        while True:
+            umas_txn = (await xbus_msg_q.get())[0x02]
+            if args.v:
+                print(umas_txn)
+            spoofer._spoofUmasMsg(umas_txn)
+            if spoofer.metrics_row is not None:
+                spoofer._countUmasMsg(umas_txn)
+            spoofer._expireFlows()
+
+    async def _sweep(self, recorder=None):
+        """
+        Periodically clean up idle flows and outstanding requests and write
+        out recorded datagrams that have been buffered for too long
+
+        Keyword arguments:
+        recorder -- the FpgaRecordWriter raw datagrams go to, or None
+        """
+
+        spoofer = self.umas_msg_spoofer
+        while True:
+            await asyncio.sleep(spoofer.flow_sweep_interval)
+            spoofer._expireFlows()
+            if recorder is not None:
+                recorder.expire()
+
+    async def run(self):
+        """
+        Starts the asyncio pipeline
+        """
+
+        loop = asyncio.get_running_loop()
+
+        fpga_msg_q = asyncio.Queue(maxsize=args.asyncio_queue_sz)
+        xbus_msg_q = asyncio.PriorityQueue(maxsize=args.asyncio_queue_sz)
+
+        # every stage shares this process, so each uses the first row
+        recv_metrics_row = None
+        if self.metrics is not None:
+            recv_metrics_row = self.metrics.row('recv')
+            self.fpga_msg_processor.metrics_row = self.metrics.row('decode')
+            self.umas_msg_spoofer.metrics_row = self.metrics.row('emit')
+
+        recorder = self.server._openRecorder(0x00)
+        profiler = start_profiler('asyncio')
+
+        self.server.s.setblocking(False)
+        transport, protocol = await loop.create_datagram_endpoint( \
+            lambda: FpgaDatagramProtocol(fpga_msg_q, recv_metrics_row, \
+                recorder), sock=self.server.s)
+
+        self.umas_msg_spoofer.emitter = self.umas_msg_spoofer._open_emitter()
+
+        exporter = start_metrics_exporter(self.metrics, \
+            {'fpga_msg_q': fpga_msg_q.qsize, 'xbus_msg_q': xbus_msg_q.qsize}, \
+            source_idx=self.source_id)
+
+        try:
+            await asyncio.gather(self._decode(fpga_msg_q, xbus_msg_q), \
+                self._emit(xbus_msg_q), self._sweep(recorder))
+        finally:
+            print("\r[*] Cleaning up asyncio pipeline ({} dropped)" \
+                .format(protocol.drop_count))
+            if exporter is not None:
+                exporter.stop()
+            self.umas_msg_spoofer.shutdown()
+            transport.close()
+            if recorder is not None:
+                recorder.close()
+            if profiler is not None:
+                profiler.stop()
+
+
+def source_path(path, source_idx):
+    """
+    Return the path an FPGA source writes to, which is `path` itself with a 
+    single --lport and <root>.src<idx><ext> with several, so the pipelines 
+    of different sources never share a file, socket or directory
+
+    Keyword arguments:
+    path -- the configured path, or None
+    source_idx -- the position of the source in --lport
+    """
+
+    if path is None or len(args.lport) <= 0x01:
+        return path
+
+    root, ext = os.path.splitext(path.rstrip(os.sep))
+    return '{}.src{}{}'.format(root, source_idx, ext)
+
+
+def parse_cpu_list(cpu_list):
+    """
+    Return the set of CPUs in a list such as 0-1,4
+
+    Keyword arguments:
+    cpu_list -- comma separated CPU numbers and ranges
+    """
+
+    cpus = set()
+    for cpu_range in cpu_list.split(','):
+        if not cpu_range.strip():
+            continue
+        first, _, last = cpu_range.partition('-')
+        cpus.update(range(int(first), int(last or first) + 0x01))
+    return cpus
+
+
+def source_cpu_sets(source_count):
+    """
+    Return the set of CPUs to pin the pipeline of each source to, taken from 
+    --source_cpus or else the CPUs this process may run on split into even 
+    consecutive runs, shared round robin when there are fewer CPUs than 
+    sources
+
+    Keyword arguments:
+    source_count -- the number of FPGA sources
+    """
+
+    if args.source_cpus is not None:
+        cpu_sets = [parse_cpu_list(cpu_list) \
+            for cpu_list in args.source_cpus.split(':')]
+        if len(cpu_sets) != source_count or not all(cpu_sets):
+            raise ValueError('--source_cpus needs a CPU list for each of ' \
+                'the {} sources'.format(source_count))
+        return cpu_sets
+
+    cpus = sorted(os.sched_getaffinity(0x00))
+    if len(cpus) < source_count:
+        return [{cpus[idx % len(cpus)]} for idx in range(source_count)]
+    return [set(cpus[idx * len(cpus) // source_count \
+        :(idx + 0x01) * len(cpus) // source_count]) \
+        for idx in range(source_count)]
+
+
+def start_profiler(stage):
+    """
+    Start sampling this process into --profile and return the profiler, or 
+    None when not profiling
+
+    Keyword arguments:
+    stage -- the name of the stage running in this process
+    """
+
+    if args.profile is None:
+        return None
+
+    # stacks start at the stage's entry point rather than the fork
+    profiler = StageProfiler(stage, args.profile, args.profile_interval)
+    profiler.start(sys._getframe(0x01))
+    return profiler
+
+
+def new_load_shedder(capacity):
+    """
+    Return a LoadShedder configured by the --shed_* arguments
+
+    Keyword arguments:
+    capacity -- the number of entries the queue holds
+    """
+
+    return LoadShedder(capacity, args.shed_policy, args.shed_sample_nth, \
+        args.shed_high_watermark, args.shed_low_watermark)
+
+
+def start_metrics_exporter(metrics, gauges, queues=None, source_idx=0x00):
+    """
+    Start publishing the pipeline metrics as configured by --metrics_port 
+    and --stats_file and return the exporter, or None when disabled
+
+    With several sources each one is served on --metrics_port plus its 
+    position in --lport and written to its own stats file
+
+    Keyword arguments:
+    metrics -- the PipelineMetrics to publish, or None
+    gauges -- a dict of queue names to their qsize callables
+    queues -- a dict of queue names to queues that shed messages
+    source_idx -- the position of the source in --lport
+    """
+
+    if metrics is None:
+        return None
+
+    port = args.metrics_port
+    if port is not None:
+        port += source_idx
+
+    exporter = MetricsExporter(metrics, gauges, port=port, \
+        stats_file=source_path(args.stats_file, source_idx), \
+        interval=args.stats_interval, queues=queues)
+    exporter.start()
+    return exporter
+
+
+def run_pipeline(source_idx, lport):
+    """
+    Kicks off the following for one FPGA source:
+       * UdpServer to receive messages from the FGPA
+       * FpgaMsgProcessor to extract XBUS messages from raw FPGA messages
+       * UmasMsgSpoofer to take processed XBUS messages and send them to Snort
+
+    Keyword arguments:
+    source_idx -- the position of the source in --lport
+    lport -- the port on which to listen for the source's traffic
+    """
+
+    # profiles written from here on belong to this run
+    start_ts = time()
+
+    # every recv worker there may ever be gets a metrics row and with shared 
+    # memory a ring of its own
+    recv_count = args.recvworker_count
+    if args.recvworker_autoscale:
+        recv_count = args.recvworker_max
+
+    # shared memory counters every stage updates when metrics are published
+    metrics = None
+    if args.metrics_port is not None or args.stats_file is not None:
+        if args.mode == 'asyncio':
+            metrics = PipelineMetrics(0x01, 0x01)
+        else:
+            metrics = PipelineMetrics(recv_count, \
+                max(args.processor_count, 0x01))
+
+    # server object to handle requests from the FPGA
+    #
+    # there is one of these per source, each FPGA sending to its own port
+    server = UdpServer(lhost=args.lhost, lport=lport, \
+        recv_mode=args.recv_mode, batch_sz=args.recv_batch_sz, \
+        reuseport=args.recv_reuseport, metrics=metrics, \
+        record=source_path(args.record, source_idx))
+
+    # everything runs in this process in asyncio mode
+    if args.mode == 'asyncio':
+        try:
+            asyncio.run(AsyncioPipeline(server, metrics, source_idx).run())
+        except KeyboardInterrupt:
+            print("\r[*] Exiting...")
+        finally:
+            server.shutdown()
+            if metrics is not None:
+                metrics.close()
+                metrics.unlink()
+            if args.profile is not None:
+                print_profile_summary(args.profile, start_ts)
+        return
+
+    # queue to hold raw messages from the FPGA
+    #
+    # the shared memory transport uses one ring per recv worker, each slot 
+    # sized for the largest FPGA message
+    #
+    # every queue is bounded and handles overflow as set by --shed_policy
+    if args.transport == 'shm':
+        fpga_msg_q = ShmRingSet(recv_count, args.shm_slot_count, \
+            server.recv_sz, shedder=new_load_shedder(args.shm_slot_count))
+    else:
+        fpga_msg_q = SheddingQueue(args.queue_sz, \
+            new_load_shedder(args.queue_sz))
+
+    # queue to hold cleaned up raw XBUS messages broken out of the FPGA msgs
+    #
+    # with more than one processor the shared memory transport needs one 
+    # ring per processor, which the spoofer drains round robin
+    if args.transport == 'shm' and args.processor_count > 0x01:
+        xbus_msg_q = ShmRingSet(args.processor_count, args.shm_slot_count, \
+            server.recv_sz, UmasTxnRing, \
+            new_load_shedder(args.shm_slot_count))
+    elif args.transport == 'shm':
+        xbus_msg_q = UmasTxnRing(args.shm_slot_count, server.recv_sz, \
+            shedder=new_load_shedder(args.shm_slot_count))
+    else:
+        xbus_msg_q = SheddingQueue(args.queue_sz, \
+            new_load_shedder(args.queue_sz))
+
+    # queue for the UMAS messages of the priority lane, laid out the same 
+    # way as the xbus_msg_q but always blocking so nothing in it is shed
+    priority_q = None
+    if args.priority_fnc_codes and args.transport == 'shm' \
+      and args.processor_count > 0x01:
+        priority_q = ShmRingSet(args.processor_count, args.shm_slot_count, \
+            server.recv_sz, UmasTxnRing)
+    elif args.priority_fnc_codes and args.transport == 'shm':
+        priority_q = UmasTxnRing(args.shm_slot_count, server.recv_sz)
+    elif args.priority_fnc_codes:
+        priority_q = SheddingQueue(args.queue_sz)
+
+    # released by the processors for every message they queue in either 
+    # lane, so the spoofer can block on both at once
+    lane_ready = Semaphore(0x00) if priority_q is not None else None
+
+    # one input queue per processor when the raw messages get sharded
+    shard_qs = []
+    for _ in range(args.processor_count if args.processor_count > 0x01 \
+            else 0x00):
+        if args.transport == 'shm':
+            shard_qs.append(ShmRing(args.shm_slot_count, server.recv_sz, \
+                shedder=new_load_shedder(args.shm_slot_count)))
+        else:
+            shard_qs.append(SheddingQueue(args.queue_sz, \
+                new_load_shedder(args.queue_sz)))
+
+    # processor to take extracted Umas messages and prepare/send them across 
+    # the wire to Snort
+    umas_msg_spoofer = UmasMsgSpoofer(metrics, source_idx)
+
+    exporter = None
+
+    # begin processing
+    try:
+        # create a process in which to run the UDP server
+        #
+        # this will listen for traffic from the FPGA
+        #
+        # a separate process is used as the FPGA is going to send traffic 
+        # as fast as it can, which is usually faster than we can receive 
+        #
+        # a queue is used to store the messages because they are going need 
+        # to be accessed by a differrent process
+        server_p = Process(target=server.serve_forever, \
+            args=(fpga_msg_q, args.recvworker_count))
+        server_p.start()
+
+        # create a process to run the FPGA message processor
+        #
+        # this is needed because we can't spend the time to process each 
+        # message on the fly
+        #
+        # data is transferred between the server and the processor via the 
+        # fpga_msg_q
+        #
+        # messages extracted from the FPGA messages are put into the 
+        # xbus_msg_q for later processing
+        #
+        # each processor counts what it decodes in its own metrics row
+        #
+        # with --processor_count above one a dispatcher shards the raw 
+        # messages by module pair between a pool of processors, all of 
+        # which feed the same spoofer
+        processor_ps = []
+        if shard_qs:
+            dispatcher_p = Process(target=FpgaMsgDispatcher().run, \
+                args=(fpga_msg_q, shard_qs, ))
+            dispatcher_p.start()
+            processor_ps.append(dispatcher_p)
+
+            for shard_idx, shard_q in enumerate(shard_qs):
+                if isinstance(xbus_msg_q, ShmRingSet):
+                    processor_xbus_msg_q = xbus_msg_q.producer(shard_idx)
+                else:
+                    processor_xbus_msg_q = xbus_msg_q
+                if isinstance(priority_q, ShmRingSet):
+                    processor_priority_q = priority_q.producer(shard_idx)
+                else:
+                    processor_priority_q = priority_q
+
+                fpga_msg_processor_p = Process( \
+                    target=FpgaMsgProcessor(metrics, shard_idx).run, \
+                    args=(shard_q, processor_xbus_msg_q, \
+                        processor_priority_q, lane_ready, ))
+                fpga_msg_processor_p.start()
+                processor_ps.append(fpga_msg_processor_p)
+        else:
+            fpga_msg_processor_p = Process( \
+                target=FpgaMsgProcessor(metrics).run, \
+                args=(fpga_msg_q, xbus_msg_q, priority_q, lane_ready, ))
+            fpga_msg_processor_p.start()
+            processor_ps.append(fpga_msg_processor_p)
+
+        # create a process to handle sending of prepared UMAS messages from 
+        # the queue
+        #
+        # each queue entry will contain a dict with the following keys:
+        #  - src_id: the one byte src field from the request packet, 
+        #            converted to an int
+        #  - dst_id: the one byte dst field from the request packet, 
+        #            converted to an int
+        #  - payload: a bytestring containing the entire message, built from 
+        #             multiple XBUS messages where necessary
+        #
+        # transactions in the priority_q are always spoofed first
+        umas_msg_spoofer_p = Process(target=umas_msg_spoofer.run, \
+            args=(xbus_msg_q, priority_q, lane_ready, ))
+        umas_msg_spoofer_p.start()
+
+        # publish the metrics from this process once every stage is forked 
+        # so the exporter's thread and socket stay out of the children
+        queues = {'fpga_msg_q': fpga_msg_q, 'xbus_msg_q': xbus_msg_q}
+        if priority_q is not None:
+            queues['priority_q'] = priority_q
+        for shard_idx, shard_q in enumerate(shard_qs):
+            queues['shard_q_{}'.format(shard_idx)] = shard_q
+        gauges = {name: q.qsize for name, q in queues.items()}
+        exporter = start_metrics_exporter(metrics, gauges, queues, \
+            source_idx)
+
+        # block for the sub processes to finish
+        server_p.join()
+        for processor_p in processor_ps:
+            processor_p.join()
+        umas_msg_spoofer_p.join()
+
+    # catch CTRL+C
+    except KeyboardInterrupt:
+        print("\r[*] Exiting...")
+
+    # make sure to clean up the server if needed
+    finally:
+        server.shutdown()
+        if exporter is not None:
+            exporter.stop()
+
+        # shared memory blocks outlive the processes unless removed
+        if args.transport == 'shm':
+            for shm_q in [fpga_msg_q, xbus_msg_q, priority_q] + shard_qs:
+                if shm_q is not None:
+                    shm_q.close()
+                    shm_q.unlink()
+        if metrics is not None:
+            metrics.close()
+            metrics.unlink()
+
+        # every stage writes its profile as it exits
+        if args.profile is not None:
+            for child_p in active_children():
+                child_p.join()
+            print_profile_summary(args.profile, start_ts)
+
+
+def run_source(source_idx, lport, cpus=None):
+    """
+    Pin this process to a CPU set and run the pipeline of one FPGA source 
+    in it, every stage it starts inherits the CPU set
+
+    Keyword arguments:
+    source_idx -- the position of the source in --lport
+    lport -- the port on which to listen for the source's traffic
+    cpus -- the set of CPUs to run on, or None to leave the affinity alone
+    """
+
+    if cpus:
+        os.sched_setaffinity(0x00, cpus)
+
+    # the stages of this source profile into a directory of their own
+    if args.profile is not None:
+        args.profile = source_path(args.profile, source_idx)
+
+    run_pipeline(source_idx, lport)
+
+
+def main():
+    """
+    Runs an independent pipeline for every --lport source, each in its own 
+    process group of stages pinned to its own CPU set
+
+    A single source runs in this process as it always has and is only 
+    pinned when --source_cpus is given
+    """
+
+    if len(args.lport) > 0x100:
+        raise ValueError('at most 256 sources fit the synthetic addresses')
+    if args.recvworker_autoscale \
+      and not 0x01 <= args.recvworker_min <= args.recvworker_max:
+        raise ValueError('recv worker counts must satisfy 1 <= ' \
+            '--recvworker_min <= --recvworker_max')
+
+    if len(args.lport) == 0x01:
+        cpus = None
+        if args.source_cpus is not None:
+            cpus = source_cpu_sets(0x01)[0x00]
+        run_source(0x00, args.lport[0x00], cpus)
+        return
+
+    # each source keeps its backplane's module IDs apart from the others 
+    # by spoofing them from its own subnet and MAC prefix
+    source_ps = []
+    try:
+        for source_idx, (lport, cpus) in enumerate(zip(args.lport, \
+                source_cpu_sets(len(args.lport)))):
+            print('[*] Source {} on port {}: 192.168.{}.0/24, ' \
+                'DE:AD:BE:EF:{:02X}:xx, CPUs {}'.format(source_idx, lport, \
+                    source_idx, source_idx, \
+                    ','.join(str(cpu) for cpu in sorted(cpus))))
+            source_p = Process(target=run_source, \
+                args=(source_idx, lport, cpus, ))
+            source_p.start()
+            source_ps.append(source_p)
+
+        for source_p in source_ps:
+            source_p.join()
+
+    # catch CTRL+C, every source cleans up after its own stages
+    except KeyboardInterrupt:
+        for source_p in source_ps:
+            source_p.join()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,92 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timezone
+from time import time, perf_counter
+import argparse
+import json
+import sys
+
+from txn_store import UmasTxnIndex
+
+parser = argparse.ArgumentParser(description='Query the UMAS transactions indexed by parse_xbus_from_fpga.py --txn_store')
+parser.add_argument('directory', help='The --txn_store directory')
+parser.add_argument('--since', type=float, default=None, help='Only transactions from the last SINCE seconds')
+parser.add_argument('--start', type=float, default=None, help='Only transactions at or after this unix time')
+parser.add_argument('--end', type=float, default=None, help='Only transactions at or before this unix time')
+parser.add_argument('--src', type=lambda value: int(value, 0x00), default=None, help='Only transactions sent by this module ID, such as 0x05')
+parser.add_argument('--dst', type=lambda value: int(value, 0x00), default=None, help='Only transactions sent to this module ID')
+parser.add_argument('--fnc', type=str, default=None, help='Comma separated UMAS function codes to match, such as 0x21,0x23,0x25 for writes')
+parser.add_argument('--limit', type=int, default=0x00, help='Stop after this many transactions, 0 for no limit')
+parser.add_argument('--json', action='store_true', help='Print one JSON object per transaction instead of a table')
+parser.add_argument('--count', action='store_true', help='Only print the number of matching transactions')
+args = parser.parse_args()
+
+
+def main():
+    """
+    Print the transactions matching the filters and how long the query took
+    """
+
+    start = args.start
+    if args.since is not None:
+        start = max(start or 0.0, time() - args.since)
+    fnc_codes = None
+    if args.fnc is not None:
+        fnc_codes = [int(fnc, 0x00) for fnc in args.fnc.split(',') \
+            if fnc.strip()]
+
+    query_start = perf_counter()
+    index = UmasTxnIndex(args.directory)
+    stats = index.stats()
+
+    match_count = 0x00
+    try:
+        for txn in index.query(start, args.end, args.src, args.dst, \
+                fnc_codes):
+            match_count += 0x01
+            if not args.count:
+                if args.json:
+                    txn['payload'] = txn['payload'].hex()
+                    print(json.dumps(txn))
+                else:
+                    print('{} {:02x} -> {:02x} FNC {} {}'.format( \
+                        datetime.fromtimestamp(txn['ts'], timezone.utc) \
+                            .isoformat(), txn['src_id'], txn['dst_id'], \
+                        '--' if txn['fnc'] is None \
+                            else '{:02x}'.format(txn['fnc']), \
+                        txn['payload'].hex()))
+            if args.limit and match_count >= args.limit:
+                break
+    except BrokenPipeError:
+        # piped into head
+        sys.stderr.close()
+        return
+    finally:
+        index.close()
+
+    if args.count:
+        print(match_count)
+    print('[*] {} matching of {} transactions in {} segments, {:.3f}s' \
+        .format(match_count, stats['txns'], stats['segments'], \
+            perf_counter() - query_start), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    # require python3
+    if sys.version_info[0] != 0x03:
+        print("Python2 is not supported")
+        exit()
+
+    main()
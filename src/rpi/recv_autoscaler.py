@@ -0,0 +1,213 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from time import monotonic
+
+# the kernel's table of UDP sockets, with their receive queue and drop count
+PROC_NET_UDP = ('/proc/net/udp', '/proc/net/udp6')
+
+
+def udp_socket_stats(port, paths=PROC_NET_UDP):
+    """
+    Return a (backlog, drops) tuple for the UDP sockets bound to a port,
+    where backlog is the most bytes waiting in any one of their receive
+    buffers and drops the total datagrams the kernel dropped on them
+
+    Keyword arguments:
+    port -- the local port of the sockets
+    paths -- the /proc tables to read
+    """
+
+    backlog = drops = 0x00
+    for path in paths:
+        try:
+            with open(path) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if int(fields[0x01].rsplit(':', 0x01)[0x01], 0x10) != port:
+                        continue
+                    backlog = max(backlog, \
+                        int(fields[0x04].split(':')[0x01], 0x10))
+                    drops += int(fields[-0x01])
+        except (OSError, StopIteration):
+            continue
+    return backlog, drops
+
+
+class RecvWorkerAutoscaler():
+
+    def __init__(self, min_count, max_count, count, rcvbuf_sz, \
+            high_watermark=0.5, low_watermark=0.05, scale_down_after=10.0, \
+            settle_after=30.0):
+        """
+        Initialize the policy deciding how many recv workers to run
+
+        Kernel drops double the workers and a receive buffer filled past
+        `high_watermark` adds one, unless the queue the workers feed is
+        congested, as more workers cannot help a slow processor. Workers are
+        only removed one at a time once there have been no drops and the
+        backlog stayed under `low_watermark` for `scale_down_after` seconds,
+        so a bursty source does not make the count flap. Once the count has
+        not changed for `settle_after` seconds it is reported as settled
+
+        Keyword arguments:
+        min_count -- the fewest workers to run, at least one
+        max_count -- the most workers to run
+        count -- the number of workers to start with
+        rcvbuf_sz -- the size of the socket receive buffer in bytes
+        high_watermark -- the fraction of the receive buffer that adds a
+                          worker
+        low_watermark -- the fraction of the receive buffer the backlog has
+                         to stay under before a worker is removed
+        scale_down_after -- seconds without pressure before a worker is
+                            removed
+        settle_after -- seconds without a change before the count is
+                        reported as settled
+        """
+
+        if not 0x01 <= min_count <= max_count:
+            raise ValueError('recv worker counts must satisfy ' \
+                '1 <= min <= max')
+
+        self.min_count = min_count
+        self.max_count = max_count
+        self.count = min(max(count, min_count), max_count)
+        self.rcvbuf_sz = max(rcvbuf_sz, 0x01)
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.scale_down_after = scale_down_after
+        self.settle_after = settle_after
+
+        # running totals from the previous update, None until the first
+        self.last_drops = None
+        self.last_datagrams = None
+        self.last_update = None
+
+        self.quiet_since = None
+        self.changed_at = monotonic()
+        self.settled = False
+        self.holding = False
+
+        # what the traffic looked like while at the current count
+        self.peak_backlog = 0.0
+        self.peak_rate = 0.0
+
+        # seconds spent at each worker count and the number of changes
+        self.count_secs = {}
+        self.change_count = 0x00
+
+    def _scale(self, count, reason, now):
+        print('[*] Recv workers {} -> {}: {}'.format(self.count, count, \
+            reason))
+        self.count = count
+        self.change_count += 0x01
+        self.changed_at = now
+        self.quiet_since = None
+        self.settled = False
+        self.peak_backlog = 0.0
+        self.peak_rate = 0.0
+
+    def update(self, drops, backlog, congested=False, datagrams=None):
+        """
+        Take in the latest kernel counters and return the number of recv
+        workers that should be running
+
+        Keyword arguments:
+        drops -- the running total of datagrams the kernel dropped
+        backlog -- the bytes waiting in the receive buffer
+        congested -- whether the queue the workers feed is congested
+        datagrams -- the running total of datagrams received, or None when
+                     it is not counted
+        """
+
+        now = monotonic()
+        elapsed = now - self.last_update if self.last_update else 0.0
+        drops_delta = max(drops - self.last_drops, 0x00) \
+            if self.last_drops is not None else 0x00
+        rate = None
+        if datagrams is not None and self.last_datagrams is not None \
+          and elapsed > 0.0:
+            rate = max(datagrams - self.last_datagrams, 0x00) / elapsed
+            self.peak_rate = max(self.peak_rate, rate)
+        self.count_secs[self.count] = self.count_secs.get(self.count, 0.0) \
+            + elapsed
+        self.last_drops = drops
+        self.last_datagrams = datagrams
+        self.last_update = now
+
+        fill = backlog / self.rcvbuf_sz
+        self.peak_backlog = max(self.peak_backlog, fill)
+
+        if drops_delta or fill >= self.high_watermark:
+            self.quiet_since = None
+            if drops_delta:
+                reason = '{} kernel drops in {:.1f}s'.format(drops_delta, \
+                    elapsed)
+                count = min(self.count * 0x02, self.max_count)
+            else:
+                reason = 'receive buffer {:.0%} full'.format(fill)
+                count = min(self.count + 0x01, self.max_count)
+
+            # say once per stretch of pressure why nothing is added
+            if count == self.count or congested:
+                if not self.holding:
+                    print('[!] WARNING: Recv workers holding at {}: {}, {}' \
+                        .format(self.count, reason, 'FPGA message queue ' \
+                            'congested' if congested else 'at --recvworker_max'))
+                self.holding = True
+            else:
+                self._scale(count, reason, now)
+                self.holding = False
+            return self.count
+
+        self.holding = False
+        if fill > self.low_watermark:
+            self.quiet_since = None
+        elif self.quiet_since is None:
+            self.quiet_since = now
+        elif now - self.quiet_since >= self.scale_down_after \
+          and self.count > self.min_count:
+            self._scale(self.count - 0x01, 'no drops and receive buffer ' \
+                'under {:.0%} for {:.0f}s'.format(self.low_watermark, \
+                    now - self.quiet_since), now)
+            return self.count
+
+        if not self.settled and now - self.changed_at >= self.settle_after:
+            self.settled = True
+            print('[*] Recv workers settled at {}: {}'.format(self.count, \
+                self._profile()))
+
+        return self.count
+
+    def _profile(self):
+        """
+        Describe the traffic seen at the current count
+        """
+
+        profile = 'peak receive buffer {:.0%}'.format(self.peak_backlog)
+        if self.peak_rate:
+            profile += ', peak {:.0f} datagrams/s'.format(self.peak_rate)
+        return profile
+
+    def report(self):
+        """
+        Print the count the workers ended on and the time spent at each
+        """
+
+        print('[*] Recv workers ended at {} ({}) after {} changes, seconds ' \
+            'at each count: {}'.format(self.count, 'settled' \
+                if self.settled else 'not settled', self.change_count, \
+                ', '.join('{}: {:.0f}'.format(count, secs) \
+                    for count, secs in sorted(self.count_secs.items()))))
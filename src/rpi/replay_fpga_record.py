@@ -0,0 +1,96 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from time import monotonic, sleep
+import argparse
+import heapq
+import socket
+import sys
+
+from fpga_record import FpgaRecordReader
+
+parser = argparse.ArgumentParser(description='Replay raw FPGA datagrams recorded with parse_xbus_from_fpga.py --record')
+parser.add_argument('records', nargs='+', help='The .fpgarec files to replay, the files of every recv worker are merged by receive time')
+parser.add_argument('--lhost', type=str, default='127.0.0.1', help='The address parse_xbus_from_fpga.py listens on')
+parser.add_argument('--lport', type=int, default=0x343A, help='The port parse_xbus_from_fpga.py listens on')
+parser.add_argument('--speed', type=float, default=1.0, help='Replay speed relative to the original timing, 0 for as fast as possible')
+parser.add_argument('--loops', type=int, default=0x01, help='The number of times to replay the records')
+args = parser.parse_args()
+
+
+def replay(s, readers, speed):
+    """
+    Send every recorded datagram in receive time order and return the number
+    sent
+
+    Keyword arguments:
+    s -- a connected UDP socket
+    readers -- the FpgaRecordReaders to replay
+    speed -- replay speed relative to the original timing, 0 for as fast as
+             possible
+    """
+
+    sent = 0x00
+    first_ts = None
+    start = monotonic()
+
+    for ts, msg in heapq.merge(*readers, key=lambda record: record[0]):
+        if speed:
+            if first_ts is None:
+                first_ts = ts
+            delay = start + (ts - first_ts) / speed - monotonic()
+            if delay > 0.0005:
+                sleep(delay)
+        try:
+            s.send(msg)
+        except ConnectionRefusedError:
+            # nothing was listening when the previous datagram arrived
+            pass
+        sent += 0x01
+
+    return sent
+
+
+def main():
+    """
+    Replay the given records into a running pipeline
+    """
+
+    readers = [FpgaRecordReader(path) for path in args.records]
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.connect((args.lhost, args.lport))
+
+    try:
+        for _ in range(args.loops):
+            start = monotonic()
+            sent = replay(s, readers, args.speed)
+            elapsed = monotonic() - start
+            print('[*] Replayed {} FPGA messages in {:.2f}s ({:.0f}/s)' \
+                .format(sent, elapsed, sent / elapsed if elapsed else 0.0))
+    except KeyboardInterrupt:
+        print('\r[*] Stopped replaying')
+    finally:
+        s.close()
+        for reader in readers:
+            reader.close()
+
+
+if __name__ == '__main__':
+    # require python3
+    if sys.version_info[0] != 0x03:
+        print("Python2 is not supported")
+        exit()
+
+    main()
@@ -0,0 +1,77 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from scapy.all import Ether, IP, TCP, sendp, Raw
+from scapy.contrib.modbus import ModbusADURequest
+from scapy.contrib.modbus import ModbusADUResponse
+
+from frame_emitter import FrameEmitter
+
+
+class ScapyEmitter(FrameEmitter):
+
+    def __init__(self, iface, source_id=0x00):
+        """
+        Initialize an emitter that builds frames with scapy and sends them
+        with sendp
+
+        Keyword arguments:
+        iface -- the interface on which to send the frames
+        source_id -- the FPGA source the synthetic addresses belong to
+        """
+
+        super().__init__()
+        self.iface = iface
+        self.frames = []
+        self.modbus_port = 0x01F6
+        self.source_id = source_id
+
+    def add_frame(self, src_id, dst_id, sport, dport, seq, ack, flags, \
+            trans_id=None, payload=b''):
+        """
+        Queue a frame for the next flush, see 
+        `SyntheticFrameBuilder.build_into` for the arguments
+        """
+
+        # Ether
+        src_mac = "DE:AD:BE:EF:{:02x}:{:02x}".format(self.source_id, src_id)
+        dst_mac = "DE:AD:BE:EF:{:02x}:{:02x}".format(self.source_id, dst_id)
+
+        # IP
+        dst = "192.168.{}.{}".format(self.source_id, dst_id)
+        src = "192.168.{}.{}".format(self.source_id, src_id)
+
+        frame = Ether(src=src_mac, dst=dst_mac)/IP(src=src, dst=dst) \
+            /TCP(sport=sport, dport=dport, flags=flags, seq=seq, ack=ack)
+        if trans_id is not None:
+            # anything sent from the Modbus port is the server responding
+            if sport == self.modbus_port:
+                frame = frame/ModbusADUResponse(transId=trans_id)/Raw(payload)
+            else:
+                frame = frame/ModbusADURequest(transId=trans_id)/Raw(payload)
+
+        self.frames.append(frame)
+        self.frames_sent += 0x01
+
+    def flush(self):
+        """
+        Send every queued frame with a single sendp call
+        """
+
+        if self.frames:
+            sendp(self.frames, iface=self.iface, verbose=False)
+            self.frames = []
+
+    def close(self):
+        self.frames = []
@@ -0,0 +1,554 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from multiprocessing import shared_memory, Condition, Lock, RawValue
+from queue import Empty, Full
+import struct
+import copy
+
+from load_shedding import LoadShedder, SHED_FULL, SHED_OLDEST, SHED_SAMPLED
+from load_shedding import SHED_REASONS
+
+
+class RingSignal():
+
+    def __init__(self):
+        """
+        Initialize the wakeup of a ring, or of every ring in a ShmRingSet
+
+        Counters are published while holding the lock of a multiprocessing
+        Condition, as taking and dropping a process shared lock is what
+        orders the slot contents before the counter on weakly ordered CPUs
+        like the Pi's ARM cores. Reading a counter takes no lock. A side
+        that has to wait registers itself under the same lock before
+        checking the counters again, so a publish only notifies when someone
+        is registered and neither side ever polls
+        """
+
+        self.cond = Condition(Lock())
+        self.waiters = RawValue('I', 0x00)
+
+    def publish(self, buf, offset, counter):
+        """
+        Store a head or tail counter and wake whoever waits on it
+
+        Keyword arguments:
+        buf -- the ring's shared memory
+        offset -- the offset of the counter
+        counter -- the new value of the counter
+        """
+
+        with self.cond:
+            struct.pack_into('I', buf, offset, counter)
+            if self.waiters.value:
+                self.cond.notify_all()
+
+    def wait(self, ready, block, timeout, exc):
+        """
+        Sleep until `ready` returns True
+
+        Keyword arguments:
+        ready -- a callable reading the counters, checked on every wakeup
+        block -- whether to wait at all
+        timeout -- the maximum number of seconds to wait, None for forever
+        exc -- the exception raised when giving up
+        """
+
+        if ready():
+            return
+        if not block:
+            raise exc
+
+        with self.cond:
+            self.waiters.value += 0x01
+            try:
+                if not self.cond.wait_for(ready, timeout):
+                    raise exc
+            finally:
+                self.waiters.value -= 0x01
+
+
+class ShmRing():
+
+    def __init__(self, slot_count, slot_sz, name=None, create=True, \
+            shedder=None, signal=None):
+        """
+        Initialize a single-producer/single-consumer ring buffer that lives in
+        shared memory
+
+        The ring is made of fixed-size slots, each prefixed with a uint32
+        length and the float64 time the message was received from the FPGA,
+        so items are (ingest_ts, msg) tuples. The producer only ever writes
+        the head counter and the consumer only ever writes the tail counter,
+        so no lock is needed as long as each side is owned by exactly one
+        process. Each put or get reads the other side's counter once and
+        only publishing its own counter goes through `signal`, once per
+        batch, which also wakes a consumer waiting for messages or a
+        producer waiting for free slots
+
+        Both counters are free running uint32 values, which is why the slot
+        count has to be a power of two
+
+        A full ring is handled according to the policy of `shedder`. Only
+        the consumer may move the tail, so with drop_oldest it is the
+        consumer that discards the oldest messages once the ring reaches the
+        high watermark, and the producer drops the newest if the ring fills
+        up regardless
+
+        Keyword arguments:
+        slot_count -- the number of slots in the ring, must be a power of two
+        slot_sz -- the maximum number of bytes stored in a slot
+        name -- the name of an existing shared memory block to attach to
+        create -- create a new shared memory block instead of attaching
+        shedder -- the LoadShedder to use, blocking by default
+        signal -- the RingSignal counters are published through, shared by
+                  the rings of a ShmRingSet, a new one by default
+        """
+
+        if slot_count <= 0x00 or slot_count & (slot_count - 0x01):
+            raise ValueError('`slot_count` must be a power of two')
+
+        self.slot_count = slot_count
+        self.slot_sz = slot_sz
+        self.slot_mask = slot_count - 0x01
+
+        # keep the head and tail counters on separate cache lines, each 
+        # followed by the shed counts its owner writes
+        self.head_offset = 0x00
+        self.tail_offset = 0x40
+        self.hdr_sz = 0x80
+        self.shed_offsets = {SHED_FULL: 0x08, SHED_SAMPLED: 0x10, \
+            SHED_OLDEST: 0x48}
+
+        self.shedder = shedder or LoadShedder(slot_count)
+        self.signal = signal or RingSignal()
+
+        # messages the consumer skipped with drop_oldest since the last
+        # `take_evicted`
+        self.evicted = 0x00
+
+        # slot header holding the length and the ingest timestamp
+        self.slot_hdr = struct.Struct('I4xd')
+        self.slot_hdr_sz = self.slot_hdr.size
+
+        # round slots up to a 4-byte boundary so the FPGA words stay aligned
+        self.slot_stride = (self.slot_hdr_sz + slot_sz + 0x03) & ~0x03
+
+        self.shm = shared_memory.SharedMemory(name=name, create=create, \
+            size=self.hdr_sz + self.slot_stride * slot_count)
+        self.buf = self.shm.buf
+
+        if create:
+            struct.pack_into('I', self.buf, self.head_offset, 0x00)
+            struct.pack_into('I', self.buf, self.tail_offset, 0x00)
+            for offset in self.shed_offsets.values():
+                struct.pack_into('Q', self.buf, offset, 0x00)
+
+    def __reduce__(self):
+        # attach to the existing block by name instead of copying it
+        return (self.__class__, (self.slot_count, self.slot_sz, \
+            self.shm.name, False, self.shedder, self.signal))
+
+    def _head(self):
+        return struct.unpack_from('I', self.buf, self.head_offset)[0]
+
+    def _tail(self):
+        return struct.unpack_from('I', self.buf, self.tail_offset)[0]
+
+    def _slot_offset(self, counter):
+        return self.hdr_sz + (counter & self.slot_mask) * self.slot_stride
+
+    def _wait(self, ready, block, timeout, exc):
+        self.signal.wait(ready, block, timeout, exc)
+
+    def qsize(self):
+        return (self._head() - self._tail()) & 0xFFFFFFFF
+
+    def empty(self):
+        return self.qsize() == 0x00
+
+    def full(self):
+        return self.qsize() == self.slot_count
+
+    def congested(self):
+        """
+        Return whether the ring is between its high and low watermarks
+        """
+
+        return self.shedder.update(self.qsize())
+
+    def _count_shed(self, reason, count):
+        # each counter is only written by the side that owns it
+        offset = self.shed_offsets[reason]
+        struct.pack_into('Q', self.buf, offset, \
+            struct.unpack_from('Q', self.buf, offset)[0] + count)
+
+    def shed_counts(self):
+        """
+        Return a dict of shed reason to the number of messages shed
+        """
+
+        return {SHED_REASONS[reason]: struct.unpack_from('Q', self.buf, \
+            offset)[0] for reason, offset in sorted(self.shed_offsets.items())}
+
+    def take_evicted(self):
+        """
+        Return and reset the number of messages the consumer skipped with
+        drop_oldest, so it can take back what was signalled for them
+        """
+
+        evicted = self.evicted
+        self.evicted = 0x00
+        return evicted
+
+    def _write_slot(self, counter, item):
+        """
+        Copy a message into the slot for the given head counter
+
+        Keyword arguments:
+        counter -- the head counter value of the slot to write
+        item -- an (ingest_ts, msg) tuple with msg no larger than `slot_sz`
+        """
+
+        ingest_ts, msg = item
+        msg_len = len(msg)
+        if msg_len > self.slot_sz:
+            raise ValueError('message of {} bytes does not fit in a {} ' \
+                'byte slot'.format(msg_len, self.slot_sz))
+
+        offset = self._slot_offset(counter)
+        self.slot_hdr.pack_into(self.buf, offset, msg_len, ingest_ts)
+        offset += self.slot_hdr_sz
+        self.buf[offset:offset + msg_len] = msg
+
+    def put(self, msg, block=True, timeout=None):
+        """
+        Add a message, or a list of messages, to the ring
+
+        A list is published with a single head update so the consumer sees
+        the whole batch at once. Returns whether the messages were added,
+        False when they were shed
+
+        Keyword arguments:
+        msg -- an (ingest_ts, msg) tuple or a list of them
+        block -- wait for free slots instead of raising queue.Full, only
+                 used with the block policy
+        timeout -- the maximum number of seconds to wait for free slots
+        """
+
+        msgs = msg if isinstance(msg, list) else [msg]
+        msg_count = len(msgs)
+        if msg_count > self.slot_count:
+            raise ValueError('batch is larger than the ring')
+
+        # the head is only ever written here, the tail is read once
+        head = self._head()
+        depth = (head - self._tail()) & 0xFFFFFFFF
+
+        shedder = self.shedder
+        if shedder.policy == 'block':
+            if self.slot_count - depth < msg_count:
+                self._wait(lambda: self.slot_count - self.qsize() \
+                    >= msg_count, block, timeout, Full())
+        elif shedder.policy == 'sample' and shedder.update(depth) \
+          and not shedder.sampled():
+            self._count_shed(SHED_SAMPLED, msg_count)
+            return False
+        elif self.slot_count - depth < msg_count:
+            self._count_shed(SHED_FULL, msg_count)
+            return False
+
+        for cur_msg in msgs:
+            self._write_slot(head, cur_msg)
+            head = (head + 0x01) & 0xFFFFFFFF
+
+        # publish only after every slot has been written
+        self.signal.publish(self.buf, self.head_offset, head)
+        return True
+
+    def get_views(self, max_count=None, block=True, timeout=None):
+        """
+        Return (ingest_ts, memoryview) tuples for the messages waiting in the
+        ring without copying them
+
+        The slots stay owned by the consumer until `release` is called, so
+        the views must not be used after that
+
+        Keyword arguments:
+        max_count -- the maximum number of views to return
+        block -- wait for a message instead of raising queue.Empty
+        timeout -- the maximum number of seconds to wait for a message
+        """
+
+        # the tail is only ever written by this side, the head is read once
+        tail = self._tail()
+        count = (self._head() - tail) & 0xFFFFFFFF
+        if not count:
+            self._wait(lambda: not self.empty(), block, timeout, Empty())
+            count = (self._head() - tail) & 0xFFFFFFFF
+
+        # skip straight past the oldest messages of a backed up ring
+        if self.shedder.policy == 'drop_oldest' \
+          and count >= self.shedder.high_count:
+            evict_count = count - self.shedder.low_count
+            self.release(evict_count)
+            self._count_shed(SHED_OLDEST, evict_count)
+            self.evicted += evict_count
+            tail = (tail + evict_count) & 0xFFFFFFFF
+            count -= evict_count
+
+        if max_count is not None and count > max_count:
+            count = max_count
+
+        views = []
+        for idx in range(count):
+            offset = self._slot_offset(tail + idx)
+            msg_len, ingest_ts = self.slot_hdr.unpack_from(self.buf, offset)
+            offset += self.slot_hdr_sz
+            views.append((ingest_ts, self.buf[offset:offset + msg_len]))
+
+        return views
+
+    def release(self, count=0x01):
+        """
+        Hand slots read through `get_views` back to the producer
+
+        Keyword arguments:
+        count -- the number of slots to release
+        """
+
+        tail = (self._tail() + count) & 0xFFFFFFFF
+        self.signal.publish(self.buf, self.tail_offset, tail)
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return a copy of the next (ingest_ts, msg) tuple, like
+        Queue.get
+
+        Keyword arguments:
+        block -- wait for a message instead of raising queue.Empty
+        timeout -- the maximum number of seconds to wait for a message
+        """
+
+        ingest_ts, view = self.get_views(0x01, block, timeout)[0]
+        msg = bytes(view)
+        self.release()
+        return ingest_ts, msg
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class ShmRingSet():
+
+    def __init__(self, producer_count, slot_count, slot_sz, \
+            ring_cls=ShmRing, shedder=None):
+        """
+        Initialize a group of rings, one per producer, drained by a single
+        consumer
+
+        The UdpServer runs several receive workers and there may be several
+        FpgaMsgProcessors, so each of them gets its own ring to keep every
+        ring single-producer
+
+        Every ring gets a copy of `shedder` so the watermarks and sampling
+        of one ring do not depend on the others, and the set counts as
+        congested while any of its rings is. The rings share one RingSignal,
+        so the consumer can sleep until any of them has a message
+
+        Keyword arguments:
+        producer_count -- the number of producer processes
+        slot_count -- the number of slots in each ring
+        slot_sz -- the maximum number of bytes stored in a slot
+        ring_cls -- the ring class to use, ShmRing or UmasTxnRing
+        shedder -- the LoadShedder each ring gets a copy of, blocking by
+                   default
+        """
+
+        signal = RingSignal()
+        self.rings = [ring_cls(slot_count, slot_sz, shedder=copy.copy( \
+            shedder), signal=signal) for _ in range(producer_count)]
+        self.cur_idx = 0x00
+
+    def producer(self, idx):
+        """
+        Return the ring owned by the given producer
+
+        Keyword arguments:
+        idx -- the index of the producer
+        """
+
+        return self.rings[idx % len(self.rings)]
+
+    def qsize(self):
+        return sum(ring.qsize() for ring in self.rings)
+
+    def empty(self):
+        return self.qsize() == 0x00
+
+    def congested(self):
+        """
+        Return whether any ring is between its high and low watermarks
+        """
+
+        return any([ring.congested() for ring in self.rings])
+
+    def shed_counts(self):
+        """
+        Return a dict of shed reason to the number of messages shed by every
+        ring
+        """
+
+        shed = dict.fromkeys(SHED_REASONS, 0x00)
+        for ring in self.rings:
+            for reason, count in ring.shed_counts().items():
+                shed[reason] += count
+        return shed
+
+    def take_evicted(self):
+        """
+        Return and reset the number of messages the consumer skipped in
+        every ring, see `ShmRing.take_evicted`
+        """
+
+        return sum(ring.take_evicted() for ring in self.rings)
+
+    def _next_ready(self):
+        # round robin over the rings so no producer is starved
+        for _ in range(len(self.rings)):
+            ring = self.rings[self.cur_idx]
+            if not ring.empty():
+                return True
+            self.cur_idx = (self.cur_idx + 0x01) % len(self.rings)
+        return False
+
+    def get_views(self, max_count=None, block=True, timeout=None):
+        """
+        Return memoryviews from the next ring holding messages, see
+        `ShmRing.get_views`
+
+        Keyword arguments:
+        max_count -- the maximum number of views to return
+        block -- wait for a message instead of raising queue.Empty
+        timeout -- the maximum number of seconds to wait for a message
+        """
+
+        self.rings[0x00]._wait(self._next_ready, block, timeout, Empty())
+        return self.rings[self.cur_idx].get_views(max_count, False)
+
+    def release(self, count=0x01):
+        """
+        Release slots from the ring the last views came from and move on to
+        the next ring
+
+        Keyword arguments:
+        count -- the number of slots to release
+        """
+
+        self.rings[self.cur_idx].release(count)
+        self.cur_idx = (self.cur_idx + 0x01) % len(self.rings)
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return the next message from any ring, decoded the same
+        way as the ring's own `get`
+
+        Keyword arguments:
+        block -- wait for a message instead of raising queue.Empty
+        timeout -- the maximum number of seconds to wait for a message
+        """
+
+        self.rings[0x00]._wait(self._next_ready, block, timeout, Empty())
+        msg = self.rings[self.cur_idx].get(False)
+        self.cur_idx = (self.cur_idx + 0x01) % len(self.rings)
+        return msg
+
+    def close(self):
+        for ring in self.rings:
+            ring.close()
+
+    def unlink(self):
+        for ring in self.rings:
+            ring.unlink()
+
+
+class UmasTxnRing(ShmRing):
+
+    def __init__(self, slot_count, slot_sz, name=None, create=True, \
+            shedder=None, signal=None):
+        """
+        Initialize a ring carrying the `umas_txn` dicts built by the
+        FpgaMsgProcessor
+
+        Each slot holds the src_id and dst_id bytes followed by the payload,
+        the ingest timestamp is kept in the slot header
+
+        Keyword arguments:
+        slot_count -- the number of slots in the ring, must be a power of two
+        slot_sz -- the maximum payload size stored in a slot
+        name -- the name of an existing shared memory block to attach to
+        create -- create a new shared memory block instead of attaching
+        shedder -- the LoadShedder to use, blocking by default
+        signal -- the RingSignal publishing the counters, a new one by
+                  default
+        """
+
+        self.txn_hdr_sz = 0x02
+        super().__init__(slot_count, slot_sz + self.txn_hdr_sz, name, \
+            create, shedder, signal)
+
+    def __reduce__(self):
+        return (self.__class__, (self.slot_count, \
+            self.slot_sz - self.txn_hdr_sz, self.shm.name, False, \
+            self.shedder, self.signal))
+
+    def _write_slot(self, counter, umas_txn):
+        payload = umas_txn['payload']
+        payload_len = len(payload)
+        if payload_len + self.txn_hdr_sz > self.slot_sz:
+            raise ValueError('payload of {} bytes does not fit in a {} ' \
+                'byte slot'.format(payload_len, self.slot_sz))
+
+        offset = self._slot_offset(counter)
+        self.slot_hdr.pack_into(self.buf, offset, \
+            payload_len + self.txn_hdr_sz, umas_txn.get('ingest_ts', 0.0))
+        offset += self.slot_hdr_sz
+        struct.pack_into('BB', self.buf, offset, umas_txn['src_id'], \
+            umas_txn['dst_id'])
+        offset += self.txn_hdr_sz
+        self.buf[offset:offset + payload_len] = payload
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return the next `umas_txn` dict, like Queue.get
+
+        Keyword arguments:
+        block -- wait for a message instead of raising queue.Empty
+        timeout -- the maximum number of seconds to wait for a message
+        """
+
+        ingest_ts, view = self.get_views(0x01, block, timeout)[0]
+
+        umas_txn = {}
+        umas_txn['src_id'] = view[0]
+        umas_txn['dst_id'] = view[1]
+        umas_txn['payload'] = bytes(view[self.txn_hdr_sz:])
+        umas_txn['ingest_ts'] = ingest_ts
+
+        self.release()
+        return umas_txn
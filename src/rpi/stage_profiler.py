@@ -0,0 +1,292 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from time import monotonic, time, clock_gettime, pthread_getcpuclockid
+import threading
+import resource
+import signal
+import json
+import sys
+import os
+
+# the deepest stack recorded per sample
+MAX_STACK_DEPTH = 0x80
+
+# the number of functions listed in a summary
+SUMMARY_TOP_COUNT = 0x05
+
+
+class StageProfiler():
+
+    def __init__(self, stage, directory, interval=0.01):
+        """
+        Initialize a sampling profiler for the pipeline stage running in this
+        process
+
+        Every `interval` seconds of CPU time the process uses, SIGPROF
+        interrupts it and the stack of every thread is recorded, weighted by
+        the CPU time that thread used since the previous sample. Stacks of
+        the main thread start at the frame that started the profiler. Other
+        threads, such as the feeder thread a multiprocessing Queue pickles
+        and writes its entries in, are mostly idle again by the time they
+        are sampled, so their CPU time is only counted against the function
+        the thread runs
+
+        On `stop` the stacks are written to
+        <directory>/<stage>.<pid>.collapsed in the collapsed format that
+        flamegraph.pl, inferno and speedscope read, with microseconds of CPU
+        time as the counts, and a summary of the CPU time to
+        <directory>/<stage>.<pid>.json
+
+        Keyword arguments:
+        stage -- the name of the stage, such as decode.0, the root frame of
+                 every stack
+        directory -- the directory the profiles are written to
+        interval -- seconds of CPU time between samples
+        """
+
+        self.stage = stage
+        self.directory = directory
+        self.interval = interval
+
+        # CPU microseconds per (thread name, frame labels...) stack
+        self.stacks = {}
+        self.sample_count = 0x00
+
+        # frame labels per code object and thread names per ident
+        self.labels = {}
+        self.thread_names = {}
+
+        # CPU seconds of each thread at the previous sample
+        self.thread_cpu = {}
+
+        self.root_frame = None
+        self.prev_handler = None
+        self.start_wall = None
+        self.start_usage = None
+
+    def _label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = '{}:{}'.format(os.path.basename(code.co_filename), \
+                getattr(code, 'co_qualname', code.co_name))
+            self.labels[code] = label
+        return label
+
+    def _threadCpu(self, thread_id):
+        try:
+            return clock_gettime(pthread_getcpuclockid(thread_id))
+        except OSError:
+            # the thread exited since its frame was looked up
+            return None
+
+    def _threadTarget(self, frame):
+        """
+        Return the label of the outermost frame of a thread outside of the
+        threading module, which is the function the thread was started with
+
+        Keyword arguments:
+        frame -- the thread's current frame
+        """
+
+        target = frame
+        while frame is not None:
+            if os.path.basename(frame.f_code.co_filename) != 'threading.py':
+                target = frame
+            frame = frame.f_back
+        return self._label(target.f_code)
+
+    def _sample(self, signum, frame):
+        """
+        Record the stack of every thread that used CPU since the last sample
+
+        Keyword arguments:
+        signum -- SIGPROF
+        frame -- the frame the main thread was interrupted in
+        """
+
+        self.sample_count += 0x01
+        main_id = threading.main_thread().ident
+
+        for thread_id, thread_frame in sys._current_frames().items():
+            cpu = self._threadCpu(thread_id)
+            if cpu is None:
+                continue
+            cpu_us = int((cpu - self.thread_cpu.get(thread_id, 0.0)) * 1e6)
+            self.thread_cpu[thread_id] = cpu
+            if cpu_us <= 0x00:
+                continue
+
+            name = self.thread_names.get(thread_id)
+            if name is None:
+                self.thread_names = {thread.ident: thread.name \
+                    for thread in threading.enumerate()}
+                name = self.thread_names.get(thread_id, str(thread_id))
+
+            if thread_id != main_id:
+                self._record((name, self._threadTarget(thread_frame)), \
+                    cpu_us)
+                continue
+
+            # the main thread's own frame is this handler
+            stack = []
+            thread_frame = frame
+            while thread_frame is not None and len(stack) < MAX_STACK_DEPTH:
+                stack.append(self._label(thread_frame.f_code))
+                if thread_frame is self.root_frame:
+                    break
+                thread_frame = thread_frame.f_back
+            stack.append(name)
+            self._record(tuple(reversed(stack)), cpu_us)
+
+    def _record(self, stack, cpu_us):
+        self.stacks[stack] = self.stacks.get(stack, 0x00) + cpu_us
+
+    def start(self, root_frame=None):
+        """
+        Start sampling this process
+
+        Keyword arguments:
+        root_frame -- the frame of the stage's entry point, stacks are cut
+                      off below it, or None to keep whole stacks
+        """
+
+        self.root_frame = root_frame
+        self.start_wall = monotonic()
+        self.start_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+        # CPU used before profiling started is not counted
+        for thread in threading.enumerate():
+            cpu = self._threadCpu(thread.ident)
+            if cpu is not None:
+                self.thread_cpu[thread.ident] = cpu
+
+        self.prev_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        """
+        Stop sampling, write the collapsed stacks and the summary and print
+        the summary
+        """
+
+        signal.setitimer(signal.ITIMER_PROF, 0.0, 0.0)
+        signal.signal(signal.SIGPROF, self.prev_handler or signal.SIG_DFL)
+
+        # pick up the CPU used since the last sample
+        self._sample(signal.SIGPROF, sys._getframe(0x01))
+        self.root_frame = None
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        summary = {}
+        summary['stage'] = self.stage
+        summary['pid'] = os.getpid()
+        summary['finished'] = time()
+        summary['wall_sec'] = monotonic() - self.start_wall
+        summary['user_sec'] = usage.ru_utime - self.start_usage.ru_utime
+        summary['sys_sec'] = usage.ru_stime - self.start_usage.ru_stime
+        summary['samples'] = self.sample_count
+        summary['sampled_us'] = sum(self.stacks.values())
+        summary['top'] = self._top()
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '{}.{}'.format(self.stage, \
+            os.getpid()))
+        with open(path + '.collapsed', 'w') as f:
+            for stack, cpu_us in sorted(self.stacks.items()):
+                f.write('{};{} {}\n'.format(self.stage, ';'.join(stack), \
+                    cpu_us))
+        with open(path + '.json', 'w') as f:
+            json.dump(summary, f, indent=0x02)
+
+        print('[*] Profile {} (pid {}): {:.2f}s CPU ({:.2f}s user, {:.2f}s ' \
+            'sys) in {:.1f}s, {}'.format(self.stage, summary['pid'], \
+                summary['user_sec'] + summary['sys_sec'], \
+                summary['user_sec'], summary['sys_sec'], \
+                summary['wall_sec'], format_top(summary['top'], \
+                    summary['sampled_us'])))
+
+    def _top(self):
+        """
+        Return the functions the most CPU time was spent in themselves, as
+        [label, CPU microseconds] pairs
+        """
+
+        self_us = {}
+        for stack, cpu_us in self.stacks.items():
+            self_us[stack[-0x01]] = self_us.get(stack[-0x01], 0x00) + cpu_us
+        return sorted(([label, cpu_us] for label, cpu_us in self_us.items()), \
+            key=lambda top: -top[0x01])[:SUMMARY_TOP_COUNT]
+
+
+def format_top(top, sampled_us):
+    """
+    Return the top functions with their share of the sampled CPU time
+
+    Keyword arguments:
+    top -- [label, CPU microseconds] pairs
+    sampled_us -- the CPU microseconds of every sample
+    """
+
+    return ', '.join('{} {:.0%}'.format(label, cpu_us / sampled_us) \
+        for label, cpu_us in top if sampled_us) or 'no samples'
+
+
+def print_profile_summary(directory, since=0.0):
+    """
+    Print the CPU time of each stage summed over its processes, from the
+    summaries written to `directory` since a point in time
+
+    Stages are grouped by the part of their name before the first dot, so
+    every recv.N worker counts towards recv
+
+    Keyword arguments:
+    directory -- the directory the profiles were written to
+    since -- the unix time of the oldest summary to include
+    """
+
+    stages = {}
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                summary = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if summary['finished'] < since:
+            continue
+
+        stage = stages.setdefault(summary['stage'].split('.')[0x00], \
+            {'processes': 0x00, 'user_sec': 0.0, 'sys_sec': 0.0, \
+                'sampled_us': 0x00, 'top': {}})
+        stage['processes'] += 0x01
+        stage['sampled_us'] += summary['sampled_us']
+        stage['user_sec'] += summary['user_sec']
+        stage['sys_sec'] += summary['sys_sec']
+        for label, cpu_us in summary['top']:
+            stage['top'][label] = stage['top'].get(label, 0x00) + cpu_us
+
+    total_sec = sum(stage['user_sec'] + stage['sys_sec'] \
+        for stage in stages.values()) or 1.0
+    for name, stage in sorted(stages.items()):
+        cpu_sec = stage['user_sec'] + stage['sys_sec']
+        top = sorted(stage['top'].items(), key=lambda top: -top[0x01])
+        print('[*] Profile {}: {} processes, {:.2f}s CPU ({:.0%}), {}'.format( \
+            name, stage['processes'], cpu_sec, cpu_sec / total_sec, \
+            format_top(top[:SUMMARY_TOP_COUNT], stage['sampled_us'])))
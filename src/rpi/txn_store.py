@@ -0,0 +1,400 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bisect import bisect_left, bisect_right
+from array import array
+from time import time
+import struct
+import mmap
+import os
+
+# segment header: magic, format version, flags, transaction count, reserved,
+# the first and last timestamp, bitmaps of the function codes, source and
+# destination IDs present and the size of the payload arena
+SEGMENT_MAGIC = b'BBTX'
+SEGMENT_VERSION = 0x01
+SEGMENT_HDR = struct.Struct('<4sHHII2d32s32s32sQ')
+SEGMENT_SUFFIX = '.umastxn'
+
+# set when the timestamps of a segment never go backwards, so time ranges
+# can be binary searched
+SEGMENT_SORTED = 0x01
+
+# function code column value for payloads too short to carry one
+NO_FNC = 0xFFFF
+
+# the columns in the order they are laid out in a segment file, largest
+# items first so every column stays aligned
+COLUMNS = (('ts', 'd'), ('payload_offs', 'Q'), ('payload_lens', 'I'), \
+    ('fncs', 'H'), ('src_ids', 'B'), ('dst_ids', 'B'))
+
+
+def bitmap_has(bitmap, value):
+    return bitmap[value >> 0x03] & (0x01 << (value & 0x07))
+
+
+class TxnColumns():
+    """
+    Filtering shared by the segment being written and the spilled ones,
+    which both hold the columns named in COLUMNS, a payload `arena`, a
+    `count` and the header fields
+    """
+
+    def overlaps(self, start=None, end=None, src_id=None, dst_id=None, \
+            fnc_codes=None):
+        """
+        Return whether the segment may hold any matching transaction,
+        judging by its time range and bitmaps alone
+        """
+
+        if not self.count:
+            return False
+        if start is not None and self.max_ts < start:
+            return False
+        if end is not None and self.min_ts > end:
+            return False
+        if src_id is not None and not bitmap_has(self.src_bitmap, src_id):
+            return False
+        if dst_id is not None and not bitmap_has(self.dst_bitmap, dst_id):
+            return False
+        if fnc_codes is not None and not any(bitmap_has(self.fnc_bitmap, fnc) \
+                for fnc in fnc_codes):
+            return False
+        return True
+
+    def select(self, start=None, end=None, src_id=None, dst_id=None, \
+            fnc_codes=None):
+        """
+        Yield a dict per matching transaction in the order they were stored
+
+        Keyword arguments:
+        start -- the earliest timestamp, inclusive
+        end -- the latest timestamp, inclusive
+        src_id -- only transactions sent by this module
+        dst_id -- only transactions sent to this module
+        fnc_codes -- a set of function codes to match
+        """
+
+        if not self.overlaps(start, end, src_id, dst_id, fnc_codes):
+            return
+
+        ts = self.ts
+        first, last = 0x00, self.count
+        if self.flags & SEGMENT_SORTED:
+            if start is not None:
+                first = bisect_left(ts, start, 0x00, last)
+            if end is not None:
+                last = bisect_right(ts, end, first, last)
+
+        src_ids = self.src_ids
+        dst_ids = self.dst_ids
+        fncs = self.fncs
+        for idx in range(first, last):
+            if src_id is not None and src_ids[idx] != src_id:
+                continue
+            if dst_id is not None and dst_ids[idx] != dst_id:
+                continue
+            if fnc_codes is not None and fncs[idx] not in fnc_codes:
+                continue
+            if start is not None and ts[idx] < start \
+              or end is not None and ts[idx] > end:
+                continue
+
+            offset = self.payload_offs[idx]
+            fnc = fncs[idx]
+            yield {'ts': ts[idx], 'src_id': src_ids[idx], \
+                'dst_id': dst_ids[idx], 'fnc': None if fnc == NO_FNC else fnc, \
+                'payload': bytes(self.arena[offset:offset \
+                    + self.payload_lens[idx]])}
+
+
+class TxnSegmentWriter(TxnColumns):
+
+    def __init__(self):
+        """
+        Initialize an empty in-memory segment that transactions are appended
+        to until it is spilled
+        """
+
+        for name, typecode in COLUMNS:
+            setattr(self, name, array(typecode))
+        self.arena = bytearray()
+        self.count = 0x00
+        self.flags = SEGMENT_SORTED
+        self.min_ts = self.max_ts = 0.0
+        self.fnc_bitmap = bytearray(0x20)
+        self.src_bitmap = bytearray(0x20)
+        self.dst_bitmap = bytearray(0x20)
+
+    def append(self, ts, src_id, dst_id, payload):
+        """
+        Add a transaction to the columns and its payload to the arena
+
+        Keyword arguments:
+        ts -- the time its FPGA message was received
+        src_id -- the sending module
+        dst_id -- the receiving module
+        payload -- the UMAS payload
+        """
+
+        fnc = payload[2] if len(payload) > 0x02 else NO_FNC
+
+        if not self.count:
+            self.min_ts = self.max_ts = ts
+        elif ts < self.max_ts:
+            self.flags &= ~SEGMENT_SORTED
+        self.min_ts = min(self.min_ts, ts)
+        self.max_ts = max(self.max_ts, ts)
+
+        self.ts.append(ts)
+        self.src_ids.append(src_id)
+        self.dst_ids.append(dst_id)
+        self.fncs.append(fnc)
+        self.payload_offs.append(len(self.arena))
+        self.payload_lens.append(len(payload))
+        self.arena += payload
+        self.count += 0x01
+
+        self.src_bitmap[src_id >> 0x03] |= 0x01 << (src_id & 0x07)
+        self.dst_bitmap[dst_id >> 0x03] |= 0x01 << (dst_id & 0x07)
+        if fnc != NO_FNC:
+            self.fnc_bitmap[fnc >> 0x03] |= 0x01 << (fnc & 0x07)
+
+    def nbytes(self):
+        return self.count * sum(array(typecode).itemsize \
+            for _, typecode in COLUMNS) + len(self.arena)
+
+    def spill(self, path):
+        """
+        Write the segment to a file that TxnSegment can map, going through a
+        .part file so readers never see a partial segment
+
+        Keyword arguments:
+        path -- the segment file
+        """
+
+        with open(path + '.part', 'wb') as f:
+            f.write(SEGMENT_HDR.pack(SEGMENT_MAGIC, SEGMENT_VERSION, \
+                self.flags, self.count, 0x00, self.min_ts, self.max_ts, \
+                bytes(self.fnc_bitmap), bytes(self.src_bitmap), \
+                bytes(self.dst_bitmap), len(self.arena)))
+            written = SEGMENT_HDR.size
+            for name, _ in COLUMNS:
+                column = getattr(self, name).tobytes()
+                f.write(column)
+                written += len(column)
+            f.write(bytes(-written & 0x07))
+            f.write(self.arena)
+        os.rename(path + '.part', path)
+
+
+class TxnSegment(TxnColumns):
+
+    def __init__(self, path):
+        """
+        Map a spilled segment, reading its columns in place
+
+        Keyword arguments:
+        path -- the segment file
+        """
+
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0x00, access=mmap.ACCESS_READ)
+
+        if len(self.mm) < SEGMENT_HDR.size:
+            raise ValueError('{} is too short to be a segment'.format(path))
+        magic, version, self.flags, self.count, _, self.min_ts, self.max_ts, \
+            self.fnc_bitmap, self.src_bitmap, self.dst_bitmap, arena_sz \
+            = SEGMENT_HDR.unpack_from(self.mm)
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+            raise ValueError('{} is not a version {} segment'.format(path, \
+                SEGMENT_VERSION))
+
+        self.view = view = memoryview(self.mm)
+        offset = SEGMENT_HDR.size
+        for name, typecode in COLUMNS:
+            column_sz = self.count * array(typecode).itemsize
+            setattr(self, name, view[offset:offset + column_sz] \
+                .cast(typecode))
+            offset += column_sz
+        offset += -offset & 0x07
+        self.arena = view[offset:offset + arena_sz]
+
+    def close(self):
+        for name, _ in COLUMNS:
+            getattr(self, name).release()
+        self.arena.release()
+        self.view.release()
+        self.mm.close()
+
+
+def segment_paths(directory):
+    """
+    Return the segment files in a directory, oldest first
+
+    Keyword arguments:
+    directory -- the store's directory
+    """
+
+    return sorted(os.path.join(directory, name) \
+        for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+
+
+class UmasTxnStore():
+
+    def __init__(self, directory, segment_secs=60.0, segment_bytes=0x1000000, \
+            max_segments=0x00):
+        """
+        Initialize an append-only store of UMAS transactions kept in compact
+        columns: timestamp, source and destination module, function code
+        and the offset and length of the payload in an arena
+
+        Transactions go to an in-memory segment that is spilled to
+        <directory>/<first ts>.<pid>.<seq>.umastxn once it spans `segment_secs`
+        or holds `segment_bytes`. Each segment records its time range and
+        bitmaps of the function codes and modules within it, so queries
+        skip the segments that cannot match
+
+        Keyword arguments:
+        directory -- where segments are spilled, created if missing
+        segment_secs -- the time span after which a segment is spilled
+        segment_bytes -- the size after which a segment is spilled
+        max_segments -- the number of spilled segments to keep, 0 to keep
+                        them all
+        """
+
+        self.directory = directory
+        self.segment_secs = segment_secs
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+
+        os.makedirs(directory, exist_ok=True)
+        self.paths = segment_paths(directory)
+        self.segment_seq = 0x00
+        self.segment = TxnSegmentWriter()
+        self.opened = time()
+
+    def append(self, umas_txn):
+        """
+        Store a transaction, spilling the current segment first once full
+
+        Keyword arguments:
+        umas_txn -- a dict holding the src_id, dst_id, payload and ingest_ts
+        """
+
+        ts = umas_txn.get('ingest_ts') or time()
+        segment = self.segment
+        if segment.count and (ts - segment.min_ts >= self.segment_secs \
+          or segment.nbytes() >= self.segment_bytes):
+            self.spill()
+
+        self.segment.append(ts, umas_txn['src_id'], umas_txn['dst_id'], \
+            umas_txn['payload'])
+
+    def expire(self, now=None):
+        """
+        Spill the current segment once it has been open for `segment_secs`,
+        so transactions become queryable even when traffic stops
+
+        Keyword arguments:
+        now -- the current time
+        """
+
+        if now is None:
+            now = time()
+        if self.segment.count and now - self.opened >= self.segment_secs:
+            self.spill()
+
+    def spill(self):
+        """
+        Write the current segment out and start a new one
+        """
+
+        self.opened = time()
+        if not self.segment.count:
+            return
+
+        path = os.path.join(self.directory, '{:.6f}.{}.{:04d}{}'.format( \
+            self.segment.min_ts, os.getpid(), self.segment_seq, \
+            SEGMENT_SUFFIX))
+        self.segment_seq = (self.segment_seq + 0x01) % 0x2710
+        self.segment.spill(path)
+        self.paths.append(path)
+        self.segment = TxnSegmentWriter()
+
+        while self.max_segments and len(self.paths) > self.max_segments:
+            os.unlink(self.paths.pop(0x00))
+
+    def close(self):
+        self.spill()
+
+
+class UmasTxnIndex():
+
+    def __init__(self, directory):
+        """
+        Initialize a read-only view of the segments a UmasTxnStore spilled
+
+        Keyword arguments:
+        directory -- the store's directory
+        """
+
+        self.directory = directory
+        self.segments = {}
+        self.refresh()
+
+    def refresh(self):
+        """
+        Map segments spilled since the last refresh and drop removed ones
+        """
+
+        paths = segment_paths(self.directory)
+        for path in set(self.segments) - set(paths):
+            self.segments.pop(path).close()
+        for path in paths:
+            if path not in self.segments:
+                self.segments[path] = TxnSegment(path)
+
+    def query(self, start=None, end=None, src_id=None, dst_id=None, \
+            fnc_codes=None):
+        """
+        Yield a dict per matching transaction, segment by segment in the
+        order they were spilled, see `TxnColumns.select` for the arguments
+        """
+
+        if fnc_codes is not None:
+            fnc_codes = frozenset(fnc_codes)
+        for path in sorted(self.segments):
+            yield from self.segments[path].select(start, end, src_id, \
+                dst_id, fnc_codes)
+
+    def stats(self):
+        """
+        Return the number of segments, transactions they hold and their
+        time range
+        """
+
+        segments = list(self.segments.values())
+        return {'segments': len(segments), \
+            'txns': sum(segment.count for segment in segments), \
+            'min_ts': min((segment.min_ts for segment in segments \
+                if segment.count), default=None), \
+            'max_ts': max((segment.max_ts for segment in segments \
+                if segment.count), default=None)}
+
+    def close(self):
+        for segment in self.segments.values():
+            segment.close()
+        self.segments = {}
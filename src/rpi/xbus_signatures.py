@@ -0,0 +1,139 @@
+# Copyright 2024 Cisco Systems
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+
+# XBUS message types and the big endian bytes found in every FPGA message
+# carrying one, as comma separated name=hex pairs
+XBUS_SIGNATURES = 'umas=08640100007f'
+
+
+def parse_signatures(spec):
+    """
+    Return a list of (name, signature bytes) tuples from comma separated
+    name=hex pairs
+
+    Keyword arguments:
+    spec -- the signatures, such as XBUS_SIGNATURES
+    """
+
+    signatures = []
+    for entry in spec.split(','):
+        if not entry.strip():
+            continue
+        name, signature = entry.split('=')
+        signature = bytes.fromhex(signature)
+        if not signature:
+            raise ValueError('empty signature for `{}`'.format(name))
+        signatures.append((name.strip(), signature))
+    return signatures
+
+
+class XbusSignatureTable():
+
+    def __init__(self, signatures):
+        """
+        Compile a table of XBUS message signatures that is matched against
+        the raw little endian FPGA words, so messages without any of them
+        never have to be byte swapped
+
+        A signature can start at any of the four byte offsets within a
+        32-bit word, and each offset reverses its bytes differently. Every
+        offset gets its own pattern, where the bytes sharing a word with the
+        rest of the message become wildcards, and a match only counts when
+        it lines up with the word boundaries. Offsets that end up with the
+        same pattern share a single one
+
+        Keyword arguments:
+        signatures -- a list of (name, big endian signature) tuples, matched
+                      in order
+        """
+
+        self.names = []
+        self.signatures = []
+        self.entries = []
+
+        for name, signature in signatures:
+            # the positions within a word each pattern may start at
+            starts = {}
+            for align in range(0x04):
+                pattern, lead = self._wordSwapped(signature, align)
+                starts.setdefault(pattern, set()).add(lead)
+
+            self.names.append(name)
+            self.signatures.append(signature)
+            self.entries.append((name, [(re.compile(pattern, re.DOTALL), \
+                frozenset(pattern_starts)) \
+                for pattern, pattern_starts in starts.items()]))
+
+    def _wordSwapped(self, signature, align):
+        """
+        Return a (pattern, lead) tuple describing how a signature looks in
+        the little endian words, where lead is the number of bytes between
+        the start of the first word and the start of the pattern
+
+        Keyword arguments:
+        signature -- the big endian signature
+        align -- the offset of the signature's first byte within its word
+        """
+
+        padded = [None] * align + list(signature) \
+            + [None] * (-(align + len(signature)) & 0x03)
+
+        swapped = []
+        for idx in range(0x00, len(padded), 0x04):
+            swapped += reversed(padded[idx:idx + 0x04])
+
+        # bytes outside the signature at either end need no matching
+        lead = 0x00
+        while swapped[lead] is None:
+            lead += 0x01
+        while swapped[-1] is None:
+            swapped.pop()
+
+        pattern = b''.join(b'.' if byte is None else re.escape(bytes((byte, ))) \
+            for byte in swapped[lead:])
+        return pattern, lead
+
+    def match(self, raw_fpga_msg):
+        """
+        Return the name of the first signature found in a raw FPGA message
+        made of whole little endian words, or None
+
+        Keyword arguments:
+        raw_fpga_msg -- the raw little endian FPGA message
+        """
+
+        for name, patterns in self.entries:
+            for pattern, starts in patterns:
+                match = pattern.search(raw_fpga_msg)
+                while match is not None:
+                    if match.start() & 0x03 in starts:
+                        return name
+                    match = pattern.search(raw_fpga_msg, match.start() + 0x01)
+        return None
+
+    def match_swapped(self, cur_fpga_msg):
+        """
+        Return the name of the first signature found in an FPGA message that
+        has already been swapped to big endian, or None
+
+        Keyword arguments:
+        cur_fpga_msg -- the big endian FPGA message
+        """
+
+        for name, signature in zip(self.names, self.signatures):
+            if signature in cur_fpga_msg:
+                return name
+        return None